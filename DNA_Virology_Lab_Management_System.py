@@ -1,38 +1,626 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, simpledialog
 import sqlite3
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import csv
 import os
 from pathlib import Path
+from dataclasses import dataclass
 import qrcode
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageTk
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4, letter
 from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image as ReportLabImage
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak, Image as ReportLabImage
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch, mm
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from xml.sax.saxutils import escape as xml_escape
 import tempfile
 import shutil
 import hashlib
+import hmac
+import logging
 import json
 import threading
 import random
+import asyncio
+import concurrent.futures
+import queue
+import time
+import contextlib
+import uuid
+import bisect
+import re
+import array
+import collections
+import sys
+import argparse
+import urllib.parse
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Date columns on items stored as ISO YYYY-MM-DD text
+ITEM_DATE_FIELDS = ("purchase_date", "warranty_until", "last_calibration", "next_calibration", "expiry_date")
+ISO_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# Column default for timestamps, in local time like every Python-side writer
+LOCAL_TIMESTAMP_SQL = "(strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime'))"
+DATE_INPUT_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%Y%m%d", "%Y年%m月%d日",
+                      "%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y", "%d %b %Y", "%d %B %Y",
+                      "%b %d, %Y", "%B %d, %Y")
+# US month-first readings, only used to spot values that parse both ways
+MONTH_FIRST_FORMATS = ("%m-%d-%Y", "%m/%d/%Y", "%m.%d.%Y")
+
+def normalize_date(value, strict=False):
+    """Return `value` as an ISO date string, '' when blank; raise ValueError if unparseable.
+    
+    With `strict`, numeric dates that read differently day-first and
+    month-first (03/04/2021) are rejected instead of taken as day-first.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, (date, datetime)):
+        return value.strftime("%Y-%m-%d")
+    text = str(value).strip()
+    if not text:
+        return ""
+    try:
+        return datetime.fromisoformat(text).strftime("%Y-%m-%d")
+    except ValueError:
+        pass
+    readings = []
+    for fmt in DATE_INPUT_FORMATS + (MONTH_FIRST_FORMATS if strict else ()):
+        try:
+            readings.append(datetime.strptime(text, fmt).strftime("%Y-%m-%d"))
+        except ValueError:
+            continue
+    if strict and len(set(readings)) > 1:
+        raise ValueError(f"ambiguous date '{text}', expected YYYY-MM-DD")
+    if readings:
+        return readings[0]
+    raise ValueError(f"unrecognized date '{text}', expected YYYY-MM-DD")
+
+def _text_column(column):
+    return {'expr': column, 'sort': f"IFNULL({column}, '')"}
+
+# Treeview headings and the SQL behind them
+INVENTORY_COLUMNS = {
+    "ID": {'expr': "id", 'sort': "id"},
+    "Name": _text_column("name"),
+    "Name_CN": _text_column("name_cn"),
+    "Category": _text_column("category"),
+    "Location": _text_column("location"),
+    "Quantity": {'expr': "quantity", 'sort': "IFNULL(quantity, 0)"},
+    "Unit": _text_column("unit"),
+    "Manufacturer": _text_column("manufacturer"),
+    "Model Number": _text_column("model_number"),
+    "Serial Number": _text_column("serial_number"),
+    "Purchase Date": _text_column("purchase_date"),
+    "Warranty Until": _text_column("warranty_until"),
+    "Maintenance Contact": _text_column("maintenance_contact"),
+    "Last Calibration": _text_column("last_calibration"),
+    "Next Calibration": _text_column("next_calibration"),
+    "Safety Classification": _text_column("safety_classification")
+}
+INVENTORY_SEARCH_COLUMNS = ("Name", "Name_CN", "Category", "Location", "Unit")
+USAGE_COLUMNS = {
+    "ID": {'expr': "u.id", 'sort': "u.id"},
+    "Item": {'expr': "i.name", 'sort': "IFNULL(i.name, '')"},
+    "User": {'expr': "u.user", 'sort': "IFNULL(u.user, '')"},
+    "Department": {'expr': "u.user_department", 'sort': "IFNULL(u.user_department, '')"},
+    "Quantity": {'expr': "u.quantity_changed", 'sort': "IFNULL(u.quantity_changed, 0)"},
+    "Date": {'expr': "u.timestamp", 'sort': "IFNULL(u.timestamp, '')"},
+    "Purpose": {'expr': "u.purpose", 'sort': "IFNULL(u.purpose, '')"},
+    "Status": {
+        'expr': """CASE WHEN u.returnable = 0 THEN 'Used'
+                        WHEN u.return_time IS NULL THEN 'Active'
+                        ELSE 'Returned' END""",
+        'sort': """CASE WHEN u.returnable = 0 THEN 'Used'
+                        WHEN u.return_time IS NULL THEN 'Active'
+                        ELSE 'Returned' END"""
+    }
+}
+
+def ensure_column(conn, table, column, declaration):
+    """Add `column` to `table` if an older database does not have it yet"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+def rebuild_table(conn, table, create_sql, select_sql="*"):
+    """Recreate `table` from `create_sql`, copying rows through `select_sql`
+    and keeping ids, indexes and triggers"""
+    create_sql = re.sub(rf'^CREATE TABLE\s+"?{table}"?', f'CREATE TABLE {table}_rebuild', create_sql)
+    dependents = [sql for (sql,) in conn.execute("""
+        SELECT sql FROM sqlite_master
+        WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL
+    """, (table,))]
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    
+    conn.commit()
+    conn.execute("PRAGMA foreign_keys = OFF")
+    # Triggers on other tables may name `table`; don't let the rename re-check them mid-swap
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    try:
+        conn.execute("BEGIN")
+        conn.execute(create_sql)
+        conn.execute(f"INSERT INTO {table}_rebuild SELECT {select_sql} FROM {table}")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_rebuild RENAME TO {table}")
+        for sql in dependents:
+            conn.execute(sql)
+        if sequence is not None:
+            conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence[0], table))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA legacy_alter_table = OFF")
+        conn.execute("PRAGMA foreign_keys = ON")
+
+def parse_iso_date(value, field="date"):
+    """`value` as a date, None when blank; raise ValueError naming `field` if it is not ISO"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if not ISO_DATE_PATTERN.match(str(value)):
+        raise ValueError(f"{field} '{value}' is not a YYYY-MM-DD date")
+    try:
+        return date.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f"{field} '{value}' is not a valid date")
+
+def parse_timestamp(value):
+    """A usage_log/items timestamp as a datetime, None when blank"""
+    if value is None or value == "" or isinstance(value, datetime):
+        return value or None
+    return datetime.fromisoformat(str(value))
+
+# Typed rows built straight from the cursor
+@dataclass
+class Item:
+    """One row of `items`.
+    
+    `select_sql` lists `COLUMNS` explicitly, so the row factory can build
+    the record positionally and a missing column fails when the query is
+    prepared rather than surfacing later as a shifted tuple index.
+    """
+    __slots__ = ("id", "name", "name_cn", "item_type", "category", "location", "quantity", "unit",
+                 "manufacturer", "model_number", "serial_number", "purchase_date", "warranty_until",
+                 "maintenance_contact", "last_calibration", "next_calibration", "safety_classification",
+                 "last_updated", "notes", "version", "expiry_date", "deleted_at", "location_id")
+    id: str
+    name: str
+    name_cn: str
+    item_type: str
+    category: str
+    location: str
+    quantity: int
+    unit: str
+    manufacturer: str
+    model_number: str
+    serial_number: str
+    purchase_date: str
+    warranty_until: str
+    maintenance_contact: str
+    last_calibration: str
+    next_calibration: str
+    safety_classification: str
+    last_updated: datetime
+    notes: str
+    version: int
+    expiry_date: str
+    deleted_at: str
+    location_id: int
+    
+    COLUMNS = __slots__
+
+    @classmethod
+    def select_sql(cls, where=""):
+        return f"SELECT {', '.join(cls.COLUMNS)} FROM items {where}"
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        return cls(*row)
+
+    @classmethod
+    def query(cls, conn, where="", params=()):
+        """Cursor yielding Item records"""
+        cursor = conn.cursor()
+        cursor.row_factory = cls.row_factory
+        return cursor.execute(cls.select_sql(where), params)
+
+    @classmethod
+    def fetch(cls, conn, item_id, include_deleted=False):
+        where = "WHERE id = ?" if include_deleted else "WHERE id = ? AND deleted_at IS NULL"
+        return cls.query(conn, where, (item_id,)).fetchone()
+
+    def date_value(self, field):
+        """A date column as a date (None when blank); raises ValueError for non-ISO text"""
+        if field not in ITEM_DATE_FIELDS:
+            raise KeyError(field)
+        return parse_iso_date(getattr(self, field), field)
+
+@dataclass
+class UsageEntry:
+    """One row of `usage_log`, with `timestamp` and `return_time` as datetimes"""
+    __slots__ = ("id", "item_id", "user", "user_department", "quantity_changed", "timestamp",
+                 "purpose", "notes", "supervisor_approval", "return_time", "returnable")
+    id: int
+    item_id: str
+    user: str
+    user_department: str
+    quantity_changed: int
+    timestamp: datetime
+    purpose: str
+    notes: str
+    supervisor_approval: str
+    return_time: datetime
+    returnable: int
+    
+    COLUMNS = __slots__
+
+    @classmethod
+    def select_sql(cls, where=""):
+        return f"SELECT {', '.join(cls.COLUMNS)} FROM usage_log {where}"
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        entry = cls(*row)
+        entry.timestamp = parse_timestamp(entry.timestamp)
+        entry.return_time = parse_timestamp(entry.return_time)
+        return entry
+
+    @classmethod
+    def query(cls, conn, where="", params=()):
+        """Cursor yielding UsageEntry records"""
+        cursor = conn.cursor()
+        cursor.row_factory = cls.row_factory
+        return cursor.execute(cls.select_sql(where), params)
+
+@dataclass
+class ReorderProposal:
+    """One line proposed by `ReorderPlanner.proposals`"""
+    __slots__ = ("manufacturer", "item_id", "name", "name_cn", "model_number", "unit",
+                 "quantity", "reorder_point", "daily_rate", "order_quantity")
+    manufacturer: str
+    item_id: str
+    name: str
+    name_cn: str
+    model_number: str
+    unit: str
+    quantity: int
+    reorder_point: float
+    daily_rate: float
+    order_quantity: int
+    
+    COLUMNS = __slots__
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        return cls(*row)
 
 # Simulated IoT Device Integration
 class IoTDevice:
-    def __init__(self, device_id):
+    def __init__(self, device_id, ingestion_service=None):
         self.device_id = device_id
         self.status = "online"
+        self.ingestion_service = ingestion_service
+    
+    def make_scan_event(self, item_id, quantity=1, user=None):
+        """Build a scan event dict for the ingestion service"""
+        return {
+            'device_id': self.device_id,
+            'item_id': str(item_id),
+            'quantity': int(quantity),
+            'user': user or self.device_id,
+            'timestamp': time.time()
+        }
     
-    def scan_item(self, item_id):
+    def scan_item(self, item_id, quantity=1, user=None):
         if self.status == "online":
+            if self.ingestion_service is not None:
+                self.ingestion_service.submit(self.make_scan_event(item_id, quantity, user))
             return f"Item {item_id} scanned by device {self.device_id}"
         else:
             return "Device offline"
 
+# Simulated scanner that replays high-rate scans for testing
+class SimulatedIoTDevice(IoTDevice):
+    async def replay(self, item_ids, rate_per_minute=600, count=100, burst=1, host=None, port=None):
+        """Replay `count` scans cycling through `item_ids` at `rate_per_minute`.
+        
+        Each scan is repeated `burst` times back to back to mimic a trigger
+        bounce. Events go to the attached ingestion service, or over the
+        local socket when `host`/`port` are given.
+        """
+        interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0
+        writer = None
+        if host is not None and port is not None:
+            _, writer = await asyncio.open_connection(host, port)
+        try:
+            for n in range(count):
+                item_id = item_ids[n % len(item_ids)]
+                for _ in range(burst):
+                    if writer is not None:
+                        event = self.make_scan_event(item_id)
+                        writer.write((json.dumps(event) + "\n").encode())
+                    else:
+                        self.scan_item(item_id)
+                if writer is not None:
+                    await writer.drain()
+                if interval:
+                    await asyncio.sleep(interval)
+        finally:
+            if writer is not None:
+                writer.close()
+                await writer.wait_closed()
+
+# Asynchronous scan ingestion with de-duplication and batched writes
+class ScanIngestionService:
+    """Batches scan events into check-outs on behalf of `session`.
+    
+    Scans are booked directly only when the session may approve
+    check-outs; otherwise they are queued in `usage_requests`.
+    """
+    def __init__(self, db_path, session, host="127.0.0.1", port=8765, dedupe_window=1.0,
+                 batch_size=200, flush_interval=0.5, on_batch=None):
+        session.require('usage.add')
+        self.db_path = str(db_path)
+        self.session = session
+        self.host = host
+        self.port = port
+        self.dedupe_window = dedupe_window
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_batch = on_batch
+        self.results = queue.Queue()
+        self.stats = {'received': 0, 'duplicates': 0, 'applied': 0, 'queued': 0, 'rejected': 0,
+                      'invalid': 0, 'failed': 0, 'batches': 0}
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self._queue = None
+        self._stopping = None
+        self._last_seen = {}
+        self._ready = threading.Event()
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._conn = None
+
+    def start(self):
+        """Start the event loop in a background thread"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self._ready.clear()
+        self.thread = threading.Thread(target=self._run, name="scan-ingestion", daemon=True)
+        self.thread.start()
+        self._ready.wait(timeout=5)
+
+    def stop(self):
+        """Flush pending scans and stop the service"""
+        if self.loop is None or self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self._stopping.set)
+        self.thread.join(timeout=10)
+        self.thread = None
+
+    def submit(self, event):
+        """Thread-safe entry point for scan events"""
+        if self.loop is None or self._queue is None:
+            raise RuntimeError("Scan ingestion service is not running")
+        event = self.validate_event(event)
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, event)
+
+    @staticmethod
+    def validate_event(event):
+        """Normalize a scan event; ValueError unless it is a positive whole-number check-out"""
+        if not isinstance(event, dict) or 'item_id' not in event:
+            raise ValueError("scan event needs an item_id")
+        event = dict(event)
+        event['item_id'] = str(event['item_id'])
+        event.setdefault('quantity', 1)
+        event.setdefault('device_id', "socket")
+        event.setdefault('user', event['device_id'])
+        event.setdefault('timestamp', time.time())
+        quantity, timestamp = event['quantity'], event['timestamp']
+        # bool is an int subclass; stock is only ever taken, never added, by a scan
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity <= 0:
+            raise ValueError(f"quantity must be a positive integer, got {quantity!r}")
+        if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+            raise ValueError(f"timestamp must be epoch seconds, got {timestamp!r}")
+        event['device_id'] = str(event['device_id'])
+        event['user'] = str(event['user'])
+        return event
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+            self.loop = None
+            self._ready.set()
+
+    async def _main(self):
+        self._queue = asyncio.Queue()
+        self._stopping = asyncio.Event()
+        if self.port is not None:
+            self.server = await asyncio.start_server(self._handle_client, self.host, self.port)
+            self.port = self.server.sockets[0].getsockname()[1]
+        self._ready.set()
+        consumer = asyncio.ensure_future(self._consume())
+        await self._stopping.wait()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        await self._queue.join()
+        consumer.cancel()
+        await self.loop.run_in_executor(self._writer, self._close_connection)
+
+    async def _handle_client(self, reader, writer):
+        """Accept newline-delimited JSON scan events from a local socket"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    event = self.validate_event(json.loads(line))
+                except (ValueError, KeyError, TypeError):
+                    self.stats['invalid'] += 1
+                    continue
+                self._queue.put_nowait(event)
+        finally:
+            writer.close()
+
+    def _is_duplicate(self, event):
+        key = (event['device_id'], event['item_id'])
+        last = self._last_seen.get(key)
+        self._last_seen[key] = event['timestamp']
+        return last is not None and event['timestamp'] - last < self.dedupe_window
+
+    async def _consume(self):
+        while True:
+            event = await self._queue.get()
+            batch = [event]
+            deadline = self.loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            unique = []
+            try:
+                for ev in batch:
+                    self.stats['received'] += 1
+                    if self._is_duplicate(ev):
+                        self.stats['duplicates'] += 1
+                    else:
+                        unique.append(ev)
+                if unique:
+                    summary = await self.loop.run_in_executor(self._writer, self._write_batch, unique)
+                    self._publish(summary)
+            except Exception as e:
+                # A failed batch must not stop the consumer, or stop() would wait on the queue forever
+                logging.getLogger(__name__).exception("Scan batch of %d event(s) failed", len(batch))
+                self.stats['failed'] += 1
+                self._publish({
+                    'applied': [],
+                    'queued': [],
+                    'rejected': [{'item_id': ev['item_id'], 'user': ev['user'], 'device_id': ev['device_id'],
+                                  'quantity': ev['quantity'], 'reason': f"write failed: {e}"} for ev in unique],
+                    'item_types': [],
+                    'scans': len(batch)
+                })
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _close_connection(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _write_batch(self, events):
+        """Coalesce scans per item/user and apply or queue them in one transaction"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA foreign_keys = ON")
+        groups = {}
+        for ev in events:
+            key = (ev['item_id'], ev['user'], ev['device_id'])
+            group = groups.setdefault(key, {'quantity': 0, 'scans': 0, 'timestamp': ev['timestamp']})
+            group['quantity'] += int(ev['quantity'])
+            group['scans'] += 1
+            group['timestamp'] = max(group['timestamp'], ev['timestamp'])
+        
+        item_ids = sorted({key[0] for key in groups})
+        conn = self._conn
+        session = self.session
+        direct = session.can('usage.approve')
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            placeholders = ",".join("?" * len(item_ids))
+            stock = dict(conn.execute(
+                f"SELECT id, COALESCE(quantity, 0) FROM items WHERE id IN ({placeholders}) AND deleted_at IS NULL",
+                item_ids).fetchall())
+            item_types = dict(conn.execute(
+                f"SELECT id, item_type FROM items WHERE id IN ({placeholders}) AND deleted_at IS NULL",
+                item_ids).fetchall())
+            
+            applied, rejected, stock_updates = [], [], {}
+            for (item_id, user, device_id), group in groups.items():
+                available = stock.get(item_id)
+                if available is None or available - group['quantity'] < 0:
+                    rejected.append({'item_id': item_id, 'user': user, 'device_id': device_id,
+                                     'quantity': group['quantity'],
+                                     'reason': "unknown item" if available is None else "insufficient stock"})
+                    continue
+                stock[item_id] = available - group['quantity']
+                if direct:
+                    stock_updates[item_id] = stock_updates.get(item_id, 0) + group['quantity']
+                applied.append({
+                    'item_id': item_id, 'user': user, 'device_id': device_id,
+                    'quantity': group['quantity'], 'scans': group['scans'],
+                    'timestamp': datetime.fromtimestamp(group['timestamp']).isoformat()
+                })
+            
+            if not direct:
+                # Held for a supervisor; stock moves only when the request is approved
+                request_ids = AccessControl(conn).request_checkouts(session, [(
+                    entry['item_id'], entry['user'], entry['quantity'], "", "IoT scan",
+                    f"{entry['scans']} scan(s) via device {entry['device_id']} at {entry['timestamp']}", False
+                ) for entry in applied], commit=False)
+                for entry, request_id in zip(applied, request_ids):
+                    entry['request_id'] = request_id
+                queued, applied = applied, []
+            else:
+                queued = []
+            conn.executemany("""
+                INSERT INTO usage_log (
+                    item_id, user, quantity_changed, timestamp, purpose, notes, supervisor_approval
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [(
+                entry['item_id'], entry['user'], entry['quantity'], entry['timestamp'],
+                "IoT scan", f"{entry['scans']} scan(s) via device {entry['device_id']}", session.username
+            ) for entry in applied])
+            conn.executemany("""
+                UPDATE items
+                SET quantity = COALESCE(quantity, 0) - ?, last_updated = ?, version = version + 1
+                WHERE id = ?
+            """, [(qty, datetime.now().isoformat(), item_id) for item_id, qty in stock_updates.items()])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        self.stats['applied'] += len(applied)
+        self.stats['queued'] += len(queued)
+        self.stats['rejected'] += len(rejected)
+        self.stats['batches'] += 1
+        return {
+            'applied': applied,
+            'queued': queued,
+            'rejected': rejected,
+            'item_types': sorted({item_types[item_id] for item_id in stock_updates}),
+            'scans': len(events)
+        }
+
+    def _publish(self, summary):
+        self.results.put(summary)
+        if self.on_batch is not None:
+            self.on_batch(summary)
+
 # Simulated Blockchain Integration
 class Blockchain:
     def __init__(self):
@@ -61,9 +649,24 @@ class AIAssistant:
     
     def predict_inventory_needs(self, inventory_data):
         # Basic prediction logic, ignoring equipment
-        low_stock_items = [item for item in inventory_data if item['quantity'] < 10 and item['item_type'] != 'equipment']
+        low_stock_items = [item for item in inventory_data if (item.quantity or 0) < 10 and item.item_type != 'equipment']
         return low_stock_items
 
+def make_qr_image(item_id, box_size=10):
+    """QR code image for an item's label"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=box_size,
+        border=4,
+    )
+    
+    qr_data = f"Item ID: {item_id}\nProperty of DNA Virology Lab-ICGEB China RRC"
+    qr.add_data(qr_data)
+    qr.make(fit=True)
+    
+    return qr.make_image(fill_color="black", back_color="white").convert("RGB")
+
 # Equipment Cover Generator
 class EquipmentCoverGenerator:
     def __init__(self):
@@ -105,172 +708,5294 @@ class EquipmentCoverGenerator:
         
         return styles
 
-# Enhanced Lab Inventory System
-class LabInventorySystem:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("DNA Virology Lab Management System-ICGEB China RRC")
-        self.root.geometry("1200x700")
-        
-        # Setup directories
-        self.base_dir = Path.home() / "DNA_Virology_Lab_System"
-        self.setup_directories()
-        
-        # Initialize database
-        self.init_database()
+    PREVIEW_FIELDS = (
+        ("Manufacturer", "manufacturer"), ("Model Number", "model_number"),
+        ("Serial Number", "serial_number"), ("Location", "location"),
+        ("Purchase Date", "purchase_date"), ("Warranty Until", "warranty_until"),
+        ("Next Calibration", "next_calibration"), ("Safety", "safety_classification"),
+    )
+    
+    @staticmethod
+    def _preview_font(size):
+        try:
+            return ImageFont.truetype("DejaVuSans.ttf", size)
+        except OSError:
+            return ImageFont.load_default()
+
+    def render_preview(self, item, width=240):
+        """Rasterize a small A4-proportioned preview of the file cover with Pillow"""
+        height = int(width * self.page_height / self.page_width)
+        scale = width / 240
+        image = Image.new("RGB", (width, height), "white")
+        draw = ImageDraw.Draw(image)
+        title_font = self._preview_font(int(14 * scale))
+        text_font = self._preview_font(int(9 * scale))
+        margin = int(12 * scale)
         
-        # Initialize IoT Device
-        self.iot_device = IoTDevice("IoT-001")
+        # Equipment name box and lab name, as on the PDF cover
+        draw.rectangle([margin, margin, width - margin, margin + int(28 * scale)], fill="lightgrey")
+        draw.text((width // 2, margin + int(14 * scale)), str(item.name or ""),
+                  fill="black", font=title_font, anchor="mm")
+        y = margin + int(40 * scale)
+        for line in ("DNA Virology Lab", "ICGEB China RRC"):
+            draw.text((width // 2, y), line, fill="black", font=text_font, anchor="mm")
+            y += int(13 * scale)
         
-        # Initialize Blockchain
-        self.blockchain = Blockchain()
+        # Information table
+        y += int(6 * scale)
+        row_height = int(16 * scale)
+        label_width = int(width * 0.4)
+        for label, field in self.PREVIEW_FIELDS:
+            draw.rectangle([margin, y, width - margin, y + row_height], outline="black")
+            draw.line([label_width, y, label_width, y + row_height], fill="black")
+            draw.text((margin + 3, y + row_height // 2), label, fill="black", font=text_font, anchor="lm")
+            draw.text((label_width + 3, y + row_height // 2), str(getattr(item, field) or "")[:22],
+                      fill="black", font=text_font, anchor="lm")
+            y += row_height
         
-        # Initialize AI Assistant
-        self.ai_assistant = AIAssistant()
+        qr_size = min(width - 2 * margin, height - y - margin - int(8 * scale))
+        if qr_size > 20:
+            qr_image = make_qr_image(item.id, box_size=4).convert("RGB").resize((qr_size, qr_size), Image.NEAREST)
+            image.paste(qr_image, ((width - qr_size) // 2, height - margin - qr_size))
+        return image
+
+# Pooled SQLite connections for background services
+class ConnectionPool:
+    def __init__(self, db_path, size=4, read_only=True):
+        self.db_path = Path(db_path)
+        self.size = size
+        self.read_only = read_only
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.read_only:
+            conn = sqlite3.connect(f"{self.db_path.as_uri()}?mode=ro", uri=True,
+                                   timeout=30, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, opening a new one while below the pool size"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                grow = self._created < self.size
+                if grow:
+                    self._created += 1
+            conn = self._connect() if grow else self._idle.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self._created = 0
+
+# Embedded HTTP/JSON API over the inventory database
+class LabAPIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "LabInventoryAPI/1.0"
+    
+    ITEM_COLUMNS = ("id", "name", "name_cn", "item_type", "category", "location", "quantity", "unit",
+                    "manufacturer", "model_number", "serial_number", "purchase_date",
+                    "warranty_until", "maintenance_contact", "last_calibration",
+                    "next_calibration", "safety_classification", "last_updated", "notes")
+    USAGE_COLUMNS = ("id", "item_id", "user", "user_department", "quantity_changed", "timestamp",
+                     "purpose", "notes", "supervisor_approval", "return_time")
+
+    def log_message(self, format, *args):
+        if self.server.api.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        parts = [p for p in url.path.split("/") if p]
+        try:
+            session = self.authenticate()
+            if session is None:
+                self.send_auth_required()
+                return
+            session.require('inventory.view')
+            if parts == ["items"]:
+                self.list_items(params)
+            elif len(parts) == 2 and parts[0] == "items":
+                self.get_item(urllib.parse.unquote(parts[1]))
+            elif parts == ["search"]:
+                self.list_items(params, search=params.get("q", ""))
+            elif parts == ["usage"]:
+                self.list_usage(params)
+            elif parts == ["reports", "summary"]:
+                self.report_summary()
+            elif parts == ["reports", "low-stock"]:
+                self.report_low_stock(params)
+            else:
+                self.send_json({"error": "not found"}, status=404)
+        except AccessDenied as e:
+            self.send_json({"error": str(e)}, status=403)
+        except ValueError as e:
+            self.send_json({"error": str(e)}, status=400)
+        except Exception as e:
+            self.send_json({"error": str(e)}, status=500)
+
+    def do_POST(self):
+        parts = [p for p in urllib.parse.urlsplit(self.path).path.split("/") if p]
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if parts == ["usage"]:
+                session = self.authenticate()
+                if session is None:
+                    self.send_auth_required()
+                    return
+                entry = self.server.api.record_usage(payload, session)
+                self.send_json(entry, status=202 if entry.get("status") == "pending" else 201)
+            else:
+                self.send_json({"error": "not found"}, status=404)
+        except AccessDenied as e:
+            self.send_json({"error": str(e)}, status=403)
+        except (ValueError, KeyError) as e:
+            self.send_json({"error": str(e)}, status=400)
+        except Exception as e:
+            self.send_json({"error": str(e)}, status=500)
+
+    def authenticate(self):
+        """The Session for HTTP Basic credentials, or None"""
+        scheme, _, credentials = self.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "basic":
+            return None
+        try:
+            username, _, password = base64.b64decode(credentials.strip(), validate=True).decode(
+                "utf-8").partition(":")
+        except ValueError:
+            return None
+        return self.server.api.authenticate(username, password)
+
+    def send_auth_required(self):
+        self.send_json({"error": "authentication required"}, status=401,
+                       headers={"WWW-Authenticate": 'Basic realm="Lab Inventory"'})
+
+    def parse_limit(self, params):
+        limit = int(params.get("limit", self.server.api.page_size))
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        return min(limit, self.server.api.max_page_size)
+
+    def list_items(self, params, search=None):
+        """Keyset-paginated item list ordered by id"""
+        clauses, args = ["deleted_at IS NULL"], []
+        if params.get("type"):
+            clauses.append("item_type = ?")
+            args.append(params["type"])
+        if search:
+            term = f"%{search.lower()}%"
+            clauses.append("""(LOWER(name) LIKE ? OR LOWER(COALESCE(name_cn, '')) LIKE ? OR
+                               LOWER(COALESCE(category, '')) LIKE ? OR LOWER(COALESCE(location, '')) LIKE ?)""")
+            args.extend([term] * 4)
+        if params.get("after"):
+            clauses.append("id > ?")
+            args.append(params["after"])
+        sql = f"SELECT {', '.join(self.ITEM_COLUMNS)} FROM items WHERE {' AND '.join(clauses)} ORDER BY id"
         
-        # Initialize Equipment Cover Generator
-        self.cover_generator = EquipmentCoverGenerator()
+        if params.get("stream") == "1":
+            self.stream_json(sql, args, self.ITEM_COLUMNS)
+            return
         
-        # Create main frames
-        self.create_frames()
+        limit = self.parse_limit(params)
+        with self.server.api.read_pool.connection() as conn:
+            rows = conn.execute(f"{sql} LIMIT ?", args + [limit + 1]).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        items = [dict(zip(self.ITEM_COLUMNS, row)) for row in rows]
+        self.send_json({
+            "items": items,
+            "next_after": items[-1]["id"] if has_more else None
+        }, conditional=True)
+
+    def get_item(self, item_id):
+        with self.server.api.read_pool.connection() as conn:
+            row = conn.execute(f"SELECT {', '.join(self.ITEM_COLUMNS)} FROM items WHERE id = ? AND deleted_at IS NULL",
+                               (item_id,)).fetchone()
+        if row is None:
+            self.send_json({"error": "item not found"}, status=404)
+        else:
+            self.send_json(dict(zip(self.ITEM_COLUMNS, row)), conditional=True)
+
+    def list_usage(self, params):
+        """Keyset-paginated usage log, newest first"""
+        clauses, args = [], []
+        if params.get("item_id"):
+            clauses.append("item_id = ?")
+            args.append(params["item_id"])
+        if params.get("before"):
+            clauses.append("id < ?")
+            args.append(int(params["before"]))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT {', '.join(self.USAGE_COLUMNS)} FROM usage_log {where} ORDER BY id DESC"
         
-        # Create menu bar
-        self.create_menu()
+        if params.get("stream") == "1":
+            self.stream_json(sql, args, self.USAGE_COLUMNS)
+            return
         
-        # Initialize tabs
-        self.create_tabs()
+        limit = self.parse_limit(params)
+        with self.server.api.read_pool.connection() as conn:
+            rows = conn.execute(f"{sql} LIMIT ?", args + [limit + 1]).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        entries = [dict(zip(self.USAGE_COLUMNS, row)) for row in rows]
+        self.send_json({
+            "usage": entries,
+            "next_before": entries[-1]["id"] if has_more else None
+        }, conditional=True)
 
-    def setup_directories(self):
-        """Setup necessary directories for the application"""
-        self.dirs = {
-            'data': self.base_dir / "data",
-            'exports': self.base_dir / "exports",
-            'qrcodes': self.base_dir / "qrcodes",
-            'documents': self.base_dir / "documents",
-            'temp': self.base_dir / "temp"
-        }
+    def report_summary(self):
+        with self.server.api.read_pool.connection() as conn:
+            rows = conn.execute("""
+                SELECT item_type,
+                       COUNT(*) as total_items,
+                       SUM(CASE WHEN quantity <= 0 THEN 1 ELSE 0 END) as out_of_stock,
+                       SUM(quantity) as total_quantity
+                FROM items
+                WHERE deleted_at IS NULL
+                GROUP BY item_type
+            """).fetchall()
+        columns = ("item_type", "total_items", "out_of_stock", "total_quantity")
+        self.send_json({"summary": [dict(zip(columns, row)) for row in rows]}, conditional=True)
+
+    def report_low_stock(self, params):
+        threshold = int(params.get("threshold", 10))
+        with self.server.api.read_pool.connection() as conn:
+            rows = conn.execute("""
+                SELECT id, name, quantity, item_type
+                FROM items
+                WHERE quantity < ? AND item_type != 'equipment' AND deleted_at IS NULL
+                ORDER BY quantity, id
+            """, (threshold,)).fetchall()
+        columns = ("id", "name", "quantity", "item_type")
+        self.send_json({"low_stock": [dict(zip(columns, row)) for row in rows]}, conditional=True)
+
+    def send_json(self, data, status=200, conditional=False, headers=None):
+        """Send a JSON body, answering 304 when the client's ETag still matches"""
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+        etag = None
+        if conditional and status == 200:
+            etag = f'W/"{hashlib.sha1(body).hexdigest()}"'
+            if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_json(self, sql, args, columns):
+        """Stream a JSON array with chunked transfer encoding, one batch at a time"""
+        def write_chunk(data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
         
-        for dir_path in self.dirs.values():
-            dir_path.mkdir(parents=True, exist_ok=True)
+        with self.server.api.read_pool.connection() as conn:
+            # Run the query before committing to a 200 so SQL errors still get a proper status
+            cursor = conn.execute(sql, args)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                write_chunk(b"[")
+                first = True
+                while True:
+                    rows = cursor.fetchmany(self.server.api.page_size)
+                    if not rows:
+                        break
+                    encoded = ",".join(
+                        json.dumps(dict(zip(columns, row)), ensure_ascii=False,
+                                   separators=(",", ":"), default=str)
+                        for row in rows)
+                    write_chunk((b"" if first else b",") + encoded.encode("utf-8"))
+                    first = False
+                write_chunk(b"]")
+                self.wfile.write(b"0\r\n\r\n")
+            except Exception as e:
+                # Headers are already sent: drop the connection without the final chunk
+                # so the client sees a truncated body instead of a second status line
+                cursor.close()
+                self.close_connection = True
+                if not isinstance(e, (BrokenPipeError, ConnectionResetError)):
+                    self.log_error("Streaming %s aborted: %s", self.path, e)
 
-    def init_database(self):
-        """Initialize the SQLite database with datetime support"""
-        try:
-            db_path = self.dirs['data'] / "lab_inventory.db"
-            self.conn = sqlite3.connect(str(db_path), detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-            self.cursor = self.conn.cursor()
+class LabAPIServer:
+    # Seconds a verified Basic credential is reused before it is checked against the database again
+    SESSION_TTL = 60
+    
+    def __init__(self, db_path, host="127.0.0.1", port=8780, pool_size=8,
+                 page_size=100, max_page_size=1000, verbose=False):
+        self.db_path = Path(db_path)
+        self.host = host
+        self.port = port
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.verbose = verbose
+        self.read_pool = ConnectionPool(self.db_path, size=pool_size)
+        self.write_pool = ConnectionPool(self.db_path, size=1, read_only=False)
+        self.httpd = None
+        self.thread = None
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._session_key = os.urandom(32)
 
-            # Register custom datetime adapters and converters
-            sqlite3.register_adapter(datetime, lambda dt: dt.isoformat())
-            sqlite3.register_converter("timestamp", lambda dt: datetime.fromisoformat(dt.decode()))
+    def start(self):
+        """Serve in a background thread"""
+        self.httpd = ThreadingHTTPServer((self.host, self.port), LabAPIRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.api = self
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="lab-api", daemon=True)
+        self.thread.start()
 
-            # Create tables with proper foreign key support
-            self.cursor.execute("PRAGMA foreign_keys = ON")
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS items (
-                    id TEXT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    name_cn TEXT,
-                    item_type TEXT NOT NULL,
-                    category TEXT,
-                    location TEXT,
-                    quantity INTEGER DEFAULT 0,
-                    unit TEXT,
-                    manufacturer TEXT,
-                    model_number TEXT,
-                    serial_number TEXT,
-                    purchase_date TEXT,
-                    warranty_until TEXT,
-                    maintenance_contact TEXT,
-                    last_calibration TEXT,
-                    next_calibration TEXT,
-                    safety_classification TEXT,
-                    last_updated TIMESTAMP,
-                    notes TEXT
-                )
-            """)
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS usage_log (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    item_id TEXT,
-                    user TEXT NOT NULL,
-                    user_department TEXT,
-                    quantity_changed INTEGER,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    purpose TEXT,
-                    notes TEXT,
-                    supervisor_approval TEXT,
-                    return_time TIMESTAMP,
-                    FOREIGN KEY (item_id) REFERENCES items (id) ON DELETE CASCADE
-                )
-            """)
-            self.conn.commit()
-        except Exception as e:
-            messagebox.showerror("Database Error", f"Failed to initialize database: {str(e)}")
-            raise
+    def serve_forever(self):
+        """Serve in the calling thread until interrupted"""
+        self.httpd = ThreadingHTTPServer((self.host, self.port), LabAPIRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.api = self
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
 
-    def create_frames(self):
-        """Create main application frames"""
-        self.main_frame = ttk.Frame(self.root)
-        self.main_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+    def stop(self):
+        if self.httpd is not None:
+            if self.thread is not None:
+                self.httpd.shutdown()
+                self.thread.join(timeout=5)
+                self.thread = None
+            self.httpd.server_close()
+            self.httpd = None
+        self.read_pool.close_all()
+        self.write_pool.close_all()
+
+    def authenticate(self, username, password):
+        """A Session for valid credentials, otherwise None.
         
-        self.status_bar = ttk.Label(self.root, text="Ready", relief=tk.SUNKEN, anchor=tk.W)
-        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        Every request carries its credentials, so a verified pair is kept
+        (keyed by an HMAC, never in clear) for `SESSION_TTL` seconds rather
+        than paying for PBKDF2 and a last_login write on each GET. Password,
+        role and deactivation changes apply once the entry expires.
+        """
+        key = hmac.new(self._session_key, f"{username}\0{password}".encode("utf-8"), hashlib.sha256).digest()
+        now = time.monotonic()
+        with self._sessions_lock:
+            cached = self._sessions.get(key)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+        with self.write_pool.connection() as conn:
+            session = AccessControl(conn).authenticate(username, password)
+        if session is not None:
+            with self._sessions_lock:
+                self._sessions = {k: v for k, v in self._sessions.items() if v[1] > now}
+                self._sessions[key] = (session, now + self.SESSION_TTL)
+        return session
 
-    def create_menu(self):
-        """Create menu bar"""
-        self.menubar = tk.Menu(self.root)
-        self.root.config(menu=self.menubar)
+    def record_usage(self, payload, session):
+        """Post a usage entry with the same rules as the Add Usage Log dialog.
         
-        # File Menu
-        file_menu = tk.Menu(self.menubar, tearoff=0)
-        self.menubar.add_cascade(label="File 文件", menu=file_menu)
-        file_menu.add_command(label="Export Inventory 导出库存", command=self.export_inventory)
-        file_menu.add_command(label="Export Usage Log 导出使用记录", command=self.export_usage_log)
-        file_menu.add_separator()
-        file_menu.add_command(label="Exit 退出", command=self.root.quit)
+        Check-outs by a session that may not approve them are queued in
+        `usage_requests` instead; the approver is always the session's user.
+        """
+        session.require('usage.add')
+        item_id = str(payload["item_id"])
+        user = str(payload.get("user", "")).strip()
+        if not user:
+            raise ValueError("User is required")
+        quantity_changed = int(payload["quantity_changed"])
+        if quantity_changed == 0:
+            raise ValueError("Quantity changed cannot be zero")
         
-        # Tools Menu
-        tools_menu = tk.Menu(self.menubar, tearoff=0)
-        self.menubar.add_cascade(label="Tools 工具", menu=tools_menu)
-        tools_menu.add_command(label="Generate Report 生成报告", command=self.generate_report)
-        tools_menu.add_command(label="Backup Database 备份数据库", command=self.backup_database)
-        tools_menu.add_command(label="AI Predict Inventory Needs AI预测库存需求", command=self.ai_predict_inventory_needs)
+        user_department = str(payload.get("user_department", "")).strip()
+        purpose = str(payload.get("purpose", "")).strip()
+        notes = str(payload.get("notes", "")).strip()
         
-        # About Menu
-        about_menu = tk.Menu(self.menubar, tearoff=0)
-        self.menubar.add_cascade(label="About 关于", menu=about_menu)
-        about_menu.add_command(label="About 关于", command=self.show_about)
+        with self.write_pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Legacy rows may hold a NULL quantity; treat it as empty stock
+            row = conn.execute("SELECT COALESCE(quantity, 0) FROM items WHERE id = ? AND deleted_at IS NULL",
+                               (item_id,)).fetchone()
+            if row is None:
+                raise ValueError("Item not found")
+            if row[0] - quantity_changed < 0:
+                raise ValueError("Not enough quantity in stock")
+            if quantity_changed > 0 and not session.can('usage.approve'):
+                request_id = AccessControl(conn).request_checkout(
+                    session, item_id, user, quantity_changed, user_department, purpose, notes)
+                return {"request_id": request_id, "status": "pending", "item_id": item_id, "user": user,
+                        "quantity_changed": quantity_changed}
+            cursor = conn.execute("""
+                INSERT INTO usage_log (
+                    item_id, user, user_department, quantity_changed,
+                    purpose, notes, supervisor_approval
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (
+                item_id,
+                user,
+                user_department,
+                quantity_changed,
+                purpose,
+                notes,
+                session.username if quantity_changed > 0 else ""
+            ))
+            conn.execute("""
+                UPDATE items
+                SET quantity = COALESCE(quantity, 0) - ?, last_updated = ?, version = version + 1
+                WHERE id = ?
+            """, (quantity_changed, datetime.now().isoformat(), item_id))
+            conn.commit()
+            return {"id": cursor.lastrowid, "item_id": item_id, "user": user,
+                    "quantity_changed": quantity_changed, "remaining": row[0] - quantity_changed}
 
-    def create_tabs(self):
-        """Create main application tabs"""
-        self.tab_control = ttk.Notebook(self.main_frame)
-        self.tab_control.pack(fill=tk.BOTH, expand=True)
+# Change-data-capture and delta replication between lab databases
+class SyncEngine:
+    """Replicate item and usage changes between workstation databases.
+    
+    Triggers on `items`, `usage_log` and `item_lots` append every mutation to
+    `change_log`, tagged with the originating site and a per-site sequence
+    number. `sync_vector` holds the highest sequence seen from each site, so
+    two databases only exchange changes the other side has not seen yet.
+    
+    Conflicts are resolved deterministically: quantity updates are applied
+    as deltas (new - old), so concurrent stock movements add up in any
+    order; every other field is last-writer-wins on (changed_at, site id).
+    
+    Stock lots replicate too: lot rows are keyed like usage rows and their
+    quantities merge as deltas. While remote changes are replayed the lot
+    triggers are paused (the origin's lot movements arrive as changes of
+    their own); afterwards any item whose lots no longer add up is
+    reconciled locally, which every site does identically.
+    
+    New item ids carry the site id (`new_item_id`), so sites never mint the
+    same id. An incoming INSERT for an id that already names a different
+    item here is recorded in `sync_conflicts` and skipped, together with
+    every later change to that id from the same origin.
+    """
+    TRACKED_TABLES = {'items': 'id', 'usage_log': 'id', 'item_lots': 'id'}
+    # Tables with integer ids; they are keyed '<site>:<id>' and mapped to local ids
+    SITE_KEYED_TABLES = ('usage_log', 'item_lots')
+    # Fields that say two rows with the same id are the same physical item
+    ITEM_IDENTITY = ('item_type', 'name')
+    
+    def __init__(self, conn):
+        self.conn = conn
+
+    @classmethod
+    def install(cls, conn):
+        """Create capture tables and (re)create triggers for the current columns"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS change_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                origin_site TEXT NOT NULL,
+                origin_seq INTEGER NOT NULL,
+                table_name TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                op TEXT NOT NULL,
+                old_data TEXT,
+                new_data TEXT,
+                changed_at TEXT NOT NULL,
+                UNIQUE (origin_site, origin_seq)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_vector (
+                origin_site TEXT PRIMARY KEY,
+                max_seq INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_row_map (
+                table_name TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                local_id INTEGER NOT NULL,
+                PRIMARY KEY (table_name, row_key)
+            )
+        """)
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sync_row_map_local ON sync_row_map (table_name, local_id)")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_field_stamps (
+                table_name TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                field TEXT NOT NULL,
+                stamp TEXT NOT NULL,
+                PRIMARY KEY (table_name, row_key, field)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_conflicts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                origin_site TEXT NOT NULL,
+                origin_seq INTEGER NOT NULL,
+                table_name TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                op TEXT NOT NULL,
+                new_data TEXT,
+                reason TEXT NOT NULL,
+                detected_at TEXT NOT NULL,
+                UNIQUE (origin_site, origin_seq)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sync_conflicts_key ON sync_conflicts (origin_site, row_key)")
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('capture_paused', '0')")
+        # Set while remote changes are replayed; pauses the lot triggers
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('replaying_changes', '0')")
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('stamped_seq', '0')")
         
-        # Equipment Tab
-        self.equipment_tab = ttk.Frame(self.tab_control)
-        self.tab_control.add(self.equipment_tab, text="Equipment 设备")
-        self.create_inventory_tab(self.equipment_tab, "equipment")
+        site_id = cursor.execute("SELECT value FROM app_meta WHERE key = 'site_id'").fetchone()
+        first_install = site_id is None
+        if first_install:
+            site_id = uuid.uuid4().hex[:12]
+            cursor.execute("INSERT INTO app_meta (key, value) VALUES ('site_id', ?)", (site_id,))
+            cursor.execute("INSERT OR IGNORE INTO sync_vector (origin_site, max_seq) VALUES (?, 0)", (site_id,))
         
-        # Chemicals Tab
-        self.chemicals_tab = ttk.Frame(self.tab_control)
-        self.tab_control.add(self.chemicals_tab, text="Chemicals 化学品")
-        self.create_inventory_tab(self.chemicals_tab, "chemical")
+        tables = [table for table in cls.TRACKED_TABLES if conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()]
+        for table in tables:
+            for op in ("insert", "update", "delete"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS trg_capture_{table}_{op}")
+            for statement in cls._trigger_sql(conn, table):
+                cursor.execute(statement)
         
-        # Consumables Tab
-        self.consumables_tab = ttk.Frame(self.tab_control)
-        self.tab_control.add(self.consumables_tab, text="Consumables 消耗品")
-        self.create_inventory_tab(self.consumables_tab, "consumable")
+        # Tables tracked since the first install (or added later) start from their existing rows, once
+        captured = cursor.execute("SELECT value FROM app_meta WHERE key = 'captured_tables'").fetchone()
+        if captured is not None:
+            captured = json.loads(captured[0])
+        else:
+            captured = [] if first_install else ['items', 'usage_log']
+        missing = [table for table in tables if table not in captured]
+        if missing:
+            cls(conn)._capture_existing_rows(missing)
+        cursor.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('captured_tables', ?)",
+                       (json.dumps(captured + missing),))
+
+    @classmethod
+    def _trigger_sql(cls, conn, table):
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
         
-        # Other Tab
-        self.other_tab = ttk.Frame(self.tab_control)
-        self.tab_control.add(self.other_tab, text="Other 其他")
-        self.create_inventory_tab(self.other_tab, "other")
+        def row_json(alias):
+            return "json_object(" + ", ".join(f"'{c}', {alias}.{c}" for c in columns) + ")"
+        
+        if table in cls.SITE_KEYED_TABLES:
+            # Rows replicated from another site keep their original key
+            def row_key(alias):
+                return (f"COALESCE((SELECT row_key FROM sync_row_map WHERE table_name = '{table}' "
+                        f"AND local_id = {alias}.id), (SELECT value FROM app_meta WHERE key = 'site_id') "
+                        f"|| ':' || {alias}.id)")
+        else:
+            def row_key(alias):
+                return f"{alias}.id"
+        
+        site = "(SELECT value FROM app_meta WHERE key = 'site_id')"
+        active = "(SELECT value FROM app_meta WHERE key = 'capture_paused') = '0'"
+        statements = []
+        for op, old, new, key_alias in (("insert", "NULL", row_json("NEW"), "NEW"),
+                                        ("update", row_json("OLD"), row_json("NEW"), "NEW"),
+                                        ("delete", row_json("OLD"), "NULL", "OLD")):
+            statements.append(f"""
+                CREATE TRIGGER trg_capture_{table}_{op}
+                AFTER {op.upper()} ON {table}
+                WHEN {active}
+                BEGIN
+                    UPDATE sync_vector SET max_seq = max_seq + 1 WHERE origin_site = {site};
+                    INSERT INTO change_log (
+                        origin_site, origin_seq, table_name, row_key, op,
+                        old_data, new_data, changed_at
+                    )
+                    SELECT origin_site, max_seq, '{table}', {row_key(key_alias)}, '{op.upper()}',
+                           {old}, {new}, strftime('%Y-%m-%dT%H:%M:%f', 'now')
+                    FROM sync_vector WHERE origin_site = {site};
+                END
+            """)
+        return statements
+
+    def _capture_existing_rows(self, tables):
+        """Record rows that predate change capture as inserts"""
+        for table in tables:
+            # A no-op update would log an UPDATE; log synthetic INSERTs instead
+            columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+            for row in self.conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid").fetchall():
+                data = dict(zip(columns, row))
+                key = data['id'] if table == 'items' else f"{self.site_id}:{data['id']}"
+                self._log_local_change(table, key, "INSERT", None, data)
+
+    def _log_local_change(self, table, row_key, op, old, new):
+        site_id = self.site_id
+        self.conn.execute("UPDATE sync_vector SET max_seq = max_seq + 1 WHERE origin_site = ?", (site_id,))
+        seq = self.conn.execute("SELECT max_seq FROM sync_vector WHERE origin_site = ?", (site_id,)).fetchone()[0]
+        self.conn.execute("""
+            INSERT INTO change_log (
+                origin_site, origin_seq, table_name, row_key, op, old_data, new_data, changed_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+        """, (site_id, seq, table, str(row_key), op,
+              json.dumps(old, default=str) if old is not None else None,
+              json.dumps(new, default=str) if new is not None else None))
+
+    @property
+    def site_id(self):
+        return self.conn.execute("SELECT value FROM app_meta WHERE key = 'site_id'").fetchone()[0]
+
+    def new_item_id(self, prefix):
+        """`<prefix><n>-<site>`, numbered per site so no other site mints the same id"""
+        site = self.site_id[:6].upper()
+        numbers = [0]
+        for (item_id,) in self.conn.execute("SELECT id FROM items WHERE id LIKE ?", (f"{prefix}%-{site}",)):
+            number = item_id[len(prefix):-len(site) - 1]
+            if number.isdigit():
+                numbers.append(int(number))
+        return f"{prefix}{max(numbers) + 1:04d}-{site}"
+
+    def conflicts(self):
+        """Skipped remote changes, newest first"""
+        return self.conn.execute("""
+            SELECT id, origin_site, table_name, row_key, op, new_data, reason, detected_at
+            FROM sync_conflicts
+            ORDER BY id DESC
+        """).fetchall()
+
+    def _record_conflict(self, change, reason):
+        self.conn.execute("""
+            INSERT OR IGNORE INTO sync_conflicts (
+                origin_site, origin_seq, table_name, row_key, op, new_data, reason, detected_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (change['origin_site'], change['origin_seq'], change['table_name'], change['row_key'],
+              change['op'], change['new_data'], reason, datetime.now().isoformat()))
+
+    def _item_conflicted(self, origin_site, item_id):
+        """True when `origin_site`'s item `item_id` collided with a different local item"""
+        return self.conn.execute("""
+            SELECT 1 FROM sync_conflicts
+            WHERE origin_site = ? AND row_key = ? AND table_name = 'items' AND op = 'INSERT'
+        """, (origin_site, str(item_id))).fetchone() is not None
+
+    def vector(self):
+        """Highest change sequence seen from each origin site"""
+        return dict(self.conn.execute("SELECT origin_site, max_seq FROM sync_vector").fetchall())
+
+    def export_changes(self, since_vector):
+        """Changes not covered by `since_vector`, oldest first per origin"""
+        columns = ("origin_site", "origin_seq", "table_name", "row_key", "op",
+                   "old_data", "new_data", "changed_at")
+        changes = []
+        for origin_site, max_seq in self.vector().items():
+            seen = since_vector.get(origin_site, 0)
+            if seen >= max_seq:
+                continue
+            rows = self.conn.execute(f"""
+                SELECT {', '.join(columns)}
+                FROM change_log
+                WHERE origin_site = ? AND origin_seq > ?
+                ORDER BY origin_seq
+            """, (origin_site, seen)).fetchall()
+            changes.extend(dict(zip(columns, row)) for row in rows)
+        # Replay in wall-clock order so usage rows follow the items they reference
+        changes.sort(key=lambda c: (c['changed_at'], c['origin_site'], c['origin_seq']))
+        return changes
+
+    def _refresh_stamps(self):
+        """Fold change_log rows written since the last sync into per-field stamps"""
+        stamped_seq = int(self.conn.execute(
+            "SELECT value FROM app_meta WHERE key = 'stamped_seq'").fetchone()[0])
+        rows = self.conn.execute("""
+            SELECT seq, origin_site, table_name, row_key, op, old_data, new_data, changed_at
+            FROM change_log
+            WHERE seq > ?
+            ORDER BY seq
+        """, (stamped_seq,)).fetchall()
+        for seq, origin_site, table, row_key, op, old_data, new_data, changed_at in rows:
+            old = json.loads(old_data) if old_data else {}
+            new = json.loads(new_data) if new_data else {}
+            self._stamp_fields(table, row_key, self._changed_fields(old, new), f"{changed_at}|{origin_site}")
+            stamped_seq = seq
+        self.conn.execute("UPDATE app_meta SET value = ? WHERE key = 'stamped_seq'", (str(stamped_seq),))
+
+    @staticmethod
+    def _changed_fields(old, new):
+        return [field for field in new if field not in old or old[field] != new[field]]
+
+    def _stamp_fields(self, table, row_key, fields, stamp):
+        self.conn.executemany("""
+            INSERT INTO sync_field_stamps (table_name, row_key, field, stamp)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (table_name, row_key, field) DO UPDATE SET stamp = excluded.stamp
+            WHERE excluded.stamp > sync_field_stamps.stamp
+        """, [(table, row_key, field, stamp) for field in fields])
+
+    def _winning_fields(self, table, row_key, fields, stamp):
+        """Fields whose incoming stamp beats the local one"""
+        local = dict(self.conn.execute(
+            "SELECT field, stamp FROM sync_field_stamps WHERE table_name = ? AND row_key = ?",
+            (table, row_key)).fetchall())
+        return [field for field in fields if stamp > local.get(field, "")]
+
+    def _local_id(self, table, row_key):
+        row = self.conn.execute(
+            "SELECT local_id FROM sync_row_map WHERE table_name = ? AND row_key = ?",
+            (table, row_key)).fetchone()
+        if row:
+            return row[0]
+        site_id, _, local_id = row_key.partition(":")
+        if site_id == self.site_id:
+            return int(local_id)
+        return None
+
+    def apply_changes(self, changes):
+        """Apply remote changes in one transaction; returns the number applied"""
+        applied = 0
+        if self.conn.in_transaction:
+            self.conn.commit()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("UPDATE app_meta SET value = '1' WHERE key = 'capture_paused'")
+            self.conn.execute("UPDATE app_meta SET value = '1' WHERE key = 'replaying_changes'")
+            self._refresh_stamps()
+            for change in changes:
+                exists = self.conn.execute(
+                    "SELECT 1 FROM change_log WHERE origin_site = ? AND origin_seq = ?",
+                    (change['origin_site'], change['origin_seq'])).fetchone()
+                if exists:
+                    continue
+                fields = self._apply_change(change)
+                self._stamp_fields(change['table_name'], change['row_key'], fields,
+                                   f"{change['changed_at']}|{change['origin_site']}")
+                self.conn.execute("""
+                    INSERT INTO change_log (
+                        origin_site, origin_seq, table_name, row_key, op, old_data, new_data, changed_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (change['origin_site'], change['origin_seq'], change['table_name'], change['row_key'],
+                      change['op'], change['old_data'], change['new_data'], change['changed_at']))
+                self.conn.execute("""
+                    INSERT INTO sync_vector (origin_site, max_seq) VALUES (?, ?)
+                    ON CONFLICT (origin_site) DO UPDATE SET max_seq = MAX(max_seq, excluded.max_seq)
+                """, (change['origin_site'], change['origin_seq']))
+                applied += 1
+            self.conn.execute("UPDATE app_meta SET value = '0' WHERE key = 'replaying_changes'")
+            # Lots that no longer add up (changes that raced with ours) are settled here, the same way on every site
+            if applied and self.conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'item_lots'").fetchone():
+                self.conn.execute("""
+                    UPDATE items SET quantity = quantity
+                    WHERE id IN (
+                        SELECT l.item_id FROM item_lots l JOIN items i ON i.id = l.item_id
+                        GROUP BY l.item_id
+                        HAVING SUM(l.quantity) != MAX(IFNULL(MAX(i.quantity), 0), 0)
+                    )
+                """)
+            self._refresh_stamps()
+            self.conn.execute("UPDATE app_meta SET value = '0' WHERE key = 'capture_paused'")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return applied
+
+    def _apply_change(self, change):
+        """Apply one change and return the fields it set"""
+        table, row_key, op = change['table_name'], change['row_key'], change['op']
+        old = json.loads(change['old_data']) if change['old_data'] else {}
+        new = json.loads(change['new_data']) if change['new_data'] else {}
+        stamp = f"{change['changed_at']}|{change['origin_site']}"
+        columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+        
+        if table == 'items':
+            if self._item_conflicted(change['origin_site'], row_key):
+                self._record_conflict(change, "Item id names a different item here 该编号在本地为另一物品")
+                return []
+            local = self.conn.execute(
+                f"SELECT {', '.join(self.ITEM_IDENTITY)} FROM items WHERE id = ?", (row_key,)).fetchone()
+            if op == "INSERT" and local is not None:
+                if tuple(local) != tuple(new.get(field) for field in self.ITEM_IDENTITY):
+                    self._record_conflict(change, "Item id names a different item here 该编号在本地为另一物品")
+                # The same item created on both sides (e.g. from a shared starting copy); later UPDATEs carry edits
+                return []
+            if op == "DELETE":
+                # Items are only soft-deleted so their usage history stays valid
+                self.conn.execute("UPDATE items SET deleted_at = COALESCE(deleted_at, ?) WHERE id = ?",
+                                  (change['changed_at'], row_key))
+                return []
+            if local is None:
+                if op == "UPDATE":
+                    # The row was deleted here; deletes win over later edits
+                    return []
+                data = {c: new[c] for c in columns if c in new and c != 'location_id'}
+                self.conn.execute(
+                    f"INSERT INTO items ({', '.join(data)}) VALUES ({', '.join('?' * len(data))})",
+                    list(data.values()))
+                return list(data)
+            
+            # Row versions and location ids are local to each site; any applied change bumps ours
+            fields = [f for f in self._changed_fields(old, new)
+                      if f in columns and f not in ('id', 'version', 'location_id')]
+            assignments, values = [], []
+            if op == "UPDATE" and 'quantity' in fields:
+                fields.remove('quantity')
+                assignments.append("quantity = quantity + ?")
+                values.append((new['quantity'] or 0) - (old['quantity'] or 0))
+            winners = self._winning_fields(table, row_key, fields, stamp)
+            for field in winners:
+                assignments.append(f"{field} = ?")
+                values.append(new[field])
+            if assignments:
+                assignments.append("version = version + 1")
+                self.conn.execute(f"UPDATE items SET {', '.join(assignments)} WHERE id = ?", values + [row_key])
+            return winners
+        
+        elif table == 'usage_log':
+            local_id = self._local_id(table, row_key)
+            exists = local_id is not None and self.conn.execute(
+                "SELECT 1 FROM usage_log WHERE id = ?", (local_id,)).fetchone()
+            if op == "INSERT" and not exists:
+                if self._item_conflicted(change['origin_site'], new.get('item_id')):
+                    self._record_conflict(change, "Usage of a conflicting item id 使用记录指向冲突的物品编号")
+                    return []
+                item = self.conn.execute("SELECT 1 FROM items WHERE id = ?", (new.get('item_id'),)).fetchone()
+                if item is None:
+                    # The item was deleted here, so its history goes with it
+                    return []
+                data = {c: new[c] for c in columns if c in new and c != 'id'}
+                cursor = self.conn.execute(
+                    f"INSERT INTO usage_log ({', '.join(data)}) VALUES ({', '.join('?' * len(data))})",
+                    list(data.values()))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO sync_row_map (table_name, row_key, local_id) VALUES ('usage_log', ?, ?)",
+                    (row_key, cursor.lastrowid))
+                return list(data)
+            elif op == "DELETE" and exists:
+                self.conn.execute("DELETE FROM usage_log WHERE id = ?", (local_id,))
+            elif op == "UPDATE" and exists:
+                fields = [f for f in self._changed_fields(old, new) if f in columns and f != 'id']
+                winners = self._winning_fields(table, row_key, fields, stamp)
+                if winners:
+                    self.conn.execute(
+                        f"UPDATE usage_log SET {', '.join(f'{f} = ?' for f in winners)} WHERE id = ?",
+                        [new[f] for f in winners] + [local_id])
+                return winners
+        
+        elif table == 'item_lots':
+            local_id = self._local_id(table, row_key)
+            exists = local_id is not None and self.conn.execute(
+                "SELECT 1 FROM item_lots WHERE id = ?", (local_id,)).fetchone()
+            if op == "INSERT" and not exists:
+                if self._item_conflicted(change['origin_site'], new.get('item_id')):
+                    self._record_conflict(change, "Lot of a conflicting item id 批次指向冲突的物品编号")
+                    return []
+                item = self.conn.execute("SELECT 1 FROM items WHERE id = ?", (new.get('item_id'),)).fetchone()
+                if item is None:
+                    return []
+                data = {c: new[c] for c in columns if c in new and c != 'id'}
+                data['quantity'] = max(data.get('quantity') or 0, 0)
+                cursor = self.conn.execute(
+                    f"INSERT INTO item_lots ({', '.join(data)}) VALUES ({', '.join('?' * len(data))})",
+                    list(data.values()))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO sync_row_map (table_name, row_key, local_id) VALUES ('item_lots', ?, ?)",
+                    (row_key, cursor.lastrowid))
+                return list(data)
+            elif op == "DELETE" and exists:
+                self.conn.execute("DELETE FROM item_lots WHERE id = ?", (local_id,))
+            elif op == "UPDATE" and exists:
+                fields = [f for f in self._changed_fields(old, new)
+                          if f in columns and f not in ('id', 'item_id')]
+                assignments, values = [], []
+                if 'quantity' in fields:
+                    # Lot stock moves by deltas like items.quantity, floored at the CHECK constraint
+                    fields.remove('quantity')
+                    assignments.append("quantity = MAX(quantity + ?, 0)")
+                    values.append((new['quantity'] or 0) - (old['quantity'] or 0))
+                winners = self._winning_fields(table, row_key, fields, stamp)
+                for field in winners:
+                    assignments.append(f"{field} = ?")
+                    values.append(new[field])
+                if assignments:
+                    self.conn.execute(f"UPDATE item_lots SET {', '.join(assignments)} WHERE id = ?",
+                                      values + [local_id])
+                return winners
+        return []
+
+    def sync_with(self, peer_conn):
+        """Exchange deltas in both directions; returns (pulled, pushed)"""
+        peer = SyncEngine(peer_conn)
+        pulled = self.apply_changes(peer.export_changes(self.vector()))
+        pushed = peer.apply_changes(self.export_changes(peer.vector()))
+        return pulled, pushed
+
+# Calibration and warranty scheduling over indexed ISO date columns
+class CalibrationScheduler:
+    """Answer "due within N days" queries and keep a rolling due-list.
+    
+    The due-list covers `horizon_days` ahead (plus anything overdue) and is
+    kept sorted by date; `refresh_item` patches it for a single item after an
+    edit instead of reloading the whole list. Values that are not real dates
+    are left out of the list and reported by `invalid_dates`.
+    """
+    DUE_FIELDS = {
+        'next_calibration': "Calibration 校准",
+        'warranty_until': "Warranty 保修"
+    }
+    
+    def __init__(self, conn, horizon_days=90):
+        self.conn = conn
+        self.horizon_days = horizon_days
+        self.due_list = []
+        self._entries = {}
+
+    @staticmethod
+    def parse_due(value):
+        """A due date as a date, None when blank or not a real YYYY-MM-DD date"""
+        if not value or not ISO_DATE_PATTERN.match(str(value)):
+            return None
+        try:
+            return date.fromisoformat(str(value))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def migrate(conn):
+        """Normalize unambiguous free-form date text to ISO and index the due-date columns.
+        
+        Values that read differently day-first and month-first are kept as
+        typed, so `invalid_dates` lists them for a person to correct.
+        """
+        for field in ITEM_DATE_FIELDS:
+            rows = conn.execute(f"""
+                SELECT id, {field} FROM items
+                WHERE {field} IS NOT NULL AND {field} != ''
+                  AND {field} NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+            """).fetchall()
+            updates = []
+            for item_id, value in rows:
+                try:
+                    updates.append((normalize_date(value, strict=True), item_id))
+                except ValueError:
+                    # Leave unparseable or ambiguous text for the user to fix
+                    pass
+            conn.executemany(f"UPDATE items SET {field} = ? WHERE id = ?", updates)
+        for field in ("next_calibration", "warranty_until", "purchase_date"):
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_items_{field} ON items ({field})")
+        
+        # New values must be real ISO dates; legacy text that was left alone is only checked when rewritten
+        def invalid(field):
+            return (f"NEW.{field} IS NOT NULL AND NEW.{field} != '' AND "
+                    f"(NEW.{field} NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' "
+                    f"OR date(NEW.{field}, '+0 days') IS NOT NEW.{field})")
+        for field in ITEM_DATE_FIELDS:
+            for op in ("insert", "update"):
+                conn.execute(f"DROP TRIGGER IF EXISTS trg_items_{field}_{op}_iso")
+            conn.execute(f"""
+                CREATE TRIGGER trg_items_{field}_insert_iso BEFORE INSERT ON items
+                WHEN {invalid(field)}
+                BEGIN
+                    SELECT RAISE(ABORT, '{field} must be a YYYY-MM-DD date');
+                END
+            """)
+            conn.execute(f"""
+                CREATE TRIGGER trg_items_{field}_update_iso BEFORE UPDATE OF {field} ON items
+                WHEN NEW.{field} IS NOT OLD.{field} AND {invalid(field)}
+                BEGIN
+                    SELECT RAISE(ABORT, '{field} must be a YYYY-MM-DD date');
+                END
+            """)
+
+    def due_within(self, days, fields=None):
+        """Items whose due dates fall on or before today + `days`, overdue included"""
+        limit = (date.today() + timedelta(days=days)).isoformat()
+        results = []
+        for field in fields or self.DUE_FIELDS:
+            # The lower bound keeps blanks out and lets the index drive the range scan
+            rows = self.conn.execute(f"""
+                SELECT {field}, id, name, location, item_type
+                FROM items
+                WHERE {field} BETWEEN '0001-01-01' AND ?
+                  AND {field} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+                  AND date({field}, '+0 days') IS {field}
+                  AND deleted_at IS NULL
+                ORDER BY {field}
+            """, (limit,)).fetchall()
+            results.extend((due, field, item_id, name, location, item_type)
+                           for due, item_id, name, location, item_type in rows)
+        results.sort()
+        return results
+
+    def invalid_dates(self, fields=None):
+        """(value, field, id, name, location, item_type) for due dates that cannot be parsed"""
+        results = []
+        for field in fields or self.DUE_FIELDS:
+            rows = self.conn.execute(f"""
+                SELECT {field}, id, name, location, item_type
+                FROM items
+                WHERE {field} IS NOT NULL AND {field} != ''
+                  AND ({field} NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+                       OR date({field}, '+0 days') IS NOT {field})
+                  AND deleted_at IS NULL
+                ORDER BY id
+            """).fetchall()
+            results.extend((value, field, item_id, name, location, item_type)
+                           for value, item_id, name, location, item_type in rows)
+        return results
+
+    def build(self):
+        """Load the rolling due-list for the configured horizon, counted from today"""
+        self.due_list = self.due_within(self.horizon_days)
+        self._entries = {}
+        for entry in self.due_list:
+            self._entries.setdefault(entry[2], []).append(entry)
+        return self.due_list
+
+    def refresh_item(self, item_id):
+        """Re-evaluate one item's due dates in the rolling list"""
+        for entry in self._entries.pop(item_id, []):
+            index = bisect.bisect_left(self.due_list, entry)
+            if index < len(self.due_list) and self.due_list[index] == entry:
+                del self.due_list[index]
+        
+        row = self.conn.execute(f"""
+            SELECT {', '.join(self.DUE_FIELDS)}, name, location, item_type
+            FROM items WHERE id = ? AND deleted_at IS NULL
+        """, (item_id,)).fetchone()
+        if row is None:
+            return
+        
+        limit = (date.today() + timedelta(days=self.horizon_days)).isoformat()
+        due_dates, (name, location, item_type) = row[:len(self.DUE_FIELDS)], row[len(self.DUE_FIELDS):]
+        for field, due in zip(self.DUE_FIELDS, due_dates):
+            if self.parse_due(due) is None or due > limit:
+                continue
+            entry = (due, field, item_id, name, location, item_type)
+            bisect.insort(self.due_list, entry)
+            self._entries.setdefault(item_id, []).append(entry)
+
+# Daily stock checkpoints for point-in-time and trend queries
+class StockSnapshotStore:
+    """Packed per-type stock checkpoints plus short usage_log replays.
+    
+    Each snapshot row holds the sorted item ids of one item type and their
+    quantities as a packed int64 array, along with the highest usage_log and
+    stock_adjustments ids at the time it was taken. A point-in-time lookup
+    reads the nearest checkpoint and replays only the rows on one side of it.
+    
+    Quantity changes that no usage_log row explains (item edits, bulk
+    edits, repairs, synced deltas) are journalled in `stock_adjustments` by
+    a trigger. Ledger writers insert their usage_log row (or set a loan's
+    return_time) before updating the item, which parks the expected change
+    in `ledger_pending`; the items trigger journals only the remainder.
+    """
+    def __init__(self, conn, cache_size=32):
+        self.conn = conn
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    @staticmethod
+    def install(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS stock_snapshots (
+                snapshot_date TEXT NOT NULL,
+                item_type TEXT NOT NULL,
+                taken_at TEXT NOT NULL,
+                last_log_id INTEGER NOT NULL,
+                item_ids TEXT NOT NULL,
+                quantities BLOB NOT NULL,
+                PRIMARY KEY (snapshot_date, item_type)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_snapshots_type_taken ON stock_snapshots (item_type, taken_at)")
+        # Snapshots taken before the adjustment journal existed precede every adjustment
+        ensure_column(conn, "stock_snapshots", "last_adjustment_id", "INTEGER NOT NULL DEFAULT 0")
+        StockSnapshotStore.localize_usage_timestamps(conn)
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS stock_adjustments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id TEXT NOT NULL,
+                quantity_delta INTEGER NOT NULL,
+                adjusted_at TEXT NOT NULL DEFAULT {LOCAL_TIMESTAMP_SQL}
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_adjustments_item ON stock_adjustments (item_id, id)")
+        # Expected stock changes from ledger rows whose item update has not run yet
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ledger_pending (
+                item_id TEXT NOT NULL,
+                quantity_delta INTEGER NOT NULL
+            )
+        """)
+        conn.execute("DELETE FROM ledger_pending")
+        for trigger in ("trg_usage_log_ledger_pending", "trg_usage_log_return_pending", "trg_items_stock_adjustments"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute("""
+            CREATE TRIGGER trg_usage_log_ledger_pending AFTER INSERT ON usage_log
+            WHEN IFNULL(NEW.quantity_changed, 0) != 0
+            BEGIN
+                INSERT INTO ledger_pending (item_id, quantity_delta) VALUES (NEW.item_id, -NEW.quantity_changed);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER trg_usage_log_return_pending AFTER UPDATE OF return_time ON usage_log
+            WHEN OLD.return_time IS NULL AND NEW.return_time IS NOT NULL AND NEW.returnable = 1
+            BEGIN
+                INSERT INTO ledger_pending (item_id, quantity_delta) VALUES (NEW.item_id, NEW.quantity_changed);
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER trg_items_stock_adjustments AFTER UPDATE OF quantity ON items
+            BEGIN
+                INSERT INTO stock_adjustments (item_id, quantity_delta, adjusted_at)
+                SELECT NEW.id, delta, {LOCAL_TIMESTAMP_SQL}
+                FROM (SELECT IFNULL(NEW.quantity, 0) - IFNULL(OLD.quantity, 0)
+                             - IFNULL((SELECT SUM(quantity_delta) FROM ledger_pending WHERE item_id = NEW.id), 0)
+                             AS delta)
+                WHERE delta != 0;
+                DELETE FROM ledger_pending WHERE item_id = NEW.id;
+            END
+        """)
+
+    @staticmethod
+    def localize_usage_timestamps(conn):
+        """Move usage_log from SQLite's UTC CURRENT_TIMESTAMP default to local time.
+        
+        Snapshots, `quantity_at` and every Python-side writer use local time;
+        rows stamped by the old default (exactly 'YYYY-MM-DD HH:MM:SS') are
+        converted once, while the table is rebuilt with a local default.
+        """
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'usage_log'").fetchone()
+        if row is None or "CURRENT_TIMESTAMP" not in row[0].upper():
+            return
+        create_sql = re.sub(r"DEFAULT\s+CURRENT_TIMESTAMP", f"DEFAULT {LOCAL_TIMESTAMP_SQL}", row[0], flags=re.IGNORECASE)
+        columns = [
+            "CASE WHEN timestamp GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9]' "
+            "THEN strftime('%Y-%m-%dT%H:%M:%S', timestamp, 'localtime') ELSE timestamp END"
+            if name == "timestamp" else name
+            for _, name, *_ in conn.execute("PRAGMA table_info(usage_log)")]
+        rebuild_table(conn, "usage_log", create_sql, ", ".join(columns))
+
+    @staticmethod
+    def _pack(quantities):
+        packed = array.array('q', quantities)
+        if sys.byteorder != 'little':
+            packed.byteswap()
+        return packed.tobytes()
+
+    @staticmethod
+    def _unpack(blob):
+        packed = array.array('q')
+        packed.frombytes(blob)
+        if sys.byteorder != 'little':
+            packed.byteswap()
+        return packed
+
+    def take_snapshot(self, force=False):
+        """Write today's checkpoint for every item type; returns the number of types written"""
+        today = date.today().isoformat()
+        if not force and self.conn.execute(
+                "SELECT 1 FROM stock_snapshots WHERE snapshot_date = ?", (today,)).fetchone():
+            return 0
+        
+        taken_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        last_log_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM usage_log").fetchone()[0]
+        last_adjustment_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM stock_adjustments").fetchone()[0]
+        written = 0
+        for (item_type,) in self.conn.execute("SELECT DISTINCT item_type FROM items").fetchall():
+            rows = self.conn.execute(
+                "SELECT id, COALESCE(quantity, 0) FROM items WHERE item_type = ? ORDER BY id",
+                (item_type,)).fetchall()
+            self.conn.execute("""
+                INSERT OR REPLACE INTO stock_snapshots (
+                    snapshot_date, item_type, taken_at, last_log_id, item_ids, quantities, last_adjustment_id
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (today, item_type, taken_at, last_log_id,
+                  "\n".join(row[0] for row in rows), self._pack(row[1] for row in rows), last_adjustment_id))
+            written += 1
+        self.conn.commit()
+        self._cache.clear()
+        return written
+
+    def _decode(self, snapshot_date, item_type, item_ids, quantities):
+        key = (snapshot_date, item_type)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        decoded = (item_ids.split("\n") if item_ids else [], self._unpack(quantities))
+        self._cache[key] = decoded
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return decoded
+
+    def _snapshot_quantity(self, row, item_id):
+        snapshot_date, item_type, taken_at, last_log_id, item_ids, quantities, _ = row
+        ids, values = self._decode(snapshot_date, item_type, item_ids, quantities)
+        index = bisect.bisect_left(ids, item_id)
+        if index < len(ids) and ids[index] == item_id:
+            return values[index]
+        return None
+
+    def _returned(self, item_id, after, until=None):
+        """Quantity credited back by loans returned after `after` and up to `until`.
+        
+        Check-ins restore stock without writing a ledger row, so replays
+        add these on top of the usage_log sums.
+        """
+        return self.conn.execute("""
+            SELECT COALESCE(SUM(quantity_changed), 0) FROM usage_log
+            WHERE item_id = ? AND returnable = 1 AND return_time IS NOT NULL
+              AND datetime(return_time) > datetime(?)
+              AND (? IS NULL OR datetime(return_time) <= datetime(?))
+        """, (item_id, after, until, until)).fetchone()[0]
+
+    def _adjusted(self, item_id, after_id=0, upto_id=None, since=None, until=None):
+        """Net non-ledger stock change journalled with id in (`after_id`, `upto_id`]
+        and stamped in (`since`, `until`]; None leaves a bound open"""
+        return self.conn.execute("""
+            SELECT COALESCE(SUM(quantity_delta), 0) FROM stock_adjustments
+            WHERE item_id = ? AND id > ? AND id <= COALESCE(?, id)
+              AND (? IS NULL OR datetime(adjusted_at) > datetime(?))
+              AND (? IS NULL OR datetime(adjusted_at) <= datetime(?))
+        """, (item_id, after_id, upto_id, since, since, until, until)).fetchone()[0]
+
+    def quantity_at(self, item_id, when):
+        """Stock level of `item_id` at datetime `when`"""
+        row = self.conn.execute("SELECT item_type, COALESCE(quantity, 0) FROM items WHERE id = ?",
+                                (item_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"Item {item_id} not found")
+        item_type, current = row
+        when_text = when.strftime("%Y-%m-%d %H:%M:%S")
+        columns = "snapshot_date, item_type, taken_at, last_log_id, item_ids, quantities, last_adjustment_id"
+        
+        # Nearest checkpoint before `when`, replaying later usage forward
+        before = self.conn.execute(f"""
+            SELECT {columns} FROM stock_snapshots
+            WHERE item_type = ? AND taken_at <= ?
+            ORDER BY taken_at DESC LIMIT 1
+        """, (item_type, when_text)).fetchone()
+        if before is not None:
+            quantity = self._snapshot_quantity(before, item_id)
+            if quantity is not None:
+                used = self.conn.execute("""
+                    SELECT COALESCE(SUM(quantity_changed), 0) FROM usage_log
+                    WHERE item_id = ? AND id > ? AND datetime(timestamp) <= datetime(?)
+                """, (item_id, before[3], when_text)).fetchone()[0]
+                return (quantity - used + self._returned(item_id, before[2], when_text)
+                        + self._adjusted(item_id, after_id=before[6], until=when_text))
+        
+        # Otherwise the nearest checkpoint after `when` (or the live row), replaying backwards
+        after = self.conn.execute(f"""
+            SELECT {columns} FROM stock_snapshots
+            WHERE item_type = ? AND taken_at > ?
+            ORDER BY taken_at LIMIT 1
+        """, (item_type, when_text)).fetchone()
+        quantity = self._snapshot_quantity(after, item_id) if after is not None else None
+        if quantity is None:
+            quantity, upper_id, upper_time, upper_adjustment_id = current, None, None, None
+        else:
+            upper_id, upper_time, upper_adjustment_id = after[3], after[2], after[6]
+        used = self.conn.execute("""
+            SELECT COALESCE(SUM(quantity_changed), 0) FROM usage_log
+            WHERE item_id = ? AND id <= COALESCE(?, id) AND datetime(timestamp) > datetime(?)
+        """, (item_id, upper_id, when_text)).fetchone()[0]
+        return (quantity + used - self._returned(item_id, when_text, upper_time)
+                - self._adjusted(item_id, upto_id=upper_adjustment_id, since=when_text))
+
+    def trend(self, item_id, days=30):
+        """Daily end-of-day stock levels for the last `days` days"""
+        today = date.today()
+        series = []
+        for offset in range(days, -1, -1):
+            day = today - timedelta(days=offset)
+            series.append((day, self.quantity_at(item_id, datetime.combine(day, datetime.max.time()))))
+        return series
+
+# Equipment check-out/check-in tracking
+class LoanTracker:
+    """Open loans are usage_log rows with returnable = 1 and no return_time.
+    
+    A partial index covers exactly those rows, so outstanding-loan lookups
+    stay proportional to the number of open loans rather than the log size.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    @staticmethod
+    def install(conn):
+        ensure_column(conn, "usage_log", "returnable", "INTEGER NOT NULL DEFAULT 0")
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_log_open_loans
+            ON usage_log (item_id) WHERE return_time IS NULL AND returnable = 1
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_log_open_loans_user
+            ON usage_log (user, timestamp) WHERE return_time IS NULL AND returnable = 1
+        """)
+
+    def outstanding(self, user=None):
+        """Open loans, optionally for one user, oldest first"""
+        sql = """
+            SELECT u.id, u.item_id, i.name, u.user, u.user_department,
+                   u.quantity_changed, u.timestamp, u.purpose
+            FROM usage_log u
+            JOIN items i ON u.item_id = i.id
+            WHERE u.return_time IS NULL AND u.returnable = 1
+        """
+        if user:
+            return self.conn.execute(sql + " AND u.user = ? ORDER BY u.timestamp", (user,)).fetchall()
+        return self.conn.execute(sql + " ORDER BY u.timestamp").fetchall()
+
+    def check_in(self, log_ids, returned_at=None):
+        """Close open loans and restore their stock in one transaction; returns the number closed"""
+        returned_at = returned_at or datetime.now()
+        log_ids = [int(log_id) for log_id in log_ids]
+        if not log_ids:
+            return 0
+        if self.conn.in_transaction:
+            self.conn.commit()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            placeholders = ",".join("?" * len(log_ids))
+            open_loans = self.conn.execute(f"""
+                SELECT id, item_id, quantity_changed FROM usage_log
+                WHERE id IN ({placeholders}) AND return_time IS NULL AND returnable = 1
+            """, log_ids).fetchall()
+            self.conn.executemany(
+                "UPDATE usage_log SET return_time = ? WHERE id = ? AND return_time IS NULL",
+                [(returned_at, log_id) for log_id, _, _ in open_loans])
+            self.conn.executemany("""
+                UPDATE items
+                SET quantity = COALESCE(quantity, 0) + ?, last_updated = ?, version = version + 1
+                WHERE id = ?
+            """, [(quantity, returned_at, item_id) for _, item_id, quantity in open_loans])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return len(open_loans)
+
+# Server-side sorting, filtering and keyset paging for Treeviews
+class TreeviewPager:
+    """Drive a Treeview from SQL one page at a time.
+    
+    `columns` maps each Treeview heading to the SQL expression used for
+    display, sorting and filtering. Sorting is always on (expression, key)
+    so the last row of a page is a complete keyset cursor; the matching
+    expression indexes are created by `create_sort_indexes`.
+    """
+    def __init__(self, conn, tree, from_sql, columns, key, base_where=None, base_params=(),
+                 default_sort=None, page_size=200, row_transform=None):
+        # The SELECT list is built from `columns`, so checking the Treeview once covers every row
+        if tuple(tree["columns"]) != tuple(columns):
+            raise ValueError(f"Treeview columns {tuple(tree['columns'])} do not match "
+                             f"the pager columns {tuple(columns)}")
+        self.conn = conn
+        self.tree = tree
+        self.from_sql = from_sql
+        self.columns = columns
+        self.key = key
+        self.base_where = base_where
+        self.base_params = tuple(base_params)
+        self.sort_column = default_sort or next(iter(columns))
+        self.descending = False
+        self.filters = {}
+        self.search_term = ""
+        self.search_columns = ()
+        self.page_size = page_size
+        self.row_transform = row_transform
+        self.last_key = None
+        self.exhausted = False
+        self.loading = False
+
+    def sort_expression(self, heading):
+        return self.columns[heading]['sort']
+
+    def _filter_clauses(self):
+        clauses, params = [], []
+        if self.base_where:
+            clauses.append(self.base_where)
+            params.extend(self.base_params)
+        for heading, text in self.filters.items():
+            clauses.append(f"LOWER(CAST({self.columns[heading]['sort']} AS TEXT)) LIKE ?")
+            params.append(f"%{text.lower()}%")
+        if self.search_term and self.search_columns:
+            clauses.append("(" + " OR ".join(
+                f"LOWER(COALESCE({self.columns[h]['expr']}, '')) LIKE ?" for h in self.search_columns) + ")")
+            params.extend([f"%{self.search_term}%"] * len(self.search_columns))
+        return clauses, params
+
+    def _query(self):
+        sort = self.sort_expression(self.sort_column)
+        clauses, params = self._filter_clauses()
+        if self.last_key is not None:
+            # The single-column bound lets SQLite seek the expression index;
+            # the row-value comparison then skips ties already shown
+            clauses.append(f"{sort} {'<=' if self.descending else '>='} ?")
+            clauses.append(f"({sort}, {self.key}) {'<' if self.descending else '>'} (?, ?)")
+            params.append(self.last_key[0])
+            params.extend(self.last_key)
+        
+        direction = "DESC" if self.descending else "ASC"
+        select = ", ".join(column['expr'] for column in self.columns.values())
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"""
+            SELECT {select}, {sort}, {self.key}
+            {self.from_sql}
+            {where}
+            ORDER BY {sort} {direction}, {self.key} {direction}
+            LIMIT ?
+        """
+        return sql, params + [self.page_size]
+
+    def reload(self):
+        """Clear the Treeview and load the first page"""
+        children = self.tree.get_children()
+        if children:
+            self.tree.delete(*children)
+        self.last_key = None
+        self.exhausted = False
+        self.load_next_page()
+        self.update_headings()
+
+    def load_next_page(self):
+        if self.exhausted or self.loading:
+            return
+        self.loading = True
+        try:
+            sql, params = self._query()
+            rows = self.conn.execute(sql, params).fetchall()
+            for row in rows:
+                values = row[:-2]
+                if self.row_transform is not None:
+                    values = self.row_transform(values)
+                self.tree.insert("", "end", iid=str(row[-1]), values=values)
+            if rows:
+                self.last_key = (rows[-1][-2], rows[-1][-1])
+            self.exhausted = len(rows) < self.page_size
+        finally:
+            self.loading = False
+
+    def refresh_rows(self, keys):
+        """Re-read just these rows in place, dropping any that no longer match the filters.
+        
+        Rows keep their position until the next full reload.
+        """
+        keys = [k for k in keys if self.tree.exists(str(k))]
+        select = ", ".join(column['expr'] for column in self.columns.values())
+        clauses, params = self._filter_clauses()
+        where = " AND ".join(clauses + [f"{self.key} = ?"])
+        statement = f"SELECT {select} {self.from_sql} WHERE {where}"
+        for key in keys:
+            row = self.conn.execute(statement, params + [key]).fetchone()
+            if row is None:
+                self.tree.delete(str(key))
+                continue
+            values = self.row_transform(row) if self.row_transform is not None else row
+            self.tree.item(str(key), values=values)
+
+    def remove_rows(self, keys):
+        """Drop rows from the Treeview without reloading"""
+        existing = [str(k) for k in keys if self.tree.exists(str(k))]
+        if existing:
+            self.tree.delete(*existing)
+
+    def on_scroll(self, scrollbar):
+        """yscrollcommand wrapper that fetches the next page near the bottom"""
+        def handler(first, last):
+            scrollbar.set(first, last)
+            if float(last) > 0.9 and not self.exhausted:
+                self.tree.after_idle(self.load_next_page)
+        return handler
+
+    def toggle_sort(self, heading):
+        if self.sort_column == heading:
+            self.descending = not self.descending
+        else:
+            self.sort_column, self.descending = heading, False
+        self.reload()
+
+    def set_filter(self, heading, text):
+        text = (text or "").strip()
+        if text:
+            self.filters[heading] = text
+        else:
+            self.filters.pop(heading, None)
+        self.reload()
+
+    def set_search(self, term, columns):
+        self.search_term = (term or "").lower().strip()
+        self.search_columns = columns
+        self.reload()
+
+    def update_headings(self):
+        for heading in self.columns:
+            text = heading
+            if heading == self.sort_column:
+                text += " ▼" if self.descending else " ▲"
+            if heading in self.filters:
+                text += f" [{self.filters[heading]}]"
+            self.tree.heading(heading, text=text)
+
+    def bind_headings(self, parent):
+        """Click a heading to sort; right-click it to filter"""
+        for heading in self.columns:
+            self.tree.heading(heading, command=lambda h=heading: self.toggle_sort(h))
+        
+        def prompt_filter(event):
+            if self.tree.identify_region(event.x, event.y) != "heading":
+                return
+            index = int(self.tree.identify_column(event.x).lstrip("#")) - 1
+            heading = self.tree["columns"][index]
+            text = simpledialog.askstring(
+                "Filter 筛选", f"Show rows where {heading} contains 包含:\n(leave empty to clear 留空清除)",
+                initialvalue=self.filters.get(heading, ""), parent=parent)
+            if text is not None:
+                self.set_filter(heading, text)
+        
+        self.tree.bind("<Button-3>", prompt_filter)
+
+    @staticmethod
+    def create_sort_indexes(conn):
+        """Expression indexes matching the sort keys used by the Treeviews"""
+        for heading, column in INVENTORY_COLUMNS.items():
+            if column['expr'] == "id":
+                continue
+            conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS idx_items_sort_{column['expr']}
+                ON items (item_type, {column['sort']}, id)
+            """)
+        for name, expression in (("user", "IFNULL(user, '')"),
+                                 ("department", "IFNULL(user_department, '')"),
+                                 ("quantity", "IFNULL(quantity_changed, 0)"),
+                                 ("timestamp", "IFNULL(timestamp, '')"),
+                                 ("purpose", "IFNULL(purpose, '')")):
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_usage_log_sort_{name} ON usage_log ({expression}, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_items_name ON items (IFNULL(name, ''), id)")
+
+# Columnar usage analytics backed by pandas
+class UsageAnalytics:
+    """Cache usage_log joined with items as a pandas frame.
+    
+    The frame is read with chunked `read_sql` and grown incrementally from
+    the highest usage_log id already loaded, so redrawing the dashboard only
+    touches rows added since the last refresh. Low-cardinality text columns
+    are stored as categoricals.
+    """
+    CATEGORICAL_COLUMNS = ("user", "user_department", "item_type", "item_id", "name")
+    
+    def __init__(self, conn, chunksize=50000):
+        self.conn = conn
+        self.chunksize = chunksize
+        self.frame = None
+        self.max_id = 0
+
+    def refresh(self):
+        """Append usage rows newer than the cached max id; returns the number added"""
+        import pandas as pd
+        
+        chunks = pd.read_sql_query("""
+            SELECT u.id, u.item_id, i.name, i.item_type, u.user, u.user_department,
+                   u.quantity_changed, u.timestamp
+            FROM usage_log u
+            JOIN items i ON u.item_id = i.id
+            WHERE u.id > ?
+            ORDER BY u.id
+        """, self.conn, params=(self.max_id,), chunksize=self.chunksize)
+        
+        new_frames = []
+        for chunk in chunks:
+            if chunk.empty:
+                # read_sql yields one empty chunk when nothing is newer than max_id
+                continue
+            # Stored timestamps mix 'T'/' ' separators and optional fractions
+            timestamps = chunk["timestamp"].astype(str).str.replace("T", " ", regex=False).str.slice(0, 19)
+            chunk["timestamp"] = pd.to_datetime(timestamps, format="%Y-%m-%d %H:%M:%S", errors="coerce")
+            chunk["quantity_changed"] = chunk["quantity_changed"].fillna(0).astype("int64")
+            chunk["user_department"] = chunk["user_department"].fillna("").replace("", "(none)")
+            new_frames.append(chunk)
+        if not new_frames:
+            return 0
+        
+        frames = new_frames if self.frame is None else [self.frame] + new_frames
+        # Union the categories so concat keeps categorical dtypes instead of falling back to object
+        for column in self.CATEGORICAL_COLUMNS:
+            seen = []
+            for frame in frames:
+                values = frame[column]
+                seen.extend(values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype)
+                            else values.dropna().unique())
+            categories = pd.Index(seen, dtype=object).unique()
+            for frame in frames:
+                frame[column] = pd.Categorical(frame[column], categories=categories)
+        self.frame = pd.concat(frames, ignore_index=True)
+        if len(self.frame):
+            self.max_id = int(self.frame["id"].max())
+        return sum(len(frame) for frame in new_frames)
+
+    def consumption_by_department(self):
+        """Total quantity consumed per department"""
+        consumed = self.frame[self.frame["quantity_changed"] > 0]
+        return (consumed.groupby("user_department", observed=True)["quantity_changed"]
+                .sum().sort_values(ascending=False))
+
+    def top_items(self, n=10):
+        """Most consumed items by total quantity"""
+        consumed = self.frame[self.frame["quantity_changed"] > 0]
+        return (consumed.groupby(["item_id", "name"], observed=True)["quantity_changed"]
+                .sum().nlargest(n))
+
+    def weekly_trend(self, by="item_type"):
+        """Quantity consumed per week, one column per `by` value"""
+        consumed = self.frame[(self.frame["quantity_changed"] > 0) & self.frame["timestamp"].notna()]
+        week = consumed["timestamp"].dt.to_period("W").dt.start_time
+        return (consumed.groupby([week, by], observed=True)["quantity_changed"]
+                .sum().unstack(fill_value=0))
+
+# Memory-bounded execution for full-catalog operations
+class MemoryBudget:
+    """Size fetch batches from a memory budget and report peak RSS.
+    
+    Large operations read rows through `iter_rows` in batches of
+    `batch_rows`, so only one batch is held in Python at a time.
+    """
+    BYTES_PER_BUFFERED_ROW = 25 * 1024
+    
+    def __init__(self, budget_mb=256):
+        self.budget_mb = budget_mb
+        self.last_report = None
+
+    @property
+    def batch_rows(self):
+        return max(100, min(20000, int(self.budget_mb * 1024 * 1024 // self.BYTES_PER_BUFFERED_ROW)))
+
+    def iter_rows(self, conn, sql, params=(), row_factory=None):
+        """Yield rows of `sql` without materializing the result set"""
+        cursor = conn.cursor()
+        if row_factory is not None:
+            cursor.row_factory = row_factory
+        cursor.execute(sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(self.batch_rows)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def peak_rss_mb():
+        """Peak resident set size of this process in MB, or None if unavailable"""
+        try:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # ru_maxrss is KB on Linux and bytes on macOS
+            return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+        except ImportError:
+            pass
+        try:
+            import ctypes
+            from ctypes import wintypes
+            
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                            ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                            ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+            
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                return counters.PeakWorkingSetSize / (1024 * 1024)
+        except (AttributeError, OSError):
+            pass
+        return None
+
+    @contextlib.contextmanager
+    def track(self, label):
+        """Record wall time and peak RSS for an operation in `last_report`"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            peak = self.peak_rss_mb()
+            self.last_report = {
+                'label': label,
+                'seconds': time.perf_counter() - started,
+                'peak_rss_mb': peak,
+                'over_budget': peak is not None and peak > self.budget_mb
+            }
+
+    def describe(self):
+        report = self.last_report
+        if report is None:
+            return ""
+        peak = "n/a" if report['peak_rss_mb'] is None else f"{report['peak_rss_mb']:.1f} MB"
+        warning = " - over budget 超出内存预算" if report['over_budget'] else ""
+        return (f"{report['label']}: {report['seconds']:.1f}s, peak RSS {peak} "
+                f"(budget {self.budget_mb} MB){warning}")
+
+class FlowableStream(list):
+    """List facade over a flowable generator for SimpleDocTemplate.build.
+    
+    reportlab consumes flowables from the front of the list, so keeping only
+    a small window filled from the generator bounds the number of tables
+    and paragraphs alive at once.
+    """
+    def __init__(self, source, window=8):
+        super().__init__()
+        self._source = iter(source)
+        self._window = window
+
+    def _fill(self):
+        while list.__len__(self) < self._window:
+            try:
+                list.append(self, next(self._source))
+            except StopIteration:
+                break
+
+    def __len__(self):
+        self._fill()
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        self._fill()
+        return list.__getitem__(self, index)
+
+# Optimistic concurrency for item edits
+class ItemVersionConflict(Exception):
+    """Raised when another workstation changed the same fields since the dialog opened"""
+    def __init__(self, current, version, changes, conflicts):
+        super().__init__(f"{len(conflicts)} field(s) were changed by someone else")
+        self.current = current
+        self.version = version
+        self.changes = changes
+        self.conflicts = conflicts
+
+class ItemEditor:
+    """Write only the fields a user changed, guarded by items.version.
+    
+    Every writer that touches an item row bumps `version`. An edit is
+    applied with `WHERE version = ?`; if that misses, the fresh row is
+    compared with the one the dialog started from. Edits to disjoint
+    fields are merged automatically, overlapping ones raise
+    ItemVersionConflict for the user to resolve.
+    """
+    EDITABLE_FIELDS = ("name", "name_cn", "category", "location", "quantity", "unit",
+                       "manufacturer", "model_number", "serial_number", "purchase_date",
+                       "warranty_until", "maintenance_contact", "last_calibration",
+                       "next_calibration", "safety_classification", "notes", "expiry_date")
+    
+    def __init__(self, conn):
+        self.conn = conn
+
+    @staticmethod
+    def install(conn):
+        ensure_column(conn, "items", "version", "INTEGER NOT NULL DEFAULT 1")
+
+    @staticmethod
+    def _normalize(value):
+        return "" if value is None else value
+
+    def load(self, item_id):
+        """Return ({field: value}, version) for an item, or (None, None) if missing"""
+        row = self.conn.execute(
+            f"SELECT {', '.join(self.EDITABLE_FIELDS)}, version FROM items WHERE id = ? AND deleted_at IS NULL",
+            (item_id,)).fetchone()
+        if row is None:
+            return None, None
+        return {f: self._normalize(v) for f, v in zip(self.EDITABLE_FIELDS, row)}, row[-1]
+
+    def save(self, item_id, original, changes, version):
+        """Apply the fields in `changes` that differ from `original`; returns (new_version, written fields)"""
+        dirty = {f: v for f, v in changes.items() if v != original.get(f)}
+        if not dirty:
+            return version, {}
+        
+        while True:
+            assignments = ", ".join(f"{field} = ?" for field in dirty)
+            cursor = self.conn.execute(f"""
+                UPDATE items
+                SET {assignments}, last_updated = ?, version = version + 1
+                WHERE id = ? AND version = ? AND deleted_at IS NULL
+            """, list(dirty.values()) + [datetime.now(), item_id, version])
+            if cursor.rowcount == 1:
+                self.conn.commit()
+                return version + 1, dirty
+            
+            current, current_version = self.load(item_id)
+            if current is None:
+                raise ValueError("Item was deleted by another user")
+            conflicts = {f: (value, current[f]) for f, value in dirty.items()
+                         if current[f] != original.get(f) and current[f] != value}
+            if conflicts:
+                raise ItemVersionConflict(current, current_version, dirty, conflicts)
+            # Someone else changed other fields only: keep theirs and retry ours on top
+            version = current_version
+
+# Content-addressed attachment store
+class AttachmentStore:
+    """Manuals, certificates and SDS sheets linked to items.
+    
+    File contents live once under blobs/<aa>/<bb>/<sha256>, however many
+    items reference them. Files are hashed while being copied in fixed-size
+    chunks, so large PDFs are never held in memory. `item_attachments`
+    links blobs to items; blobs nobody links to are removed by
+    `collect_garbage`.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    
+    def __init__(self, conn, root):
+        self.conn = conn
+        self.root = Path(root)
+        self.staging = self.root / "staging"
+        self.staging.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def install(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS item_attachments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                kind TEXT,
+                added_at TEXT NOT NULL,
+                UNIQUE (item_id, sha256, filename),
+                FOREIGN KEY (item_id) REFERENCES items (id) ON DELETE CASCADE,
+                FOREIGN KEY (sha256) REFERENCES blobs (sha256)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_item_attachments_item ON item_attachments (item_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_item_attachments_sha256 ON item_attachments (sha256)")
+
+    def blob_path(self, digest):
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def store_file(self, source_path):
+        """Copy a file into the store, returning (sha256, size, already_stored)"""
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, staging_path = tempfile.mkstemp(dir=self.staging)
+        try:
+            with open(source_path, 'rb') as source, os.fdopen(fd, 'wb') as staged:
+                while True:
+                    chunk = source.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    staged.write(chunk)
+                    size += len(chunk)
+            
+            digest = sha256.hexdigest()
+            target = self.blob_path(digest)
+            if target.exists():
+                return digest, size, True
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(staging_path, target)
+            return digest, size, False
+        finally:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+
+    def attach(self, item_id, source_path, kind=None):
+        """Link a file to an item; returns (attachment_id, sha256, already_stored)"""
+        digest, size, already_stored = self.store_file(source_path)
+        now = datetime.now().isoformat()
+        try:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, size, created_at) VALUES (?, ?, ?)",
+                (digest, size, now))
+            self.conn.execute("""
+                INSERT OR IGNORE INTO item_attachments (item_id, sha256, filename, kind, added_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (item_id, digest, Path(source_path).name, kind, now))
+            attachment_id = self.conn.execute(
+                "SELECT id FROM item_attachments WHERE item_id = ? AND sha256 = ? AND filename = ?",
+                (item_id, digest, Path(source_path).name)).fetchone()[0]
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return attachment_id, digest, already_stored
+
+    def list_attachments(self, item_id):
+        """(id, filename, kind, size, added_at, sha256) rows for one item"""
+        return self.conn.execute("""
+            SELECT a.id, a.filename, a.kind, b.size, a.added_at, a.sha256
+            FROM item_attachments a JOIN blobs b ON b.sha256 = a.sha256
+            WHERE a.item_id = ?
+            ORDER BY a.added_at, a.id
+        """, (item_id,)).fetchall()
+
+    def export(self, attachment_id, destination):
+        """Stream an attachment's contents to `destination`"""
+        row = self.conn.execute(
+            "SELECT sha256 FROM item_attachments WHERE id = ?", (attachment_id,)).fetchone()
+        if row is None:
+            raise ValueError("Attachment not found")
+        with open(self.blob_path(row[0]), 'rb') as source, open(destination, 'wb') as target:
+            shutil.copyfileobj(source, target, self.CHUNK_SIZE)
+
+    def detach(self, attachment_ids):
+        """Unlink attachments from their items; the blobs stay until garbage collection"""
+        try:
+            self.conn.executemany(
+                "DELETE FROM item_attachments WHERE id = ?", [(i,) for i in attachment_ids])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def collect_garbage(self, scan_disk=False):
+        """Delete blobs no item links to; returns (files removed, bytes freed).
+        
+        With `scan_disk`, files on disk without a blobs row (e.g. left by an
+        interrupted import) are removed too.
+        """
+        orphans = self.conn.execute("""
+            SELECT sha256, size FROM blobs b
+            WHERE NOT EXISTS (SELECT 1 FROM item_attachments a WHERE a.sha256 = b.sha256)
+        """).fetchall()
+        try:
+            self.conn.executemany("DELETE FROM blobs WHERE sha256 = ?", [(d,) for d, _ in orphans])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        
+        removed, freed = 0, 0
+        for digest, size in orphans:
+            path = self.blob_path(digest)
+            if path.exists():
+                path.unlink()
+                removed += 1
+                freed += size
+        
+        if scan_disk:
+            known = {row[0] for row in self.conn.execute("SELECT sha256 FROM blobs")}
+            for path in self.root.glob("??/??/*"):
+                if path.name not in known:
+                    freed += path.stat().st_size
+                    path.unlink()
+                    removed += 1
+            for path in self.staging.iterdir():
+                path.unlink()
+        return removed, freed
+
+# Two-level (memory + disk) LRU cache of rendered preview thumbnails
+class ThumbnailCache:
+    """Preview images keyed by item id and the row's change stamp.
+    
+    The stamp is built from `last_updated` and `version`, so any edit
+    produces a new key and the stale entry simply ages out. Hits come from
+    an in-memory LRU first, then from PNGs on disk; only misses call the
+    renderer for that kind of preview.
+    """
+    def __init__(self, root, renderers, memory_items=64, disk_items=2000):
+        self.root = Path(root)
+        self.renderers = renderers
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self._memory = collections.OrderedDict()
+        self._disk_writes = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _safe(item_id):
+        return re.sub(r'[^A-Za-z0-9_-]', '_', str(item_id))
+
+    def _path(self, kind, item_id, stamp):
+        digest = hashlib.sha1(str(stamp).encode()).hexdigest()[:12]
+        return self.root / kind / f"{self._safe(item_id)}_{digest}.png"
+
+    def get(self, kind, item_id, stamp, item=None):
+        """Return the preview image, rendering it from `item` on a miss"""
+        key = (kind, item_id, stamp)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        
+        path = self._path(kind, item_id, stamp)
+        if path.exists():
+            with Image.open(path) as stored:
+                image = stored.copy()
+            os.utime(path)
+        else:
+            image = self.renderers[kind](item)
+            self._store(kind, item_id, path, image)
+        
+        self._memory[key] = image
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+        return image
+
+    def _store(self, kind, item_id, path, image):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Older renders of the same item are stale once its stamp changes
+        for stale in path.parent.glob(f"{self._safe(item_id)}_*.png"):
+            stale.unlink()
+        image.save(path)
+        self._disk_writes += 1
+        if self._disk_writes % 100 == 0:
+            self.prune()
+
+    def discard(self, item_id):
+        """Forget every preview of an item (e.g. after it is deleted)"""
+        for key in [k for k in self._memory if k[1] == item_id]:
+            del self._memory[key]
+        for stale in self.root.glob(f"*/{self._safe(item_id)}_*.png"):
+            stale.unlink()
+
+    def prune(self):
+        """Keep only the `disk_items` most recently used files on disk"""
+        files = sorted(self.root.glob("*/*.png"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for path in files[self.disk_items:]:
+            path.unlink()
+
+# Multi-item edits and deletes with undo
+class BulkItemOperations:
+    """Apply one change to many selected items in a single transaction.
+    
+    The item audit trail tags the entries each operation writes with its
+    id, and `undo` reverts those entries. Deletes are soft (they set
+    `deleted_at`), so undoing one clears that stamp again.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    @staticmethod
+    def install(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS bulk_operations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                op TEXT NOT NULL,
+                field TEXT,
+                value TEXT,
+                item_count INTEGER NOT NULL,
+                performed_at TEXT NOT NULL,
+                undone_at TEXT
+            )
+        """)
+        # Older databases kept their own before-images; tag the audit entries those operations wrote instead
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bulk_before_images'").fetchone():
+            images = conn.execute("""
+                SELECT b.operation_id, b.item_id, o.field, o.performed_at
+                FROM bulk_before_images b JOIN bulk_operations o ON o.id = b.operation_id
+                ORDER BY b.operation_id
+            """).fetchall()
+            # The first entry for the field at or after the operation is the one it wrote
+            conn.executemany("""
+                UPDATE item_audit SET operation_id = ?
+                WHERE id = (SELECT id FROM item_audit
+                            WHERE item_id = ? AND operation_id IS NULL AND changed_at >= substr(?, 1, 23)
+                              AND json_type(changes, '$.' || ?) IS NOT NULL
+                            ORDER BY changed_at, id LIMIT 1)
+            """, [(operation_id, item_id, performed_at, field)
+                  for operation_id, item_id, field, performed_at in images])
+            conn.execute("DROP TABLE bulk_before_images")
+
+    def _begin(self, op, field, value, item_ids):
+        cursor = self.conn.execute("""
+            INSERT INTO bulk_operations (op, field, value, item_count, performed_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (op, field, None if value is None else str(value), len(item_ids), datetime.now().isoformat()))
+        ItemAuditTrail(self.conn).tag_operation(cursor.lastrowid)
+        return cursor.lastrowid
+
+    def update(self, item_ids, field, value):
+        """Set `field` to `value` on every item; returns the operation id"""
+        if field not in ItemEditor.EDITABLE_FIELDS:
+            raise ValueError(f"Field {field} cannot be bulk edited")
+        item_ids = list(dict.fromkeys(item_ids))
+        if field in ("quantity", "expiry_date") and any(LotTracker(self.conn).is_tracked(i) for i in item_ids):
+            raise ValueError(f"The {field} of lot-tracked items follows their lots")
+        try:
+            operation_id = self._begin("update", field, value, item_ids)
+            now = datetime.now().isoformat()
+            self.conn.executemany(f"""
+                UPDATE items SET {field} = ?, last_updated = ?, version = version + 1
+                WHERE id = ? AND deleted_at IS NULL
+            """, [(value, now, item_id) for item_id in item_ids])
+            ItemAuditTrail(self.conn).tag_operation(None)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return operation_id
+
+    def delete(self, item_ids):
+        """Soft-delete every item, keeping its usage history; returns the operation id"""
+        item_ids = list(dict.fromkeys(item_ids))
+        try:
+            now = datetime.now().isoformat()
+            operation_id = self._begin("delete", "deleted_at", now, item_ids)
+            self.conn.executemany("""
+                UPDATE items SET deleted_at = ?, version = version + 1
+                WHERE id = ? AND deleted_at IS NULL
+            """, [(now, item_id) for item_id in item_ids])
+            ItemAuditTrail(self.conn).tag_operation(None)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return operation_id
+
+    def undo(self, operation_id):
+        """Reverse an operation; returns the item ids it touched.
+        
+        Fields are only restored on items that still hold the value the
+        operation wrote, so later edits by other users are kept.
+        """
+        operation = self.conn.execute(
+            "SELECT undone_at FROM bulk_operations WHERE id = ?", (operation_id,)).fetchone()
+        if operation is None:
+            raise ValueError("Bulk operation not found")
+        if operation[0]:
+            raise ValueError("This operation has already been undone")
+        
+        entries = ItemAuditTrail(self.conn).operation_changes(operation_id)
+        if not entries:
+            raise ValueError("No audit entries were recorded for this operation 此操作没有审计记录")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(items)")}
+        try:
+            now = datetime.now().isoformat()
+            # Newest first, so an item touched twice ends at its original value
+            for item_id, _, changes in reversed(entries):
+                for field, (old, new) in changes.items():
+                    if field in columns:
+                        self.conn.execute(f"""
+                            UPDATE items SET {field} = ?, last_updated = ?, version = version + 1
+                            WHERE id = ? AND {field} IS ?
+                        """, (old, now, item_id, new))
+            self.conn.execute("UPDATE bulk_operations SET undone_at = ? WHERE id = ?", (now, operation_id))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return list(dict.fromkeys(item_id for item_id, _, _ in entries))
+
+    def recent(self, limit=50):
+        """Latest operations, newest first"""
+        return self.conn.execute("""
+            SELECT id, op, field, value, item_count, performed_at, undone_at
+            FROM bulk_operations ORDER BY id DESC LIMIT ?
+        """, (limit,)).fetchall()
+
+# Append-only field-level audit trail for items
+class ItemAuditTrail:
+    """Trigger-maintained history of every change to `items`.
+    
+    Each row of `item_audit` holds only the fields that changed, as
+    {field: [old, new]} (inserts and purges store the non-null values).
+    `state_at` rebuilds an item at any moment by replaying the diffs
+    forward from creation or backward from the live row, whichever side
+    of the requested time has fewer entries. Items are soft-deleted via
+    `deleted_at`, so their usage history is never cascaded away.
+    
+    While `audit_operation` holds an operation id (see `tag_operation`),
+    every entry written is tagged with it, so a bulk operation can be
+    reverted from its own entries.
+    """
+    SKIPPED_FIELDS = ('id', 'version', 'last_updated', 'location_id')
+    
+    def __init__(self, conn):
+        self.conn = conn
+
+    @staticmethod
+    def rebuild_usage_log(conn):
+        """Recreate usage_log without ON DELETE CASCADE, keeping ids, indexes and triggers"""
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'usage_log'").fetchone()
+        if row is None or "ON DELETE CASCADE" not in row[0].upper():
+            return
+        
+        rebuild_table(conn, "usage_log", re.sub(r'ON DELETE CASCADE', '', row[0], flags=re.IGNORECASE))
+
+    @classmethod
+    def install(cls, conn):
+        """Create the audit table and (re)create its triggers for the current item columns"""
+        ensure_column(conn, "items", "deleted_at", "TEXT")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS item_audit (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id TEXT NOT NULL,
+                changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')),
+                op TEXT NOT NULL,
+                changes TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_item_audit_item_time ON item_audit (item_id, changed_at, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_item_audit_time ON item_audit (changed_at)")
+        ensure_column(conn, "item_audit", "operation_id", "INTEGER")
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_item_audit_operation ON item_audit (operation_id)
+            WHERE operation_id IS NOT NULL
+        """)
+        # At most one row: the operation the current transaction's entries belong to
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS audit_operation (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                operation_id INTEGER NOT NULL
+            )
+        """)
+        conn.execute("DELETE FROM audit_operation")
+        operation = "(SELECT operation_id FROM audit_operation)"
+        
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(items)") if row[1] not in cls.SKIPPED_FIELDS]
+        
+        def values_json(alias):
+            # json_patch onto an empty object drops the null members
+            return "json_patch('{}', json_object(" + ", ".join(f"'{c}', {alias}.{c}" for c in columns) + "))"
+        
+        diff_json = "json_patch('{}', json_object(" + ", ".join(
+            f"'{c}', CASE WHEN OLD.{c} IS NOT NEW.{c} THEN json_array(OLD.{c}, NEW.{c}) END" for c in columns) + "))"
+        changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in columns)
+        
+        for op in ("insert", "update", "delete"):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_audit_items_{op}")
+        conn.execute(f"""
+            CREATE TRIGGER trg_audit_items_insert AFTER INSERT ON items
+            BEGIN
+                INSERT INTO item_audit (item_id, op, changes, operation_id)
+                VALUES (NEW.id, 'INSERT', {values_json('NEW')}, {operation});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER trg_audit_items_update AFTER UPDATE ON items
+            WHEN {changed}
+            BEGIN
+                INSERT INTO item_audit (item_id, op, changes, operation_id) VALUES (
+                    NEW.id,
+                    CASE WHEN OLD.deleted_at IS NULL AND NEW.deleted_at IS NOT NULL THEN 'DELETE'
+                         WHEN OLD.deleted_at IS NOT NULL AND NEW.deleted_at IS NULL THEN 'RESTORE'
+                         ELSE 'UPDATE' END,
+                    {diff_json},
+                    {operation});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER trg_audit_items_delete AFTER DELETE ON items
+            BEGIN
+                INSERT INTO item_audit (item_id, op, changes, operation_id)
+                VALUES (OLD.id, 'PURGE', {values_json('OLD')}, {operation});
+            END
+        """)
+        
+        # Items that predate the audit trail start from their current values
+        conn.execute(f"""
+            INSERT INTO item_audit (item_id, changed_at, op, changes)
+            SELECT id, COALESCE(REPLACE(CAST(last_updated AS TEXT), ' ', 'T'),
+                                strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')),
+                   'INSERT', {values_json('items')}
+            FROM items
+            WHERE NOT EXISTS (SELECT 1 FROM item_audit a WHERE a.item_id = items.id)
+        """)
+
+    def tag_operation(self, operation_id):
+        """Tag entries written from now on with `operation_id`; None stops tagging.
+        
+        Call both inside the operation's transaction, so a rollback clears the tag too.
+        """
+        if operation_id is None:
+            self.conn.execute("DELETE FROM audit_operation")
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO audit_operation (id, operation_id) VALUES (1, ?)",
+                              (operation_id,))
+
+    def operation_changes(self, operation_id):
+        """(item_id, op, {field: [old, new]}) entries tagged with `operation_id`, oldest first"""
+        rows = self.conn.execute("""
+            SELECT item_id, op, changes FROM item_audit
+            WHERE operation_id = ?
+            ORDER BY id
+        """, (operation_id,)).fetchall()
+        return [(item_id, op, json.loads(changes)) for item_id, op, changes in rows]
+
+    def history(self, item_id, limit=500):
+        """(changed_at, op, {field: [old, new]}) entries, newest first"""
+        rows = self.conn.execute("""
+            SELECT changed_at, op, changes FROM item_audit
+            WHERE item_id = ?
+            ORDER BY changed_at DESC, id DESC
+            LIMIT ?
+        """, (item_id, limit)).fetchall()
+        return [(changed_at, op, json.loads(changes)) for changed_at, op, changes in rows]
+
+    def state_at(self, item_id, when):
+        """The item's fields as of `when` (ISO date or datetime), or None if it did not exist"""
+        if isinstance(when, (datetime, date)):
+            when = when.isoformat()
+        if len(when) == 10:
+            # A bare date means the end of that day
+            when += "T23:59:59.999"
+        
+        before, after = self.conn.execute("""
+            SELECT SUM(changed_at <= ?), SUM(changed_at > ?) FROM item_audit WHERE item_id = ?
+        """, (when, when, item_id)).fetchone()
+        if not before:
+            return None
+        
+        if before <= after:
+            state = None
+            for op, changes in self.conn.execute("""
+                SELECT op, changes FROM item_audit
+                WHERE item_id = ? AND changed_at <= ?
+                ORDER BY changed_at, id
+            """, (item_id, when)):
+                changes = json.loads(changes)
+                if op == 'INSERT':
+                    state = changes
+                elif op == 'PURGE':
+                    state = None
+                elif state is not None:
+                    for field, (_, new) in changes.items():
+                        if new is None:
+                            state.pop(field, None)
+                        else:
+                            state[field] = new
+            return state
+        
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(items)")
+                   if row[1] not in self.SKIPPED_FIELDS]
+        row = self.conn.execute(f"SELECT {', '.join(columns)} FROM items WHERE id = ?", (item_id,)).fetchone()
+        state = {c: v for c, v in zip(columns, row) if v is not None} if row else None
+        for op, changes in self.conn.execute("""
+            SELECT op, changes FROM item_audit
+            WHERE item_id = ? AND changed_at > ?
+            ORDER BY changed_at DESC, id DESC
+        """, (item_id, when)):
+            changes = json.loads(changes)
+            if op == 'INSERT':
+                state = None
+            elif op == 'PURGE':
+                state = changes
+            elif state is not None:
+                for field, (old, _) in changes.items():
+                    if old is None:
+                        state.pop(field, None)
+                    else:
+                        state[field] = old
+        return state
+
+# Runtime language selection for the bilingual UI strings
+class MessageCatalog:
+    """Split the UI's "English 中文" strings into per-language variants.
+    
+    Every label in the interface is written bilingually. Each distinct
+    string is split once into its English and Chinese halves (per line,
+    keeping shared suffixes such as " *" or " (YYYY-MM-DD)") and the result
+    is cached, so switching language only re-reads the cache. `OVERRIDES`
+    holds strings whose halves do not split cleanly.
+    """
+    LANGUAGES = {"both": "English + 中文", "en": "English", "zh": "中文"}
+    CJK = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+    SUFFIX = re.compile(r'(\s*(?:\*|:|\uff1a|\([^()\u3400-\u9fff]*\)))+$')
+    OVERRIDES = {
+        "AI Predict Inventory Needs AI预测库存需求": ("AI Predict Inventory Needs", "AI预测库存需求"),
+        "Kind (manual, certificate, SDS...) 类型:": ("Kind (manual, certificate, SDS...):", "类型:"),
+        # Language names are always shown as themselves
+        "English + 中文": ("English + 中文", "English + 中文"),
+        "中文": ("中文", "中文"),
+    }
+    
+    def __init__(self, language="both"):
+        self.language = language if language in self.LANGUAGES else "both"
+        self._compiled = dict(self.OVERRIDES)
+
+    def _split_line(self, line):
+        match = self.CJK.search(line)
+        if match is None:
+            return line, None
+        english = line[:match.start()]
+        if not re.search(r'[A-Za-z]', english):
+            return None, line
+        suffix_match = self.SUFFIX.search(line)
+        suffix = suffix_match.group(0) if suffix_match and suffix_match.start() > match.start() else ""
+        chinese = line[match.start():len(line) - len(suffix)]
+        return english.rstrip() + suffix, chinese.strip() + suffix
+
+    def compile(self, text):
+        """(english, chinese) halves of a bilingual string"""
+        if text not in self._compiled:
+            english, chinese = [], []
+            for line in text.split("\n"):
+                en, zh = self._split_line(line)
+                if en is not None:
+                    english.append(en)
+                if zh is not None:
+                    chinese.append(zh)
+            self._compiled[text] = ("\n".join(english) or text, "\n".join(chinese) or "\n".join(english) or text)
+        return self._compiled[text]
+
+    def translate(self, text):
+        if self.language == "both" or not text or not isinstance(text, str) or not self.CJK.search(text):
+            return text
+        english, chinese = self.compile(text)
+        return english if self.language == "en" else chinese
+
+# CJK-capable fonts for PDF output
+class PDFFonts:
+    """Register reportlab's built-in CID font for Chinese text once per process.
+    
+    STSong-Light ships with reportlab's Adobe-GB1 CMap support, so nothing
+    is read from disk or embedded; it is only selected for text that
+    actually contains CJK characters.
+    """
+    CJK_FONT = "STSong-Light"
+    _registered = False
+    _lock = threading.Lock()
+    
+    @classmethod
+    def cjk(cls):
+        if not cls._registered:
+            with cls._lock:
+                if not cls._registered:
+                    pdfmetrics.registerFont(UnicodeCIDFont(cls.CJK_FONT))
+                    cls._registered = True
+        return cls.CJK_FONT
+
+    @classmethod
+    def for_text(cls, text, default="Helvetica"):
+        return cls.cjk() if text and MessageCatalog.CJK.search(str(text)) else default
+
+    @classmethod
+    def markup(cls, text):
+        """Paragraph markup that switches to the CJK font when needed"""
+        text = xml_escape(str(text or ""))
+        if cls.for_text(text) == cls.CJK_FONT:
+            return f'<font name="{cls.CJK_FONT}">{text}</font>'
+        return text
+
+    @classmethod
+    def table_styles(cls, data, first_row=0):
+        """FONTNAME commands for the table cells that contain CJK text"""
+        styles = []
+        for row_index, row in enumerate(data[first_row:], start=first_row):
+            for col_index, value in enumerate(row):
+                if value and MessageCatalog.CJK.search(str(value)):
+                    styles.append(('FONTNAME', (col_index, row_index), (col_index, row_index), cls.cjk()))
+        return styles
+
+# Rule-based low-stock, expiry and calibration alerts
+class AlertEngine:
+    """Evaluate alert rules only for items that were written to.
+    
+    Triggers on `items` queue the id of every inserted or changed row in
+    `alert_dirty_items`, whichever code path did the write (dialogs, the
+    scanner service, the API, imports or sync). `evaluate_pending` drains
+    that queue. Date rules also record when an item will next cross its
+    threshold in `alert_schedule`, so `evaluate_due` only touches items
+    whose day has come. At most one open alert exists per item and rule
+    type; new alerts are queued for the UI and appended to a JSON-lines
+    outbox file.
+    """
+    RULE_TYPES = {
+        'low_stock': "Low stock 库存不足",
+        'expiry': "Expiry 过期",
+        'calibration': "Calibration due 校准到期",
+    }
+    SCOPES = ('item', 'category', 'item_type', 'all')
+    DEFAULT_RULES = (
+        ('low_stock', 'all', None, 10),
+        ('low_stock', 'item_type', 'equipment', 0),
+        ('expiry', 'item_type', 'chemical', 30),
+        ('calibration', 'item_type', 'equipment', 14),
+    )
+    WATCHED_FIELDS = ("quantity", "expiry_date", "next_calibration", "category", "item_type", "deleted_at")
+    
+    def __init__(self, conn, outbox_path):
+        self.conn = conn
+        self.outbox_path = Path(outbox_path)
+        self.notifications = queue.Queue()
+        self._rules = None
+
+    @classmethod
+    def install(cls, conn):
+        ensure_column(conn, "items", "expiry_date", "TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_items_expiry_date ON items (expiry_date)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS alert_rules (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                rule_type TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                target TEXT,
+                threshold REAL NOT NULL,
+                enabled INTEGER NOT NULL DEFAULT 1,
+                UNIQUE (rule_type, scope, target)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS alerts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id TEXT NOT NULL,
+                rule_type TEXT NOT NULL,
+                rule_id INTEGER,
+                message TEXT NOT NULL,
+                raised_at TEXT NOT NULL,
+                acknowledged_at TEXT,
+                resolved_at TEXT
+            )
+        """)
+        # One open alert per item and rule type is what de-duplicates repeats
+        conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_alerts_open
+            ON alerts (item_id, rule_type) WHERE resolved_at IS NULL
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS alert_dirty_items (item_id TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS alert_schedule (
+                item_id TEXT NOT NULL,
+                rule_type TEXT NOT NULL,
+                due_on TEXT NOT NULL,
+                PRIMARY KEY (item_id, rule_type)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_alert_schedule_due ON alert_schedule (due_on)")
+        
+        first_install = conn.execute("SELECT COUNT(*) FROM alert_rules").fetchone()[0] == 0
+        if first_install:
+            conn.executemany(
+                "INSERT INTO alert_rules (rule_type, scope, target, threshold) VALUES (?, ?, ?, ?)",
+                cls.DEFAULT_RULES)
+            # Existing items are evaluated once against the default rules
+            conn.execute("INSERT OR IGNORE INTO alert_dirty_items (item_id) SELECT id FROM items")
+        
+        conn.execute("DROP TRIGGER IF EXISTS trg_alert_items_insert")
+        conn.execute("DROP TRIGGER IF EXISTS trg_alert_items_update")
+        conn.execute("""
+            CREATE TRIGGER trg_alert_items_insert AFTER INSERT ON items
+            BEGIN
+                INSERT OR IGNORE INTO alert_dirty_items (item_id) VALUES (NEW.id);
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER trg_alert_items_update AFTER UPDATE OF {', '.join(cls.WATCHED_FIELDS)} ON items
+            BEGIN
+                INSERT OR IGNORE INTO alert_dirty_items (item_id) VALUES (NEW.id);
+            END
+        """)
+
+    def rules(self):
+        """Enabled rules grouped as {rule_type: {(scope, target): (rule_id, threshold)}}"""
+        if self._rules is None:
+            self._rules = {}
+            for rule_id, rule_type, scope, target, threshold in self.conn.execute(
+                    "SELECT id, rule_type, scope, target, threshold FROM alert_rules WHERE enabled = 1"):
+                self._rules.setdefault(rule_type, {})[(scope, target)] = (rule_id, threshold)
+        return self._rules
+
+    def rule_for(self, rule_type, item):
+        """The most specific rule of a type for an item: item, then category, type, all"""
+        rules = self.rules().get(rule_type, {})
+        for scope, target in (('item', item['id']), ('category', item['category']),
+                              ('item_type', item['item_type']), ('all', None)):
+            if (scope, target) in rules:
+                return rules[(scope, target)]
+        return None
+
+    def save_rule(self, rule_type, scope, target, threshold):
+        """Add or replace a rule and queue the items it may affect"""
+        if rule_type not in self.RULE_TYPES or scope not in self.SCOPES:
+            raise ValueError("Unknown rule type or scope")
+        target = None if scope == 'all' else target
+        try:
+            self.conn.execute("""
+                INSERT INTO alert_rules (rule_type, scope, target, threshold, enabled) VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT (rule_type, scope, target) DO UPDATE SET threshold = excluded.threshold, enabled = 1
+            """, (rule_type, scope, target, threshold))
+            self._mark_scope_dirty(scope, target)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self._rules = None
+
+    def delete_rule(self, rule_id):
+        row = self.conn.execute("SELECT scope, target FROM alert_rules WHERE id = ?", (rule_id,)).fetchone()
+        if row is None:
+            return
+        try:
+            self.conn.execute("DELETE FROM alert_rules WHERE id = ?", (rule_id,))
+            self._mark_scope_dirty(*row)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self._rules = None
+
+    def _mark_scope_dirty(self, scope, target):
+        where = {'item': "id = ?", 'category': "category = ?", 'item_type': "item_type = ?", 'all': "1"}[scope]
+        self.conn.execute(f"""
+            INSERT OR IGNORE INTO alert_dirty_items (item_id)
+            SELECT id FROM items WHERE {where} AND deleted_at IS NULL
+        """, () if scope == 'all' else (target,))
+
+    def _conditions(self, item, today):
+        """{rule_type: (rule_id, message or None, due_on or None)} for one item"""
+        results = {}
+        rule = self.rule_for('low_stock', item)
+        if rule is not None:
+            rule_id, threshold = rule
+            quantity = item['quantity'] or 0
+            message = (f"{item['name']} ({item['id']}): {quantity} left, below {threshold:g}"
+                       if quantity < threshold else None)
+            results['low_stock'] = (rule_id, message, None)
+        
+        for rule_type, field, verb in (('expiry', 'expiry_date', "expires"),
+                                       ('calibration', 'next_calibration', "calibration due")):
+            rule = self.rule_for(rule_type, item)
+            due = item[field]
+            if rule is None or not due or not ISO_DATE_PATTERN.match(due):
+                continue
+            rule_id, days = rule
+            alert_from = (date.fromisoformat(due) - timedelta(days=int(days))).isoformat()
+            if alert_from <= today:
+                overdue = " (OVERDUE 已过期)" if due < today else ""
+                results[rule_type] = (rule_id, f"{item['name']} ({item['id']}): {verb} {due}{overdue}", None)
+            else:
+                results[rule_type] = (rule_id, None, alert_from)
+        return results
+
+    def evaluate(self, item_ids):
+        """Re-check the given items; returns the alerts newly raised"""
+        today = date.today().isoformat()
+        now = datetime.now().isoformat()
+        raised = []
+        for item_id in item_ids:
+            row = self.conn.execute("""
+                SELECT id, name, item_type, category, quantity, expiry_date, next_calibration, deleted_at
+                FROM items WHERE id = ?
+            """, (item_id,)).fetchone()
+            item = dict(zip(("id", "name", "item_type", "category", "quantity",
+                             "expiry_date", "next_calibration", "deleted_at"), row)) if row else None
+            conditions = self._conditions(item, today) if item and not item['deleted_at'] else {}
+            
+            for rule_type in self.RULE_TYPES:
+                rule_id, message, due_on = conditions.get(rule_type, (None, None, None))
+                if message is None:
+                    self.conn.execute("""
+                        UPDATE alerts SET resolved_at = ?
+                        WHERE item_id = ? AND rule_type = ? AND resolved_at IS NULL
+                    """, (now, item_id, rule_type))
+                else:
+                    open_alert = self.conn.execute("""
+                        SELECT id FROM alerts WHERE item_id = ? AND rule_type = ? AND resolved_at IS NULL
+                    """, (item_id, rule_type)).fetchone()
+                    if open_alert is not None:
+                        self.conn.execute("UPDATE alerts SET message = ?, rule_id = ? WHERE id = ?",
+                                          (message, rule_id, open_alert[0]))
+                    else:
+                        cursor = self.conn.execute("""
+                            INSERT INTO alerts (item_id, rule_type, rule_id, message, raised_at)
+                            VALUES (?, ?, ?, ?, ?)
+                        """, (item_id, rule_type, rule_id, message, now))
+                        raised.append({"id": cursor.lastrowid, "item_id": item_id, "rule_type": rule_type,
+                                       "message": message, "raised_at": now})
+                if due_on is None:
+                    self.conn.execute("DELETE FROM alert_schedule WHERE item_id = ? AND rule_type = ?",
+                                      (item_id, rule_type))
+                else:
+                    self.conn.execute("""
+                        INSERT INTO alert_schedule (item_id, rule_type, due_on) VALUES (?, ?, ?)
+                        ON CONFLICT (item_id, rule_type) DO UPDATE SET due_on = excluded.due_on
+                    """, (item_id, rule_type, due_on))
+        return raised
+
+    def _run(self, item_ids, clear_dirty=False):
+        if not item_ids:
+            return []
+        try:
+            raised = self.evaluate(item_ids)
+            if clear_dirty:
+                # Only the ids read above; writers may have queued more meanwhile
+                self.conn.executemany("DELETE FROM alert_dirty_items WHERE item_id = ?",
+                                      [(item_id,) for item_id in item_ids])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self._publish(raised)
+        return raised
+
+    def evaluate_pending(self):
+        """Evaluate the items written since the last call"""
+        item_ids = [row[0] for row in self.conn.execute("SELECT item_id FROM alert_dirty_items")]
+        return self._run(item_ids, clear_dirty=True)
+
+    def evaluate_due(self):
+        """Evaluate items whose expiry/calibration window opens today or earlier"""
+        item_ids = [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT item_id FROM alert_schedule WHERE due_on <= ?", (date.today().isoformat(),))]
+        # evaluate() rewrites or removes each item's schedule rows
+        return self._run(item_ids)
+
+    def _publish(self, raised):
+        if not raised:
+            return
+        with open(self.outbox_path, 'a', encoding='utf-8') as outbox:
+            for alert in raised:
+                outbox.write(json.dumps(alert, ensure_ascii=False) + "\n")
+                self.notifications.put(alert)
+
+    def open_alerts(self):
+        """(id, item_id, rule_type, message, raised_at, acknowledged_at) for unresolved alerts"""
+        return self.conn.execute("""
+            SELECT id, item_id, rule_type, message, raised_at, acknowledged_at
+            FROM alerts WHERE resolved_at IS NULL
+            ORDER BY acknowledged_at IS NOT NULL, raised_at DESC
+        """).fetchall()
+
+    def acknowledge(self, alert_ids):
+        try:
+            self.conn.executemany(
+                "UPDATE alerts SET acknowledged_at = ? WHERE id = ? AND acknowledged_at IS NULL",
+                [(datetime.now().isoformat(), alert_id) for alert_id in alert_ids])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+# Consumption-driven reorder proposals and purchase orders
+class ReorderPlanner:
+    """Propose and issue purchase orders for items below their reorder point.
+    
+    The reorder point of an item is its low-stock alert threshold, resolved
+    the same way as `AlertEngine.rule_for` (item, category, type, all). The
+    order quantity tops stock up to that point plus `cover_days` of the
+    daily consumption seen in `usage_log` over the last `window_days`.
+    Items on an open purchase order are left out until it is received or
+    cancelled.
+    """
+    UNSPECIFIED = "Unspecified 未指定"
+    
+    def __init__(self, conn, output_dir):
+        self.conn = conn
+        self.output_dir = Path(output_dir)
+
+    @staticmethod
+    def install(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS purchase_orders (
+                id TEXT PRIMARY KEY,
+                batch_id TEXT NOT NULL,
+                manufacturer TEXT,
+                status TEXT NOT NULL DEFAULT 'open',
+                created_at TEXT NOT NULL,
+                closed_at TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS purchase_order_lines (
+                po_id TEXT NOT NULL REFERENCES purchase_orders (id),
+                item_id TEXT NOT NULL,
+                quantity INTEGER NOT NULL,
+                unit TEXT,
+                daily_rate REAL,
+                PRIMARY KEY (po_id, item_id)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_purchase_orders_status ON purchase_orders (status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_purchase_order_lines_item ON purchase_order_lines (item_id)")
+        # Lets the consumption window be read as an index range instead of a table scan
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_log_consumption
+            ON usage_log (timestamp, item_id, quantity_changed)
+        """)
+
+    def proposals(self, window_days=90, cover_days=30):
+        """ReorderProposal records for the whole catalog, ordered by manufacturer"""
+        cursor = self.conn.cursor()
+        cursor.row_factory = ReorderProposal.row_factory
+        since = (datetime.now() - timedelta(days=window_days)).isoformat()
+        return cursor.execute("""
+            WITH consumption AS (
+                SELECT item_id, SUM(quantity_changed) AS used
+                FROM usage_log
+                WHERE timestamp >= ? AND quantity_changed > 0
+                GROUP BY item_id
+            ),
+            on_order AS (
+                SELECT DISTINCT l.item_id
+                FROM purchase_order_lines l
+                JOIN purchase_orders p ON p.id = l.po_id
+                WHERE p.status = 'open'
+            ),
+            candidates AS (
+                SELECT i.id, i.name, i.name_cn, i.model_number, i.unit,
+                       COALESCE(NULLIF(TRIM(i.manufacturer), ''), ?) AS manufacturer,
+                       COALESCE(i.quantity, 0) AS quantity,
+                       COALESCE(ri.threshold, rc.threshold, rt.threshold, ra.threshold) AS reorder_point,
+                       COALESCE(c.used, 0) * 1.0 / ? AS daily_rate
+                FROM items i
+                LEFT JOIN alert_rules ri ON ri.rule_type = 'low_stock' AND ri.enabled = 1
+                     AND ri.scope = 'item' AND ri.target = i.id
+                LEFT JOIN alert_rules rc ON rc.rule_type = 'low_stock' AND rc.enabled = 1
+                     AND rc.scope = 'category' AND rc.target = i.category
+                LEFT JOIN alert_rules rt ON rt.rule_type = 'low_stock' AND rt.enabled = 1
+                     AND rt.scope = 'item_type' AND rt.target = i.item_type
+                LEFT JOIN alert_rules ra ON ra.rule_type = 'low_stock' AND ra.enabled = 1
+                     AND ra.scope = 'all'
+                LEFT JOIN consumption c ON c.item_id = i.id
+                WHERE i.deleted_at IS NULL
+                  AND i.id NOT IN (SELECT item_id FROM on_order)
+            ),
+            needed AS (
+                SELECT *, reorder_point + daily_rate * ? - quantity AS shortfall
+                FROM candidates
+                WHERE quantity < reorder_point
+            )
+            SELECT manufacturer, id AS item_id, name, name_cn, model_number, unit, quantity, reorder_point,
+                   ROUND(daily_rate, 3) AS daily_rate,
+                   MAX(1, CAST(shortfall AS INTEGER) + (shortfall > CAST(shortfall AS INTEGER))) AS order_quantity
+            FROM needed
+            ORDER BY manufacturer, name, id
+        """, (since, self.UNSPECIFIED, window_days, cover_days)).fetchall()
+
+    def create_orders(self, proposals):
+        """Record one purchase order per manufacturer and write the batch's PDF
+        and CSV; returns (batch_id, order count, pdf path, csv path)"""
+        if not proposals:
+            return None, 0, None, None
+        now = datetime.now()
+        batch_id = now.strftime("%Y%m%d-%H%M%S")
+        orders = {}
+        for proposal in proposals:
+            orders.setdefault(proposal.manufacturer, []).append(proposal)
+        
+        try:
+            for number, (manufacturer, lines) in enumerate(orders.items(), start=1):
+                po_id = f"PO-{batch_id}-{number:03d}"
+                self.conn.execute("""
+                    INSERT INTO purchase_orders (id, batch_id, manufacturer, status, created_at)
+                    VALUES (?, ?, ?, 'open', ?)
+                """, (po_id, batch_id, manufacturer, now.isoformat()))
+                self.conn.executemany("""
+                    INSERT INTO purchase_order_lines (po_id, item_id, quantity, unit, daily_rate)
+                    VALUES (?, ?, ?, ?, ?)
+                """, [(po_id, line.item_id, line.order_quantity, line.unit, line.daily_rate) for line in lines])
+                orders[manufacturer] = (po_id, lines)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        pdf_path = self.output_dir / f"purchase_orders_{batch_id}.pdf"
+        csv_path = self.output_dir / f"purchase_orders_{batch_id}.csv"
+        self.write_csv(csv_path, orders)
+        self.write_pdf(pdf_path, orders, now)
+        return batch_id, len(orders), pdf_path, csv_path
+
+    def write_csv(self, path, orders):
+        with open(path, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['PO', 'Manufacturer', 'Item ID', 'Name', 'Chinese Name', 'Model Number',
+                             'Order Quantity', 'Unit', 'In Stock', 'Reorder Point', 'Daily Usage'])
+            for manufacturer, (po_id, lines) in orders.items():
+                for line in lines:
+                    writer.writerow([po_id, manufacturer, line.item_id, line.name, line.name_cn, line.model_number,
+                                     line.order_quantity, line.unit, line.quantity, line.reorder_point,
+                                     line.daily_rate])
+
+    def write_pdf(self, path, orders, created):
+        """One page per purchase order"""
+        doc = SimpleDocTemplate(str(path), pagesize=A4)
+        styles = getSampleStyleSheet()
+        col_widths = [doc.width * share for share in (0.14, 0.26, 0.2, 0.16, 0.12, 0.12)]
+        story = []
+        for manufacturer, (po_id, lines) in orders.items():
+            if story:
+                story.append(PageBreak())
+            story.append(Paragraph(f"Purchase Order {po_id}", styles['Title']))
+            story.append(Paragraph(f"Supplier: {PDFFonts.markup(manufacturer)}", styles['Heading2']))
+            story.append(Paragraph(f"Date: {created.strftime('%Y-%m-%d')}", styles['Normal']))
+            story.append(Paragraph("<br/>", styles['Normal']))
+            
+            data = [['Item ID', 'Name', 'Chinese Name', 'Model', 'Quantity', 'Unit']]
+            data.extend([line.item_id, line.name, line.name_cn or "", line.model_number or "",
+                         line.order_quantity, line.unit or ""] for line in lines)
+            table = Table(data, colWidths=col_widths, repeatRows=1)
+            style = [
+                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+                ('FONTSIZE', (0, 0), (-1, -1), 9),
+                ('ALIGN', (4, 1), (4, -1), 'RIGHT'),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ]
+            style.extend(PDFFonts.table_styles(data, 1))
+            table.setStyle(TableStyle(style))
+            story.append(table)
+        doc.build(story)
+
+    def open_orders(self):
+        """(po_id, manufacturer, created_at, line count, total quantity) for open orders"""
+        return self.conn.execute("""
+            SELECT p.id, p.manufacturer, p.created_at, COUNT(l.item_id), COALESCE(SUM(l.quantity), 0)
+            FROM purchase_orders p
+            LEFT JOIN purchase_order_lines l ON l.po_id = p.id
+            WHERE p.status = 'open'
+            GROUP BY p.id
+            ORDER BY p.created_at, p.id
+        """).fetchall()
+
+    def receive(self, po_id, user="Purchasing 采购"):
+        """Book an open order's quantities into stock as negative usage entries"""
+        self._close(po_id, 'received', user)
+
+    def cancel(self, po_id):
+        self._close(po_id, 'cancelled')
+
+    def _close(self, po_id, status, user=None):
+        closed_at = datetime.now()
+        try:
+            updated = self.conn.execute("""
+                UPDATE purchase_orders SET status = ?, closed_at = ? WHERE id = ? AND status = 'open'
+            """, (status, closed_at.isoformat(), po_id)).rowcount
+            if not updated:
+                raise ValueError(f"Purchase order {po_id} is not open")
+            if status == 'received':
+                lines = self.conn.execute("""
+                    SELECT l.item_id, l.quantity FROM purchase_order_lines l
+                    JOIN items i ON i.id = l.item_id
+                    WHERE l.po_id = ? AND i.deleted_at IS NULL
+                """, (po_id,)).fetchall()
+                # Lot-tracked items get a lot named after the order, filled by the ledger credit below
+                lots = LotTracker(self.conn)
+                for item_id, _ in lines:
+                    if lots.is_tracked(item_id):
+                        lots.add_empty_lot(item_id, po_id)
+                self.conn.executemany("""
+                    INSERT INTO usage_log (item_id, user, quantity_changed, purpose)
+                    VALUES (?, ?, ?, ?)
+                """, [(item_id, user, -quantity, f"Received {po_id} 到货") for item_id, quantity in lines])
+                self.conn.executemany("""
+                    UPDATE items
+                    SET quantity = COALESCE(quantity, 0) + ?, last_updated = ?, version = version + 1
+                    WHERE id = ?
+                """, [(quantity, closed_at, item_id) for item_id, quantity in lines])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+# Storage location hierarchy (building > room > unit > shelf)
+class LocationHierarchy:
+    """Location tree stored as a closure table with per-node occupancy.
+    
+    `location_closure` holds one row per (ancestor, descendant) pair, so a
+    subtree is a single indexed lookup and moving a node rewrites only the
+    pairs that cross its boundary. `items.location` keeps the full path
+    text ("Building A / Room 101 / Freezer 3 / Shelf 2"); triggers resolve
+    it to `items.location_id` and keep `location_stats` item and
+    hazardous-item counts current for every ancestor of the item's node.
+    """
+    LEVELS = ('building', 'room', 'unit', 'shelf')
+    LEVEL_LABELS = {
+        'building': "Building 楼宇",
+        'room': "Room 房间",
+        'unit': "Unit 冰箱/柜",
+        'shelf': "Shelf 层架",
+    }
+    SEPARATOR = " / "
+    # Safety classifications that do not count as hazardous
+    NON_HAZARDOUS = ('', 'none', 'n/a', 'na', 'non-hazardous', 'not hazardous', '无', '非危险品')
+    
+    def __init__(self, conn):
+        self.conn = conn
+
+    @classmethod
+    def _hazardous(cls, alias):
+        exempt = ", ".join(f"'{value}'" for value in cls.NON_HAZARDOUS)
+        return f"(LOWER(TRIM(IFNULL({alias}.safety_classification, ''))) NOT IN ({exempt}))"
+
+    @classmethod
+    def install(cls, conn):
+        ensure_column(conn, "items", "location_id", "INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_items_location_id ON items (location_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_items_location ON items (location)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS locations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                parent_id INTEGER REFERENCES locations (id),
+                name TEXT NOT NULL,
+                level TEXT NOT NULL,
+                path TEXT NOT NULL,
+                UNIQUE (parent_id, name)
+            )
+        """)
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_locations_path ON locations (path)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS location_closure (
+                ancestor_id INTEGER NOT NULL,
+                descendant_id INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                PRIMARY KEY (ancestor_id, descendant_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_location_closure_descendant
+            ON location_closure (descendant_id, ancestor_id)
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS location_stats (
+                location_id INTEGER PRIMARY KEY,
+                item_count INTEGER NOT NULL DEFAULT 0,
+                hazardous_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        
+        for name in ("resolve_insert", "resolve_update", "stats_insert", "stats_update", "stats_delete"):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_location_{name}")
+        # The path text is what users type and what sync replicates; the id is resolved locally
+        conn.execute("""
+            CREATE TRIGGER trg_location_resolve_insert AFTER INSERT ON items
+            WHEN (SELECT id FROM locations WHERE path = NEW.location) IS NOT NEW.location_id
+            BEGIN
+                UPDATE items SET location_id = (SELECT id FROM locations WHERE path = NEW.location)
+                WHERE id = NEW.id;
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER trg_location_resolve_update AFTER UPDATE OF location ON items
+            WHEN NEW.location IS NOT OLD.location
+            BEGIN
+                UPDATE items SET location_id = (SELECT id FROM locations WHERE path = NEW.location)
+                WHERE id = NEW.id;
+            END
+        """)
+        
+        def adjust(alias, sign):
+            return f"""
+                UPDATE location_stats
+                SET item_count = item_count {sign} 1,
+                    hazardous_count = hazardous_count {sign} {cls._hazardous(alias)}
+                WHERE {alias}.location_id IS NOT NULL AND {alias}.deleted_at IS NULL
+                  AND location_id IN (SELECT ancestor_id FROM location_closure
+                                      WHERE descendant_id = {alias}.location_id);
+            """
+        
+        conn.execute(f"""
+            CREATE TRIGGER trg_location_stats_insert AFTER INSERT ON items
+            BEGIN
+                {adjust('NEW', '+')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER trg_location_stats_update
+            AFTER UPDATE OF location_id, deleted_at, safety_classification ON items
+            WHEN OLD.location_id IS NOT NEW.location_id OR OLD.deleted_at IS NOT NEW.deleted_at
+                 OR {cls._hazardous('OLD')} IS NOT {cls._hazardous('NEW')}
+            BEGIN
+                {adjust('OLD', '-')}
+                {adjust('NEW', '+')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER trg_location_stats_delete AFTER DELETE ON items
+            BEGIN
+                {adjust('OLD', '-')}
+            END
+        """)
+
+    def rebuild_stats(self):
+        """Recount every node's occupancy from scratch"""
+        self.conn.execute("DELETE FROM location_stats")
+        self.conn.execute(f"""
+            INSERT INTO location_stats (location_id, item_count, hazardous_count)
+            SELECT l.id, COUNT(i.id), COALESCE(SUM({self._hazardous('i')}), 0)
+            FROM locations l
+            LEFT JOIN location_closure c ON c.ancestor_id = l.id
+            LEFT JOIN items i ON i.location_id = c.descendant_id AND i.deleted_at IS NULL
+            GROUP BY l.id
+        """)
+
+    def add(self, name, parent_id=None):
+        """Create a node one level below `parent_id` (a building when None); returns its id"""
+        name = self._check_name(name)
+        if parent_id is None:
+            level, path = self.LEVELS[0], name
+        else:
+            parent = self.get(parent_id)
+            if parent is None:
+                raise ValueError("Parent location not found")
+            if parent['level'] == self.LEVELS[-1]:
+                raise ValueError("Shelves cannot contain other locations")
+            level = self.LEVELS[self.LEVELS.index(parent['level']) + 1]
+            path = parent['path'] + self.SEPARATOR + name
+        try:
+            location_id = self.conn.execute(
+                "INSERT INTO locations (parent_id, name, level, path) VALUES (?, ?, ?, ?)",
+                (parent_id, name, level, path)).lastrowid
+            self.conn.execute("""
+                INSERT INTO location_closure (ancestor_id, descendant_id, depth)
+                SELECT ancestor_id, ?, depth + 1 FROM location_closure WHERE descendant_id = ?
+                UNION ALL SELECT ?, ?, 0
+            """, (location_id, parent_id, location_id, location_id))
+            self.conn.execute("INSERT INTO location_stats (location_id) VALUES (?)", (location_id,))
+            # Items whose free-text location already spells this path are linked to it
+            self.conn.execute("UPDATE items SET location_id = ? WHERE location = ?", (location_id, path))
+            self.conn.commit()
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
+            raise ValueError(f"A location named '{name}' already exists here")
+        except Exception:
+            self.conn.rollback()
+            raise
+        return location_id
+
+    def _check_name(self, name):
+        name = (name or "").strip()
+        if not name:
+            raise ValueError("Location name is required")
+        if self.SEPARATOR.strip() in name:
+            raise ValueError(f"Location names cannot contain '{self.SEPARATOR.strip()}'")
+        return name
+
+    def get(self, location_id):
+        row = self.conn.execute(
+            "SELECT id, parent_id, name, level, path FROM locations WHERE id = ?", (location_id,)).fetchone()
+        return dict(zip(("id", "parent_id", "name", "level", "path"), row)) if row else None
+
+    def nodes(self):
+        """(id, parent_id, name, level, path, item_count, hazardous_count), parents before children"""
+        return self.conn.execute("""
+            SELECT l.id, l.parent_id, l.name, l.level, l.path,
+                   COALESCE(s.item_count, 0), COALESCE(s.hazardous_count, 0)
+            FROM locations l
+            LEFT JOIN location_stats s ON s.location_id = l.id
+            ORDER BY l.path
+        """).fetchall()
+
+    def paths(self):
+        return [path for (path,) in self.conn.execute("SELECT path FROM locations ORDER BY path")]
+
+    def items_in(self, location_id):
+        """Live items anywhere below (and at) a node"""
+        return self.conn.execute("""
+            SELECT i.id, i.name, i.name_cn, i.item_type, i.quantity, i.unit, i.location, i.safety_classification
+            FROM location_closure c
+            JOIN items i ON i.location_id = c.descendant_id
+            WHERE c.ancestor_id = ? AND i.deleted_at IS NULL
+            ORDER BY i.location, i.name
+        """, (location_id,)).fetchall()
+
+    def rename(self, location_id, name):
+        node = self.get(location_id)
+        if node is None:
+            raise ValueError("Location not found")
+        name = self._check_name(name)
+        try:
+            self.conn.execute("UPDATE locations SET name = ? WHERE id = ?", (name, location_id))
+            self._repath(location_id)
+            self.conn.commit()
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
+            raise ValueError(f"A location named '{name}' already exists here")
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def move(self, location_id, new_parent_id):
+        """Re-parent a node with everything below it"""
+        node, parent = self.get(location_id), self.get(new_parent_id)
+        if node is None or parent is None:
+            raise ValueError("Location not found")
+        if self.LEVELS.index(parent['level']) != self.LEVELS.index(node['level']) - 1:
+            raise ValueError(f"A {node['level']} must be placed in a {self.LEVELS[self.LEVELS.index(node['level']) - 1]}")
+        if node['parent_id'] == new_parent_id:
+            return
+        
+        stats = self.conn.execute(
+            "SELECT item_count, hazardous_count FROM location_stats WHERE location_id = ?",
+            (location_id,)).fetchone() or (0, 0)
+        try:
+            # Counts leave the old ancestors and join the new ones
+            self.conn.execute("""
+                UPDATE location_stats SET item_count = item_count - ?, hazardous_count = hazardous_count - ?
+                WHERE location_id IN (SELECT ancestor_id FROM location_closure
+                                      WHERE descendant_id = ? AND ancestor_id != ?)
+            """, (*stats, location_id, location_id))
+            self.conn.execute("""
+                DELETE FROM location_closure
+                WHERE descendant_id IN (SELECT descendant_id FROM location_closure WHERE ancestor_id = ?)
+                  AND ancestor_id NOT IN (SELECT descendant_id FROM location_closure WHERE ancestor_id = ?)
+            """, (location_id, location_id))
+            self.conn.execute("""
+                INSERT INTO location_closure (ancestor_id, descendant_id, depth)
+                SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+                FROM location_closure above, location_closure below
+                WHERE above.descendant_id = ? AND below.ancestor_id = ?
+            """, (new_parent_id, location_id))
+            self.conn.execute("""
+                UPDATE location_stats SET item_count = item_count + ?, hazardous_count = hazardous_count + ?
+                WHERE location_id IN (SELECT ancestor_id FROM location_closure
+                                      WHERE descendant_id = ? AND ancestor_id != ?)
+            """, (*stats, location_id, location_id))
+            self.conn.execute("UPDATE locations SET parent_id = ? WHERE id = ?", (new_parent_id, location_id))
+            self._repath(location_id)
+            self.conn.commit()
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
+            raise ValueError(f"A location named '{node['name']}' already exists there")
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _repath(self, location_id):
+        """Rebuild the path of a subtree and of the items stored in it"""
+        self.conn.execute(f"""
+            UPDATE locations SET path = (
+                SELECT group_concat(name, '{self.SEPARATOR}') FROM (
+                    SELECT a.name FROM location_closure c
+                    JOIN locations a ON a.id = c.ancestor_id
+                    WHERE c.descendant_id = locations.id
+                    ORDER BY c.depth DESC
+                )
+            )
+            WHERE id IN (SELECT descendant_id FROM location_closure WHERE ancestor_id = ?)
+        """, (location_id,))
+        self.conn.execute("""
+            UPDATE items
+            SET location = (SELECT path FROM locations WHERE id = items.location_id),
+                last_updated = ?, version = version + 1
+            WHERE location_id IN (SELECT descendant_id FROM location_closure WHERE ancestor_id = ?)
+        """, (datetime.now(), location_id))
+
+    def delete(self, location_id):
+        """Remove an empty node and everything below it"""
+        stats = self.conn.execute(
+            "SELECT item_count FROM location_stats WHERE location_id = ?", (location_id,)).fetchone()
+        if stats and stats[0]:
+            raise ValueError(f"{stats[0]} items are still stored here")
+        try:
+            subtree = "SELECT descendant_id FROM location_closure WHERE ancestor_id = ?"
+            # Soft-deleted items keep their path text but lose the link
+            self.conn.execute(f"UPDATE items SET location_id = NULL WHERE location_id IN ({subtree})", (location_id,))
+            self.conn.execute(f"DELETE FROM location_stats WHERE location_id IN ({subtree})", (location_id,))
+            self.conn.execute(f"DELETE FROM locations WHERE id IN ({subtree})", (location_id,))
+            self.conn.execute(f"""
+                DELETE FROM location_closure
+                WHERE descendant_id IN ({subtree})
+            """, (location_id,))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+# Lot-level stock with first-expired-first-out consumption
+class LotTracker:
+    """Track stock per received lot and consume it first-expired-first-out.
+    
+    Every stock movement in the app already writes a `usage_log` row, so
+    triggers on that table do the lot bookkeeping inside the writer's own
+    transaction: a positive row takes stock from the item's lots in
+    expiry order (lots without an expiry go last) and records what came
+    from where in `usage_lot_allocations`; a returned loan puts exactly
+    that back; a negative row credits the item's newest lot.
+    `items.quantity` stays the item's running total and `items.expiry_date`
+    follows the earliest expiry still in stock. Items without lots are
+    left alone.
+    
+    Writers therefore book the ledger row (or the return) before touching
+    `items.quantity`. Any quantity change that does not match the lots
+    afterwards (a manual edit, bulk undo) is reconciled by crediting
+    the newest lot or consuming the lots in expiry order, without
+    allocations.
+    
+    The triggers stand down while `SyncEngine` replays another site's
+    changes, because that site's lot rows arrive in the same batch; only
+    the allocations stay local.
+    """
+    OPENING_LOT = "UNTRACKED 未分批"
+    NO_EXPIRY = "'9999-12-31'"
+    
+    def __init__(self, conn):
+        self.conn = conn
+
+    @classmethod
+    def install(cls, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS item_lots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id TEXT NOT NULL REFERENCES items (id),
+                lot_number TEXT NOT NULL,
+                expiry_date TEXT,
+                quantity INTEGER NOT NULL DEFAULT 0 CHECK (quantity >= 0),
+                received_date TEXT NOT NULL
+            )
+        """)
+        conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_item_lots_fefo
+            ON item_lots (item_id, IFNULL(expiry_date, {cls.NO_EXPIRY}), id)
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_lot_allocations (
+                usage_id INTEGER NOT NULL,
+                lot_id INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                PRIMARY KEY (usage_id, lot_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_lot_allocations_lot ON usage_lot_allocations (lot_id)")
+        conn.execute("CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Scratch space for reconciling lots, emptied again by the trigger that fills it
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS lot_reconciliation (
+                lot_id INTEGER PRIMARY KEY,
+                quantity INTEGER NOT NULL
+            )
+        """)
+        
+        def earliest_expiry_for(item_id):
+            return f"""
+                UPDATE items SET expiry_date = (
+                    SELECT MIN(expiry_date) FROM item_lots WHERE item_id = {item_id} AND quantity > 0
+                )
+                WHERE id = {item_id} AND expiry_date IS NOT (
+                    SELECT MIN(expiry_date) FROM item_lots WHERE item_id = {item_id} AND quantity > 0
+                );
+            """
+        earliest_expiry = earliest_expiry_for("NEW.item_id")
+        apply_allocations = """
+            UPDATE item_lots SET quantity = quantity - (
+                SELECT a.quantity FROM usage_lot_allocations a WHERE a.usage_id = NEW.id AND a.lot_id = item_lots.id
+            )
+            WHERE id IN (SELECT lot_id FROM usage_lot_allocations WHERE usage_id = NEW.id);
+        """
+        local = "(SELECT value FROM app_meta WHERE key = 'replaying_changes') IS NOT '1'"
+        has_lots = f"EXISTS (SELECT 1 FROM item_lots WHERE item_id = NEW.item_id) AND {local}"
+        for name in ("consume", "credit", "return", "reconcile"):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_lots_{name}")
+        conn.execute(f"""
+            CREATE TRIGGER trg_lots_consume AFTER INSERT ON usage_log
+            WHEN NEW.quantity_changed > 0 AND {has_lots}
+            BEGIN
+                INSERT INTO usage_lot_allocations (usage_id, lot_id, quantity)
+                SELECT NEW.id, id, MIN(quantity, NEW.quantity_changed - (running - quantity))
+                FROM (
+                    SELECT id, quantity, SUM(quantity) OVER (
+                        ORDER BY IFNULL(expiry_date, {cls.NO_EXPIRY}), id
+                    ) AS running
+                    FROM item_lots
+                    WHERE item_id = NEW.item_id AND quantity > 0
+                )
+                WHERE running - quantity < NEW.quantity_changed;
+                {apply_allocations}
+                {earliest_expiry}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER trg_lots_credit AFTER INSERT ON usage_log
+            WHEN NEW.quantity_changed < 0 AND {has_lots}
+            BEGIN
+                INSERT INTO usage_lot_allocations (usage_id, lot_id, quantity)
+                SELECT NEW.id, id, NEW.quantity_changed FROM item_lots
+                WHERE item_id = NEW.item_id
+                ORDER BY id DESC
+                LIMIT 1;
+                {apply_allocations}
+                {earliest_expiry}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER trg_lots_return AFTER UPDATE OF return_time ON usage_log
+            WHEN OLD.return_time IS NULL AND NEW.return_time IS NOT NULL AND NEW.returnable = 1
+                 AND {has_lots}
+            BEGIN
+                UPDATE item_lots SET quantity = quantity + (
+                    SELECT a.quantity FROM usage_lot_allocations a
+                    WHERE a.usage_id = NEW.id AND a.lot_id = item_lots.id
+                )
+                WHERE id IN (SELECT lot_id FROM usage_lot_allocations WHERE usage_id = NEW.id);
+                {earliest_expiry}
+            END
+        """)
+        lot_total = "(SELECT SUM(quantity) FROM item_lots WHERE item_id = NEW.id)"
+        target = "MAX(IFNULL(NEW.quantity, 0), 0)"
+        conn.execute(f"""
+            CREATE TRIGGER trg_lots_reconcile AFTER UPDATE OF quantity ON items
+            WHEN EXISTS (SELECT 1 FROM item_lots WHERE item_id = NEW.id) AND {target} != {lot_total} AND {local}
+            BEGIN
+                UPDATE item_lots SET quantity = quantity + {target} - {lot_total}
+                WHERE {target} > {lot_total}
+                  AND id = (SELECT MAX(id) FROM item_lots WHERE item_id = NEW.id);
+                INSERT INTO lot_reconciliation (lot_id, quantity)
+                SELECT id, MIN(quantity, excess - (running - quantity))
+                FROM (
+                    SELECT id, quantity, {lot_total} - {target} AS excess, SUM(quantity) OVER (
+                        ORDER BY IFNULL(expiry_date, {cls.NO_EXPIRY}), id
+                    ) AS running
+                    FROM item_lots
+                    WHERE item_id = NEW.id AND quantity > 0
+                )
+                WHERE running - quantity < excess;
+                UPDATE item_lots SET quantity = quantity - (
+                    SELECT r.quantity FROM lot_reconciliation r WHERE r.lot_id = item_lots.id
+                )
+                WHERE id IN (SELECT lot_id FROM lot_reconciliation);
+                DELETE FROM lot_reconciliation;
+                {earliest_expiry_for("NEW.id")}
+            END
+        """)
+
+    def is_tracked(self, item_id):
+        return self.conn.execute("SELECT 1 FROM item_lots WHERE item_id = ? LIMIT 1", (item_id,)).fetchone() is not None
+
+    def lots(self, item_id, include_empty=False):
+        """(id, lot_number, expiry_date, quantity, received_date) in consumption order"""
+        return self.conn.execute(f"""
+            SELECT id, lot_number, expiry_date, quantity, received_date FROM item_lots
+            WHERE item_id = ? {'' if include_empty else 'AND quantity > 0'}
+            ORDER BY IFNULL(expiry_date, {self.NO_EXPIRY}), id
+        """, (item_id,)).fetchall()
+
+    def add_empty_lot(self, item_id, lot_number, expiry_date=None, received_date=None):
+        """Start a lot that the next stock credit for the item will fill; returns its id.
+        
+        The first lot of an item that already has stock also gets an
+        opening lot holding that stock, so the lots add up to the item
+        quantity from then on.
+        """
+        if not self.is_tracked(item_id):
+            self.conn.execute("""
+                INSERT INTO item_lots (item_id, lot_number, expiry_date, quantity, received_date)
+                SELECT id, ?, CASE WHEN expiry_date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+                                   THEN expiry_date END,
+                       quantity, COALESCE(NULLIF(purchase_date, ''), ?)
+                FROM items WHERE id = ? AND quantity > 0
+            """, (self.OPENING_LOT, date.today().isoformat(), item_id))
+        return self.conn.execute("""
+            INSERT INTO item_lots (item_id, lot_number, expiry_date, quantity, received_date)
+            VALUES (?, ?, ?, 0, ?)
+        """, (item_id, lot_number, expiry_date or None,
+              received_date or date.today().isoformat())).lastrowid
+
+    def receive(self, item_id, lot_number, quantity, expiry_date=None, received_date=None, user="Stores 库房"):
+        """Book a delivered lot into stock; returns the lot id"""
+        lot_number = (lot_number or "").strip()
+        if not lot_number:
+            raise ValueError("Lot number is required")
+        if quantity <= 0:
+            raise ValueError("Quantity must be positive")
+        expiry_date = normalize_date(expiry_date) or None
+        received_date = normalize_date(received_date) or date.today().isoformat()
+        try:
+            if self.conn.execute("SELECT 1 FROM items WHERE id = ? AND deleted_at IS NULL",
+                                 (item_id,)).fetchone() is None:
+                raise ValueError("Item not found")
+            lot_id = self.add_empty_lot(item_id, lot_number, expiry_date, received_date)
+            self.conn.execute("""
+                INSERT INTO usage_log (item_id, user, quantity_changed, purpose)
+                VALUES (?, ?, ?, ?)
+            """, (item_id, user, -quantity, f"Received lot {lot_number} 批次入库"))
+            self.conn.execute("""
+                UPDATE items SET quantity = COALESCE(quantity, 0) + ?, last_updated = ?, version = version + 1
+                WHERE id = ?
+            """, (quantity, datetime.now(), item_id))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return lot_id
+
+    def allocations(self, usage_id):
+        """(lot_number, expiry_date, quantity) drawn by one usage entry"""
+        return self.conn.execute(f"""
+            SELECT l.lot_number, l.expiry_date, a.quantity
+            FROM usage_lot_allocations a
+            JOIN item_lots l ON l.id = a.lot_id
+            WHERE a.usage_id = ?
+            ORDER BY IFNULL(l.expiry_date, {self.NO_EXPIRY}), l.id
+        """, (usage_id,)).fetchall()
+
+# Label rendering and print spooling
+class LabelSpooler:
+    """Render asset labels (QR code, ID, name, name_cn) and spool them in batches.
+    
+    Each job is one batch of labels written as a single spool file: ZPL with
+    every label as a ^GFA graphic field, ESC/POS raster (GS v 0) for receipt
+    style printers, or a PDF sheet of raster labels for office printers.
+    Labels are rendered as bitmaps so Chinese names print without printer
+    fonts, and the bitmaps are cached per item change stamp. Jobs run on a
+    background thread; finished jobs are reported on `results`.
+    """
+    FORMATS = {'zpl': '.zpl', 'escpos': '.bin', 'sheet': '.pdf'}
+    FONT_CANDIDATES = ("NotoSansCJK-Regular.ttc", "NotoSansSC-Regular.otf", "wqy-microhei.ttc",
+                       "msyh.ttc", "simhei.ttf", "DejaVuSans.ttf")
+    _fonts = {}
+    
+    def __init__(self, spool_dir, cache_dir, dpi=203, size_mm=(50, 25), printer=None):
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.dpi = dpi
+        self.size = tuple(int(round(mm_ * dpi / 25.4)) for mm_ in size_mm)
+        self.printer = printer
+        self.cache = ThumbnailCache(cache_dir, {'label': self.render_label}, memory_items=512)
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self._thread = None
+
+    @classmethod
+    def font(cls, size):
+        """A font with CJK glyphs if one is installed, loaded once per size"""
+        if size not in cls._fonts:
+            cls._fonts[size] = ImageFont.load_default()
+            for name in cls.FONT_CANDIDATES:
+                try:
+                    cls._fonts[size] = ImageFont.truetype(name, size)
+                    break
+                except OSError:
+                    continue
+        return cls._fonts[size]
+
+    def render_label(self, item):
+        """Monochrome label bitmap at the printer's resolution"""
+        width, height = self.size
+        label = Image.new("1", (width, height), 1)
+        margin = max(4, height // 20)
+        qr_size = height - 2 * margin
+        qr_image = make_qr_image(item.id, box_size=4).convert("1").resize((qr_size, qr_size), Image.NEAREST)
+        label.paste(qr_image, (margin, margin))
+        
+        draw = ImageDraw.Draw(label)
+        text_x = qr_size + 2 * margin
+        text_width = width - text_x - margin
+        y = margin
+        for text, size in ((item.id, height // 6), (item.name, height // 8), (item.name_cn, height // 8)):
+            if not text:
+                continue
+            font = self.font(size)
+            text = str(text)
+            # Trim to the printable width rather than wrapping
+            while len(text) > 1 and draw.textlength(text, font=font) > text_width:
+                text = text[:-1]
+            draw.text((text_x, y), text, fill=0, font=font)
+            y += int(size * 1.3)
+        return label
+
+    @staticmethod
+    def _black_bits(label):
+        """Packed rows with 1 = black, as printers expect"""
+        return ImageOps.invert(label.convert("L")).convert("1").tobytes()
+
+    @staticmethod
+    def _zpl_repeat(count, char):
+        """ZPL run-length prefix: g-z count 20-400, G-Y count 1-19"""
+        prefix = []
+        while count > 400:
+            prefix.append("z")
+            count -= 400
+        if count >= 20:
+            prefix.append(chr(ord("g") + count // 20 - 1))
+            count %= 20
+        if count > 1 or (count == 1 and prefix):
+            prefix.append(chr(ord("G") + count - 1))
+        return "".join(prefix) + char
+
+    def _zpl_compress(self, bits, row_bytes):
+        """ZPL ASCII compression: runs, ',' for a zero-filled tail, ':' for a repeated row"""
+        rows, previous = [], None
+        for start in range(0, len(bits), row_bytes):
+            row = bits[start:start + row_bytes].hex().upper()
+            if row == previous:
+                rows.append(":")
+                continue
+            previous = row
+            stripped = row.rstrip("0")
+            encoded = [self._zpl_repeat(len(run.group(0)), run.group(1))
+                       for run in re.finditer(r"(.)\1*", stripped)]
+            rows.append("".join(encoded) + ("," if len(stripped) < len(row) else ""))
+        return "".join(rows)
+
+    def encode_zpl(self, labels):
+        width, height = self.size
+        row_bytes = (width + 7) // 8
+        total = row_bytes * height
+        chunks = []
+        for label in labels:
+            data = self._zpl_compress(self._black_bits(label), row_bytes)
+            chunks.append(f"^XA^PW{width}^LL{height}^FO0,0^GFA,{total},{total},{row_bytes},{data}^FS^XZ\n")
+        return "".join(chunks).encode("ascii")
+
+    def encode_escpos(self, labels):
+        width, height = self.size
+        row_bytes = (width + 7) // 8
+        header = b"\x1dv0\x00" + bytes((row_bytes & 0xFF, row_bytes >> 8, height & 0xFF, height >> 8))
+        parts = [b"\x1b@"]
+        for label in labels:
+            # Raster image, then feed and partial cut
+            parts.extend((header, self._black_bits(label), b"\n\x1dVB\x00"))
+        return b"".join(parts)
+
+    def encode_sheet(self, labels, path):
+        """Lay labels out on A4 pages and save them as one PDF"""
+        page_w, page_h = (int(round(mm_ * self.dpi / 25.4)) for mm_ in (210, 297))
+        width, height = self.size
+        gap = self.dpi // 10
+        columns = max(1, (page_w - gap) // (width + gap))
+        rows = max(1, (page_h - gap) // (height + gap))
+        pages = []
+        for start in range(0, len(labels), columns * rows):
+            page = Image.new("1", (page_w, page_h), 1)
+            for index, label in enumerate(labels[start:start + columns * rows]):
+                row, column = divmod(index, columns)
+                page.paste(label, (gap + column * (width + gap), gap + row * (height + gap)))
+            pages.append(page)
+        pages[0].save(path, "PDF", resolution=self.dpi, save_all=True, append_images=pages[1:])
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._worker, name="label-spooler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None and self._thread.is_alive():
+            self.jobs.put(None)
+            self._thread.join(timeout=10)
+
+    def submit(self, items, fmt="zpl", copies=1):
+        """Queue labels for `items` (Item records); returns the job id"""
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Unknown label format: {fmt}")
+        job_id = f"{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:6]}"
+        self.jobs.put({'id': job_id, 'items': list(items), 'format': fmt, 'copies': copies})
+        self.start()
+        return job_id
+
+    def run_job(self, job):
+        """Render and spool one job; returns (spool path, label count)"""
+        labels = []
+        for item in job['items']:
+            stamp = f"{item.last_updated}|{item.version}|{self.dpi}|{self.size}"
+            labels.extend([self.cache.get('label', item.id, stamp, item)] * job['copies'])
+        if not labels:
+            raise ValueError("No labels to print")
+        
+        path = self.spool_dir / f"job_{job['id']}{self.FORMATS[job['format']]}"
+        staging = path.with_suffix(path.suffix + ".part")
+        if job['format'] == 'sheet':
+            self.encode_sheet(labels, staging)
+        else:
+            encode = self.encode_zpl if job['format'] == 'zpl' else self.encode_escpos
+            staging.write_bytes(encode(labels))
+        # Printers polling the spool directory only ever see complete files
+        os.replace(staging, path)
+        if self.printer is not None:
+            self.printer.send(path, len(labels))
+        return path, len(labels)
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            started = time.perf_counter()
+            try:
+                path, count = self.run_job(job)
+                self.results.put({'job': job['id'], 'path': str(path), 'labels': count,
+                                  'seconds': time.perf_counter() - started})
+            except Exception as e:
+                self.results.put({'job': job['id'], 'error': str(e)})
+
+# Stand-in for a networked label printer
+class SimulatedLabelPrinter:
+    def __init__(self, labels_per_minute=600):
+        self.labels_per_minute = labels_per_minute
+        self.printed = 0
+        self.received = []
+
+    def send(self, path, label_count):
+        time.sleep(label_count * 60 / self.labels_per_minute)
+        self.received.append(Path(path).name)
+        self.printed += label_count
+
+# Page-level differential backups, compressed and optionally encrypted
+class IncrementalBackup:
+    """Write the database as full snapshots plus page-level deltas.
+    
+    A consistent copy is taken with SQLite's online backup API and read
+    one page at a time. A full archive stores every page; a delta stores
+    only the pages whose hash differs from its full snapshot, so any point
+    in time is restored from two archives. Pages are written in frames of
+    `FRAME_PAGES`, each compressed on its own with zstd when `zstandard`
+    is installed or gzip otherwise and, when a passphrase is given,
+    encrypted as its own Fernet token under a passphrase-derived key.
+    Backup, restore and verify therefore hold one frame at a time (plus
+    the page-hash manifest) rather than the whole database. The JSON
+    header is written last and keeps SHA-256 checksums of the manifest
+    and page frames and of the rebuilt database, which `verify` checks
+    without writing anything.
+    """
+    MAGIC = b"LABBAK2\n"
+    SUFFIX = ".lbk"
+    KDF_ITERATIONS = 390000
+    FRAME_PAGES = 256
+    
+    def __init__(self, backup_dir, keep_full=3, delta_ratio=0.5, full_every_days=7):
+        self.backup_dir = Path(backup_dir)
+        self.keep_full = keep_full
+        self.delta_ratio = delta_ratio
+        self.full_every_days = full_every_days
+
+    # Codecs
+
+    @staticmethod
+    def _compressor():
+        try:
+            import zstandard
+            return "zstd", zstandard.ZstdCompressor(level=10).compress
+        except ImportError:
+            import gzip
+            return "gzip", lambda data: gzip.compress(data, compresslevel=6)
+
+    @staticmethod
+    def _decompress(method, data):
+        if method == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("This backup is zstd-compressed; install the zstandard package to read it")
+            return zstandard.ZstdDecompressor().decompress(data)
+        import gzip
+        return gzip.decompress(data)
+
+    @classmethod
+    def _fernet(cls, passphrase, salt):
+        try:
+            import base64
+            from cryptography.fernet import Fernet
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+        except ImportError:
+            raise RuntimeError("Encrypted backups need the cryptography package")
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=cls.KDF_ITERATIONS)
+        return Fernet(base64.urlsafe_b64encode(kdf.derive(passphrase.encode("utf-8"))))
+
+    def _frame_decoder(self, header, passphrase):
+        """Function turning one stored frame back into its plain bytes"""
+        fernet = None
+        if header['encrypted']:
+            if not passphrase:
+                raise ValueError(f"{header['name']} is encrypted; a passphrase is required")
+            fernet = self._fernet(passphrase, bytes.fromhex(header['salt']))
+        
+        def decode(frame):
+            if fernet is not None:
+                from cryptography.fernet import InvalidToken
+                try:
+                    frame = fernet.decrypt(frame)
+                except InvalidToken:
+                    raise ValueError(f"{header['name']}: wrong passphrase")
+            return self._decompress(header['compression'], frame)
+        return decode
+
+    # Archive files
+
+    def archives(self):
+        """Headers of every archive, oldest first, each with its 'path'"""
+        headers = []
+        for path in sorted(self.backup_dir.glob(f"*{self.SUFFIX}")):
+            try:
+                header = self.read_header(path)
+            except (OSError, ValueError):
+                continue
+            header['path'] = path
+            headers.append(header)
+        return sorted(headers, key=lambda h: (h['created'], h['name']))
+
+    def read_header(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f"{Path(path).name} is not a lab backup archive")
+            f.seek(-4, os.SEEK_END)
+            length = int.from_bytes(f.read(4), 'big')
+            f.seek(-4 - length, os.SEEK_END)
+            return json.loads(f.read(length).decode("utf-8"))
+
+    def _frames(self, header, section):
+        """Stored frames of the 'manifest' or 'pages' section, one at a time"""
+        with open(header['path'], 'rb') as f:
+            f.seek(header[f'{section}_offset'])
+            while True:
+                length = int.from_bytes(f.read(8), 'big')
+                if not length:
+                    return
+                frame = f.read(length)
+                if len(frame) != length:
+                    raise ValueError(f"{header['name']} is truncated")
+                yield frame
+
+    def _check_stored(self, header, sections=('manifest', 'pages')):
+        for section in sections:
+            digest = hashlib.sha256()
+            for frame in self._frames(header, section):
+                digest.update(frame)
+            if digest.hexdigest() != header[f'{section}_sha256']:
+                raise ValueError(f"{header['name']}: stored data does not match its checksum")
+
+    def _manifest(self, header, passphrase):
+        """Page hashes of one archive"""
+        decode = self._frame_decoder(header, passphrase)
+        manifest = b"".join(decode(frame) for frame in self._frames(header, 'manifest'))
+        return [manifest[i:i + 16] for i in range(0, len(manifest), 16)]
+
+    def _pages(self, header, passphrase):
+        """(page number, page bytes) stored in one archive, one frame at a time"""
+        decode = self._frame_decoder(header, passphrase)
+        record = 4 + header['page_size']
+        for frame in self._frames(header, 'pages'):
+            data = decode(frame)
+            for i in range(0, len(data), record):
+                yield int.from_bytes(data[i:i + 4], 'big'), data[i + 4:i + record]
+
+    # Backup
+
+    def backup(self, conn, passphrase=None, force_full=False):
+        """Archive the database behind `conn`; returns the new archive's header"""
+        self.backup_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snapshot_path = Path(temp_dir) / "snapshot.db"
+            snapshot = sqlite3.connect(str(snapshot_path))
+            try:
+                conn.backup(snapshot)
+            finally:
+                snapshot.close()
+            with open(snapshot_path, 'rb') as db:
+                header = self._write_archive(db, passphrase, force_full)
+        self.prune()
+        return header
+
+    def _write_archive(self, db, passphrase, force_full):
+        page_size = int.from_bytes(db.read(18)[16:18], 'big')
+        page_size = 65536 if page_size == 1 else page_size
+        db.seek(0)
+        db_digest = hashlib.sha256()
+        hashes = []
+        for page in iter(lambda: db.read(page_size), b""):
+            db_digest.update(page)
+            hashes.append(hashlib.blake2b(page, digest_size=16).digest())
+        
+        base = None if force_full else self._base_for_delta(passphrase)
+        if base is not None:
+            base_header, base_hashes = base
+            changed = [n for n, digest in enumerate(hashes)
+                       if n >= len(base_hashes) or base_hashes[n] != digest]
+            # Once a delta approaches the size of a full snapshot, start a new chain
+            if len(changed) > self.delta_ratio * len(hashes) or base_header['page_size'] != page_size:
+                base = None
+        if base is None:
+            changed = range(len(hashes))
+        
+        created = datetime.now()
+        kind = "full" if base is None else "delta"
+        name = f"lab_inventory_{created:%Y%m%d_%H%M%S_%f}_{kind}"
+        header = {
+            'format': 2,
+            'name': name,
+            'kind': kind,
+            'base': None if base is None else base[0]['name'],
+            'created': created.isoformat(),
+            'page_size': page_size,
+            'page_count': len(hashes),
+            'pages_stored': len(changed),
+            'db_sha256': db_digest.hexdigest(),
+            'encrypted': bool(passphrase),
+            'salt': os.urandom(16).hex() if passphrase else None,
+        }
+        method, compress = self._compressor()
+        header['compression'] = method
+        fernet = self._fernet(passphrase, bytes.fromhex(header['salt'])) if passphrase else None
+        
+        def page_records():
+            for start in range(0, len(changed), self.FRAME_PAGES):
+                records = []
+                for n in changed[start:start + self.FRAME_PAGES]:
+                    db.seek(n * page_size)
+                    records.append(n.to_bytes(4, 'big') + db.read(page_size))
+                yield b"".join(records)
+        sections = {
+            'manifest': (b"".join(hashes[i:i + 4096]) for i in range(0, len(hashes), 4096)),
+            'pages': page_records(),
+        }
+        
+        path = self.backup_dir / f"{name}{self.SUFFIX}"
+        partial = path.with_suffix(".part")
+        try:
+            with open(partial, 'wb') as f:
+                f.write(self.MAGIC)
+                for section, chunks in sections.items():
+                    header[f'{section}_offset'] = f.tell()
+                    digest = hashlib.sha256()
+                    for chunk in chunks:
+                        frame = compress(chunk)
+                        if fernet is not None:
+                            frame = fernet.encrypt(frame)
+                        digest.update(frame)
+                        f.write(len(frame).to_bytes(8, 'big') + frame)
+                    f.write((0).to_bytes(8, 'big'))
+                    header[f'{section}_sha256'] = digest.hexdigest()
+                encoded = json.dumps(header).encode("utf-8")
+                f.write(encoded + len(encoded).to_bytes(4, 'big'))
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        os.replace(partial, path)
+        header['path'] = path
+        header['stored_bytes'] = path.stat().st_size
+        return header
+
+    def _base_for_delta(self, passphrase):
+        """(header, page hashes) of the newest full snapshot a delta may build on, or None"""
+        fulls = [h for h in self.archives() if h['kind'] == 'full']
+        if not fulls:
+            return None
+        latest = fulls[-1]
+        age = datetime.now() - datetime.fromisoformat(latest['created'])
+        # Deltas of one chain share the full's key, so a change of passphrase starts a new chain
+        if age > timedelta(days=self.full_every_days) or latest['encrypted'] != bool(passphrase):
+            return None
+        try:
+            self._check_stored(latest, ('manifest',))
+            return latest, self._manifest(latest, passphrase)
+        except ValueError:
+            return None
+
+    def prune(self):
+        """Keep the newest `keep_full` chains; returns the number of archives removed"""
+        archives = self.archives()
+        fulls = [h['name'] for h in archives if h['kind'] == 'full']
+        keep = set(fulls[-self.keep_full:]) if self.keep_full else set(fulls)
+        removed = 0
+        for header in archives:
+            chain = header['name'] if header['kind'] == 'full' else header['base']
+            if chain not in keep:
+                header['path'].unlink()
+                removed += 1
+        return removed
+
+    # Restore and verify
+
+    def _chain(self, name):
+        by_name = {h['name']: h for h in self.archives()}
+        if name not in by_name:
+            raise ValueError(f"Backup {name} not found")
+        header = by_name[name]
+        if header['kind'] == 'full':
+            return None, header
+        if header['base'] not in by_name:
+            raise ValueError(f"{name}: its full snapshot {header['base']} is missing")
+        return by_name[header['base']], header
+
+    def restore(self, name, destination, passphrase=None):
+        """Rebuild the database as of archive `name` into `destination`"""
+        base, target = self._chain(name)
+        destination = Path(destination)
+        partial = destination.with_name(destination.name + ".part")
+        page_size = target['page_size']
+        try:
+            with open(partial, 'wb') as f:
+                for header in (base, target):
+                    if header is None:
+                        continue
+                    self._check_stored(header)
+                    for number, page in self._pages(header, passphrase):
+                        f.seek(number * page_size)
+                        f.write(page)
+                f.truncate(target['page_count'] * page_size)
+            digest = hashlib.sha256()
+            with open(partial, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            if digest.hexdigest() != target['db_sha256']:
+                raise ValueError(f"{name}: restored database does not match the recorded checksum")
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        os.replace(partial, destination)
+        return destination
+
+    def verify(self, passphrase=None):
+        """[(name, error or None)] for every archive, without restoring anything.
+        
+        Checksums are always checked. With the passphrase (or for
+        unencrypted archives) every stored page is also checked against
+        its manifest hash, and deltas against their full snapshot.
+        """
+        results = []
+        for header in self.archives():
+            try:
+                self._check_stored(header)
+                if header['kind'] == 'delta':
+                    self._chain(header['name'])
+                if header['encrypted'] and not passphrase:
+                    results.append((header['name'], None))
+                    continue
+                hashes = self._manifest(header, passphrase)
+                if len(hashes) != header['page_count']:
+                    raise ValueError("page counts do not match the header")
+                stored = 0
+                for number, page in self._pages(header, passphrase):
+                    if number >= len(hashes) or hashlib.blake2b(page, digest_size=16).digest() != hashes[number]:
+                        raise ValueError(f"page {number} is corrupt")
+                    stored += 1
+                if stored != header['pages_stored']:
+                    raise ValueError("page counts do not match the header")
+                results.append((header['name'], None))
+            except Exception as e:
+                results.append((header['name'], str(e)))
+        return results
+
+# Integrity checks, batch repair and planner statistics upkeep
+class DatabaseMaintenance:
+    """Find and repair data that breaks the views, and keep statistics fresh.
+    
+    `check` runs SQLite's `quick_check`, the declared foreign keys (which
+    are only enforced by connections that turn them on) and set-based scans
+    for malformed dates and timestamps, impossible quantities and drifted
+    derived state. `repair` fixes everything it can in one transaction:
+    rows pointing at missing items get a soft-deleted placeholder item so
+    their history is kept, unparseable values are cleared with the original
+    text appended to `notes`, and derived tables are recomputed. Checks
+    without a `_repair_` method (stock that disagrees with its lots) are
+    only reported, since either side may be the one that is wrong. ANALYZE
+    and VACUUM are tracked in `app_meta` and run by `run_due`.
+    """
+    CHECKS = {
+        'quick_check': "Database structure 数据库结构",
+        'foreign_keys': "Missing referenced rows 引用缺失",
+        'lot_allocations': "Orphaned lot allocations 孤立批次分配",
+        'item_dates': "Malformed item dates 物品日期格式错误",
+        'timestamps': "Malformed timestamps 时间戳格式错误",
+        'quantities': "Invalid quantities 数量无效",
+        'lot_totals': "Quantity differs from lots (report only) 数量与批次合计不符(仅报告)",
+        'location_links': "Stale location links 位置关联过期",
+        'location_stats': "Location counts out of date 位置统计过期",
+    }
+    # Checks on tables that a database not yet opened by this version lacks
+    CHECK_TABLES = {
+        'lot_allocations': ("usage_lot_allocations", "item_lots"),
+        'lot_totals': ("item_lots",),
+        'location_links': ("locations",),
+        'location_stats': ("locations", "location_closure", "location_stats"),
+    }
+    # TIMESTAMP columns go through the datetime converter on every read
+    TIMESTAMP_COLUMNS = (("usage_log", "timestamp"), ("usage_log", "return_time"), ("items", "last_updated"))
+    PLACEHOLDER_NAME = "Missing item 缺失物品"
+    ANALYZE_EVERY_DAYS = 7
+    VACUUM_EVERY_DAYS = 30
+    VACUUM_FREE_RATIO = 0.2
+    SAMPLE_SIZE = 5
+    
+    def __init__(self, conn):
+        self.conn = conn
+
+    @staticmethod
+    def _bad_date(column):
+        return (f"({column} IS NOT NULL AND {column} != '' AND "
+                f"(typeof({column}) != 'text' "
+                f"OR {column} NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' "
+                f"OR date({column}, '+0 days') IS NOT {column}))")
+
+    @staticmethod
+    def _bad_timestamp(column):
+        return (f"({column} IS NOT NULL AND "
+                f"(typeof({column}) != 'text' "
+                f"OR {column} NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*' "
+                f"OR datetime({column}) IS NULL "
+                f"OR date({column}, '+0 days') IS NOT substr({column}, 1, 10)))")
+
+    @staticmethod
+    def _lot_total(alias):
+        return f"(SELECT SUM(quantity) FROM item_lots WHERE item_id = {alias}.id)"
+
+    @staticmethod
+    def _bad_quantity(alias):
+        return f"(typeof({alias}.quantity) NOT IN ('integer', 'null') OR {alias}.quantity < 0)"
+
+    def _actual_location_stats(self):
+        return f"""
+            SELECT l.id AS location_id, COUNT(i.id) AS item_count,
+                   COALESCE(SUM({LocationHierarchy._hazardous('i')}), 0) AS hazardous_count
+            FROM locations l
+            LEFT JOIN location_closure c ON c.ancestor_id = l.id
+            LEFT JOIN items i ON i.location_id = c.descendant_id AND i.deleted_at IS NULL
+            GROUP BY l.id
+        """
+
+    def _items_foreign_keys(self):
+        """(table, column) pairs declared as referencing items.id"""
+        pairs = []
+        for (table,) in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+            for row in self.conn.execute(f"PRAGMA foreign_key_list({table})"):
+                if row[2] == "items":
+                    pairs.append((table, row[3]))
+        return pairs
+
+    # Checks
+
+    def _find_quick_check(self):
+        messages = [row[0] for row in self.conn.execute("PRAGMA quick_check")]
+        return [] if messages == ["ok"] else messages
+
+    def _find_foreign_keys(self):
+        return [f"{table} row {rowid} -> {parent}"
+                for table, rowid, parent, _ in self.conn.execute("PRAGMA foreign_key_check")]
+
+    def _find_lot_allocations(self):
+        return [f"usage {usage_id} / lot {lot_id}" for usage_id, lot_id in self.conn.execute("""
+            SELECT usage_id, lot_id FROM usage_lot_allocations a
+            WHERE NOT EXISTS (SELECT 1 FROM usage_log u WHERE u.id = a.usage_id)
+               OR NOT EXISTS (SELECT 1 FROM item_lots l WHERE l.id = a.lot_id)
+        """)]
+
+    def _find_item_dates(self):
+        found = []
+        for field in ITEM_DATE_FIELDS:
+            found.extend(f"{item_id}: {field} = {value!r}" for item_id, value in self.conn.execute(
+                f"SELECT id, {field} FROM items WHERE {self._bad_date(field)}"))
+        return found
+
+    def _find_timestamps(self):
+        found = []
+        for table, column in self.TIMESTAMP_COLUMNS:
+            # CAST keeps the converter away from the bad values
+            found.extend(f"{table} {key}: {column} = {value!r}" for key, value in self.conn.execute(
+                f"SELECT id, CAST({column} AS TEXT) FROM {table} WHERE {self._bad_timestamp(column)}"))
+        return found
+
+    def _find_quantities(self):
+        return [f"{item_id}: {quantity!r}" for item_id, quantity in self.conn.execute(
+            f"SELECT id, quantity FROM items i WHERE {self._bad_quantity('i')}")]
+
+    def _find_lot_totals(self):
+        return [f"{item_id}: {quantity!r} (lots {lots})" for item_id, quantity, lots in self.conn.execute(f"""
+            SELECT id, quantity, lots FROM (SELECT id, quantity, {self._lot_total('i')} AS lots FROM items i)
+            WHERE lots IS NOT NULL AND quantity IS NOT lots
+        """)]
+
+    def _find_location_links(self):
+        return [f"{item_id}: {location!r}" for item_id, location in self.conn.execute("""
+            SELECT id, location FROM items
+            WHERE location_id IS NOT (SELECT l.id FROM locations l WHERE l.path = items.location)
+        """)]
+
+    def _find_location_stats(self):
+        stored = "SELECT location_id, item_count, hazardous_count FROM location_stats"
+        actual = self._actual_location_stats()
+        return [f"location {location_id}" for (location_id,) in self.conn.execute(f"""
+            SELECT location_id FROM ({actual} EXCEPT {stored})
+            UNION
+            SELECT location_id FROM ({stored} EXCEPT {actual})
+        """)]
+
+    def applicable_checks(self):
+        tables = {name for (name,) in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        return [key for key in self.CHECKS if set(self.CHECK_TABLES.get(key, ())) <= tables]
+
+    def check(self):
+        """[(key, label, problem count, sample descriptions)] for every applicable check"""
+        results = []
+        for key in self.applicable_checks():
+            label = self.CHECKS[key]
+            found = getattr(self, f"_find_{key}")()
+            results.append((key, label, len(found), found[:self.SAMPLE_SIZE]))
+        return results
+
+    # Repairs
+
+    @staticmethod
+    def _parse_loose_timestamp(value):
+        text = str(value).strip()
+        try:
+            return datetime.fromisoformat(text.replace("Z", "").replace("/", "-"))
+        except ValueError:
+            pass
+        for fmt in DATE_INPUT_FORMATS:
+            for suffix in (" %H:%M:%S", " %H:%M", ""):
+                try:
+                    return datetime.strptime(text, fmt + suffix)
+                except ValueError:
+                    continue
+        try:
+            # Unix epoch seconds written by other tools
+            return datetime.fromtimestamp(float(text))
+        except (ValueError, OverflowError, OSError):
+            return None
+
+    def _repair_quick_check(self):
+        self.conn.execute("REINDEX")
+
+    def _repair_foreign_keys(self):
+        now = datetime.now().isoformat()
+        for table, column in self._items_foreign_keys():
+            self.conn.execute(f"""
+                INSERT INTO items (id, name, item_type, quantity, last_updated, deleted_at, notes)
+                SELECT DISTINCT t.{column}, ?, 'other', 0, ?, ?, ?
+                FROM {table} t
+                WHERE t.{column} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM items i WHERE i.id = t.{column})
+            """, (self.PLACEHOLDER_NAME, now, now,
+                  f"Recreated by integrity repair for orphaned {table} rows 因孤立记录重建"))
+        # Anything else dangling has no history worth keeping; the location tree is left for the user
+        for table, rowid, parent, _ in self.conn.execute("PRAGMA foreign_key_check").fetchall():
+            if table != "locations" and rowid is not None:
+                self.conn.execute(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+
+    def _repair_lot_allocations(self):
+        self.conn.execute("""
+            DELETE FROM usage_lot_allocations
+            WHERE NOT EXISTS (SELECT 1 FROM usage_log u WHERE u.id = usage_lot_allocations.usage_id)
+               OR NOT EXISTS (SELECT 1 FROM item_lots l WHERE l.id = usage_lot_allocations.lot_id)
+        """)
+
+    def _append_note(self, table, key, note):
+        self.conn.execute(f"""
+            UPDATE {table} SET notes = CASE WHEN IFNULL(notes, '') = '' THEN ? ELSE notes || char(10) || ? END
+            WHERE id = ?
+        """, (note, note, key))
+
+    def _repair_item_dates(self):
+        for field in ITEM_DATE_FIELDS:
+            rows = self.conn.execute(f"SELECT id, {field} FROM items WHERE {self._bad_date(field)}").fetchall()
+            for item_id, value in rows:
+                try:
+                    fixed = normalize_date(value) or None
+                except ValueError:
+                    fixed = None
+                    self._append_note("items", item_id, f"Invalid {field} removed 无效日期已清除: {value}")
+                self.conn.execute(f"UPDATE items SET {field} = ? WHERE id = ?", (fixed, item_id))
+
+    def _repair_timestamps(self):
+        for table, column in self.TIMESTAMP_COLUMNS:
+            rows = self.conn.execute(f"""
+                SELECT id, CAST({column} AS TEXT), CAST(timestamp AS TEXT) FROM {table}
+                WHERE {self._bad_timestamp(column)}
+            """ if table == "usage_log" else f"""
+                SELECT id, CAST({column} AS TEXT), NULL FROM {table} WHERE {self._bad_timestamp(column)}
+            """).fetchall()
+            for key, value, logged_at in rows:
+                fixed = self._parse_loose_timestamp(value)
+                if fixed is None:
+                    self._append_note(table, key, f"Invalid {column} replaced 无效时间已替换: {value}")
+                    if column == "return_time":
+                        # Still a closed loan; the check-out time is the best bound available
+                        fixed = self._parse_loose_timestamp(logged_at) or datetime.now()
+                    elif column == "last_updated":
+                        fixed = datetime.now()
+                # Stored as text so headless connections without the app's adapter write the same form
+                self.conn.execute(f"UPDATE {table} SET {column} = ? WHERE id = ?",
+                                  (fixed.isoformat() if fixed else None, key))
+
+    def _repair_quantities(self):
+        # Keep the whole, non-negative part and note what was there before
+        rows = self.conn.execute(f"""
+            SELECT id, CAST(quantity AS TEXT),
+                   MAX(0, CAST(CASE WHEN typeof(quantity) IN ('integer', 'real') THEN quantity
+                                    ELSE CAST(quantity AS REAL) END AS INTEGER))
+            FROM items WHERE {self._bad_quantity('items')}
+        """).fetchall()
+        for item_id, value, fixed in rows:
+            self._append_note("items", item_id, f"Invalid quantity replaced 无效数量已替换: {value}")
+            self.conn.execute("UPDATE items SET quantity = ? WHERE id = ?", (fixed, item_id))
+
+    def _repair_location_links(self):
+        self.conn.execute("""
+            UPDATE items SET location_id = (SELECT l.id FROM locations l WHERE l.path = items.location)
+            WHERE location_id IS NOT (SELECT l.id FROM locations l WHERE l.path = items.location)
+        """)
+
+    def _repair_location_stats(self):
+        LocationHierarchy(self.conn).rebuild_stats()
+
+    def repair(self, keys=None):
+        """Repair the given checks (all by default) in one transaction; returns check() afterwards"""
+        keys = [key for key in self.applicable_checks() if keys is None or key in keys]
+        try:
+            for key in keys:
+                repair = getattr(self, f"_repair_{key}", None)
+                if repair is not None and getattr(self, f"_find_{key}")():
+                    repair()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return self.check()
+
+    # Statistics and free space
+
+    def _last_run(self, task):
+        row = self.conn.execute("SELECT value FROM app_meta WHERE key = ?", (f"last_{task}",)).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def _record_run(self, task):
+        self.conn.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?)",
+                          (f"last_{task}", datetime.now().isoformat()))
+        self.conn.commit()
+
+    def free_ratio(self):
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return free_pages / page_count if page_count else 0.0
+
+    def due_tasks(self):
+        """Subset of ('analyze', 'vacuum') that is due now"""
+        now = datetime.now()
+        due = []
+        last_analyze = self._last_run("analyze")
+        if last_analyze is None or now - last_analyze > timedelta(days=self.ANALYZE_EVERY_DAYS):
+            due.append("analyze")
+        free_ratio = self.free_ratio()
+        last_vacuum = self._last_run("vacuum")
+        if free_ratio >= self.VACUUM_FREE_RATIO or (
+                free_ratio > 0 and (last_vacuum is None or now - last_vacuum > timedelta(days=self.VACUUM_EVERY_DAYS))):
+            due.append("vacuum")
+        return due
+
+    def analyze(self):
+        self.conn.execute("ANALYZE")
+        self._record_run("analyze")
+
+    def vacuum(self):
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+        self._record_run("vacuum")
+
+    def run_due(self):
+        """Run whatever is due plus the cheap `PRAGMA optimize`; returns the tasks run"""
+        due = self.due_tasks()
+        for task in due:
+            getattr(self, task)()
+        self.conn.execute("PRAGMA optimize")
+        return due
+
+# Users, roles and the check-out approval queue
+class AccessDenied(Exception):
+    """Raised when the signed-in role lacks a permission"""
+    def __init__(self, permission, role):
+        super().__init__(f"Role '{role}' lacks permission: {AccessControl.PERMISSIONS.get(permission, permission)}")
+        self.permission = permission
+        self.role = role
+
+@dataclass
+class Session:
+    """The signed-in user; `permissions` is resolved once at sign-in"""
+    __slots__ = ("username", "display_name", "role", "permissions")
+    username: str
+    display_name: str
+    role: str
+    permissions: frozenset
+
+    def can(self, permission):
+        return permission in self.permissions
+
+    def require(self, permission):
+        if permission not in self.permissions:
+            raise AccessDenied(permission, self.role)
+
+class AccessControl:
+    """Accounts with PBKDF2-hashed passwords, role permissions and approvals.
+    
+    A role is a named set of permissions in `role_permissions`; a
+    session's set is resolved once at sign-in (and cached per role), so
+    a check is a frozenset lookup. Check-outs by users who may not
+    approve them are queued in `usage_requests` without touching stock;
+    a supervisor approves a batch in one transaction, which books the
+    stock and the `usage_log` rows with the approver's name.
+    """
+    PERMISSIONS = {
+        'inventory.view': "View inventory and reports 查看库存与报表",
+        'item.add': "Add items 添加物品",
+        'item.edit': "Edit items 编辑物品",
+        'item.delete': "Delete items 删除物品",
+        'usage.add': "Record usage 记录使用",
+        'usage.approve': "Approve check-outs 批准领用",
+        'users.manage': "Manage users and roles 管理用户与角色",
+        'loans.check_in': "Check in loans 归还借用",
+        'stock.receive': "Receive stock and purchase orders 入库与采购订单",
+        'locations.manage': "Manage storage locations 管理存放位置",
+        'alerts.manage': "Manage alert rules 管理警报规则",
+        'bulk.undo': "Undo bulk edits 撤销批量编辑",
+        'database.admin': "Sync, repair and restore the database 同步、修复与恢复数据库",
+        'services.manage': "Start and stop the scanner and API services 启停扫描与接口服务",
+    }
+    DEFAULT_ROLES = {
+        'viewer': ("Read-only access 只读", ('inventory.view',)),
+        'technician': ("Day-to-day stock handling 日常库存操作",
+                       ('inventory.view', 'item.add', 'item.edit', 'usage.add', 'loans.check_in',
+                        'stock.receive')),
+        'supervisor': ("Approvals and administration 审批与管理", tuple(PERMISSIONS)),
+    }
+    # Permissions that databases created before `permission_catalog` were already seeded with
+    CATALOGUED_BEFORE = ('item.add', 'item.edit', 'item.delete', 'usage.add', 'usage.approve', 'users.manage')
+    HASH_ITERATIONS = 260000
+    MIN_PASSWORD_LENGTH = 8
+    
+    def __init__(self, conn):
+        self.conn = conn
+        self._role_permissions = {}
+
+    @classmethod
+    def install(cls, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS roles (
+                name TEXT PRIMARY KEY,
+                description TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS role_permissions (
+                role TEXT NOT NULL REFERENCES roles (name) ON DELETE CASCADE,
+                permission TEXT NOT NULL,
+                PRIMARY KEY (role, permission)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY COLLATE NOCASE,
+                display_name TEXT,
+                role TEXT NOT NULL REFERENCES roles (name),
+                password_hash TEXT NOT NULL,
+                active INTEGER NOT NULL DEFAULT 1,
+                created_at TEXT NOT NULL,
+                last_login TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id TEXT NOT NULL REFERENCES items (id),
+                user TEXT NOT NULL,
+                user_department TEXT,
+                quantity INTEGER NOT NULL CHECK (quantity > 0),
+                purpose TEXT,
+                notes TEXT,
+                returnable INTEGER NOT NULL DEFAULT 0,
+                requested_by TEXT NOT NULL,
+                requested_at TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'approved', 'rejected')),
+                decided_by TEXT,
+                decided_at TEXT,
+                usage_id INTEGER
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_requests_pending
+            ON usage_requests (requested_at) WHERE status = 'pending'
+        """)
+        # Permissions already granted to the default roles once, so administrator edits stick
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS permission_catalog (
+                permission TEXT PRIMARY KEY
+            ) WITHOUT ROWID
+        """)
+        # Seed the defaults once; later edits to the roles are the administrator's
+        if conn.execute("SELECT 1 FROM roles LIMIT 1").fetchone() is None:
+            for role, (description, permissions) in cls.DEFAULT_ROLES.items():
+                conn.execute("INSERT INTO roles (name, description) VALUES (?, ?)", (role, description))
+                conn.executemany("INSERT INTO role_permissions (role, permission) VALUES (?, ?)",
+                                 [(role, permission) for permission in permissions])
+        else:
+            seeded = {permission for (permission,) in conn.execute("SELECT permission FROM permission_catalog")}
+            seeded = seeded or set(cls.CATALOGUED_BEFORE)
+            # Permissions added since the roles were seeded go to the default roles that still exist
+            conn.executemany("""
+                INSERT OR IGNORE INTO role_permissions (role, permission)
+                SELECT name, ? FROM roles WHERE name = ?
+            """, [(permission, role) for role, (_, permissions) in cls.DEFAULT_ROLES.items()
+                  for permission in permissions if permission not in seeded])
+        conn.executemany("INSERT OR IGNORE INTO permission_catalog (permission) VALUES (?)",
+                         [(permission,) for permission in cls.PERMISSIONS])
+
+    # Credentials
+
+    @classmethod
+    def hash_password(cls, password, salt=None, iterations=None):
+        """'pbkdf2_sha256$iterations$salt$hash' for `password`"""
+        salt = salt or os.urandom(16)
+        iterations = iterations or cls.HASH_ITERATIONS
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+        return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+    @classmethod
+    def verify_password(cls, password, stored):
+        try:
+            algorithm, iterations, salt, _ = stored.split("$")
+        except (AttributeError, ValueError):
+            return False
+        if algorithm != "pbkdf2_sha256":
+            return False
+        return hmac.compare_digest(cls.hash_password(password, bytes.fromhex(salt), int(iterations)), stored)
+
+    def _check_password(self, password):
+        if len(password or "") < self.MIN_PASSWORD_LENGTH:
+            raise ValueError(f"Password must be at least {self.MIN_PASSWORD_LENGTH} characters")
+
+    # Roles and permissions
+
+    def roles(self):
+        return [name for (name,) in self.conn.execute("SELECT name FROM roles ORDER BY name")]
+
+    def permissions(self, role):
+        """The role's permissions as a frozenset, cached until the role is changed"""
+        if role not in self._role_permissions:
+            self._role_permissions[role] = frozenset(permission for (permission,) in self.conn.execute(
+                "SELECT permission FROM role_permissions WHERE role = ?", (role,)))
+        return self._role_permissions[role]
+
+    def set_permissions(self, role, permissions):
+        unknown = set(permissions) - set(self.PERMISSIONS)
+        if unknown:
+            raise ValueError(f"Unknown permission(s): {', '.join(sorted(unknown))}")
+        try:
+            self.conn.execute("INSERT OR IGNORE INTO roles (name) VALUES (?)", (role,))
+            self.conn.execute("DELETE FROM role_permissions WHERE role = ?", (role,))
+            self.conn.executemany("INSERT INTO role_permissions (role, permission) VALUES (?, ?)",
+                                  [(role, permission) for permission in permissions])
+            self._require_administrator()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self._role_permissions.pop(role, None)
+
+    def _require_administrator(self):
+        # Never lock everyone out of user management
+        if self.conn.execute("""
+            SELECT 1 FROM users u JOIN role_permissions p ON p.role = u.role
+            WHERE u.active = 1 AND p.permission = 'users.manage' LIMIT 1
+        """).fetchone() is None and self.user_count():
+            raise ValueError("At least one active user must keep the right to manage users")
+
+    # Accounts
+
+    def user_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def users(self):
+        """(username, display_name, role, active, last_login) by username"""
+        return self.conn.execute("""
+            SELECT username, display_name, role, active, last_login FROM users ORDER BY username
+        """).fetchall()
+
+    def create_user(self, username, password, role, display_name=None):
+        username = (username or "").strip()
+        if not username:
+            raise ValueError("Username is required")
+        if role not in self.roles():
+            raise ValueError(f"Unknown role '{role}'")
+        self._check_password(password)
+        try:
+            self.conn.execute("""
+                INSERT INTO users (username, display_name, role, password_hash, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (username, (display_name or "").strip() or username, role,
+                  self.hash_password(password), datetime.now().isoformat()))
+            self.conn.commit()
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
+            raise ValueError(f"User '{username}' already exists")
+
+    def _update_user(self, username, sql, params):
+        try:
+            if self.conn.execute(f"UPDATE users SET {sql} WHERE username = ?",
+                                 (*params, username)).rowcount == 0:
+                raise ValueError(f"User '{username}' not found")
+            self._require_administrator()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def set_role(self, username, role):
+        if role not in self.roles():
+            raise ValueError(f"Unknown role '{role}'")
+        self._update_user(username, "role = ?", (role,))
+
+    def set_active(self, username, active):
+        self._update_user(username, "active = ?", (1 if active else 0,))
+
+    def set_password(self, username, password):
+        self._check_password(password)
+        self._update_user(username, "password_hash = ?", (self.hash_password(password),))
+
+    def authenticate(self, username, password):
+        """A Session for valid, active credentials, otherwise None"""
+        row = self.conn.execute("""
+            SELECT username, display_name, role, password_hash FROM users WHERE username = ? AND active = 1
+        """, ((username or "").strip(),)).fetchone()
+        # Hash even for unknown users so timing does not reveal which names exist
+        stored = row[3] if row else self.hash_password("", b"\0" * 16)
+        if not self.verify_password(password or "", stored) or row is None:
+            return None
+        self.conn.execute("UPDATE users SET last_login = ? WHERE username = ?",
+                          (datetime.now().isoformat(), row[0]))
+        self.conn.commit()
+        return Session(row[0], row[1] or row[0], row[2], self.permissions(row[2]))
+
+    # Check-out approvals
+
+    def request_checkout(self, session, item_id, user, quantity, user_department="", purpose="", notes="",
+                         returnable=False):
+        """Queue a check-out for approval; returns the request id"""
+        return self.request_checkouts(
+            session, [(item_id, user, quantity, user_department, purpose, notes, returnable)])[0]
+
+    def request_checkouts(self, session, requests, commit=True):
+        """Queue (item_id, user, quantity, user_department, purpose, notes, returnable)
+        check-outs in one transaction; returns the request ids.
+        
+        With `commit=False` the rows join the caller's open transaction.
+        """
+        session.require('usage.add')
+        if any(request[2] <= 0 for request in requests):
+            raise ValueError("Only check-outs (positive quantities) need approval")
+        now = datetime.now().isoformat()
+        try:
+            request_ids = [self.conn.execute("""
+                INSERT INTO usage_requests (item_id, user, user_department, quantity, purpose, notes,
+                                            returnable, requested_by, requested_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (item_id, user, user_department, quantity, purpose, notes, 1 if returnable else 0,
+                  session.username, now)).lastrowid
+                for item_id, user, quantity, user_department, purpose, notes, returnable in requests]
+            if commit:
+                self.conn.commit()
+        except Exception:
+            if commit:
+                self.conn.rollback()
+            raise
+        return request_ids
+
+    def pending(self):
+        """(id, item_id, name, quantity, stock, user, purpose, requested_by, requested_at), oldest first"""
+        return self.conn.execute("""
+            SELECT r.id, r.item_id, i.name, r.quantity, i.quantity, r.user, r.purpose,
+                   r.requested_by, r.requested_at
+            FROM usage_requests r JOIN items i ON i.id = r.item_id
+            WHERE r.status = 'pending'
+            ORDER BY r.requested_at
+        """).fetchall()
+
+    def approve(self, session, request_ids):
+        """Book the requests in one transaction, oldest first.
+        
+        Returns (approved [(request id, usage id)], skipped [(request id,
+        reason)]); requests the stock cannot cover stay pending.
+        """
+        session.require('usage.approve')
+        placeholders = ",".join("?" * len(request_ids))
+        approved, skipped = [], []
+        now = datetime.now()
+        try:
+            rows = self.conn.execute(f"""
+                SELECT r.id, r.item_id, r.user, r.user_department, r.quantity, r.purpose, r.notes,
+                       r.returnable, i.quantity, i.deleted_at
+                FROM usage_requests r JOIN items i ON i.id = r.item_id
+                WHERE r.id IN ({placeholders}) AND r.status = 'pending'
+                ORDER BY r.requested_at, r.id
+            """, list(request_ids)).fetchall()
+            stock = {}
+            for (request_id, item_id, user, department, quantity, purpose, notes,
+                 returnable, item_quantity, deleted_at) in rows:
+                available = stock.get(item_id, item_quantity or 0)
+                if deleted_at is not None:
+                    skipped.append((request_id, "Item was deleted 物品已删除"))
+                    continue
+                if quantity > available:
+                    skipped.append((request_id, f"Only {available} in stock 库存仅 {available}"))
+                    continue
+                stock[item_id] = available - quantity
+                usage_id = self.conn.execute("""
+                    INSERT INTO usage_log (item_id, user, user_department, quantity_changed, timestamp,
+                                           purpose, notes, supervisor_approval, returnable)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (item_id, user, department, quantity, now.isoformat(), purpose, notes,
+                      session.username, returnable)).lastrowid
+                self.conn.execute("""
+                    UPDATE items SET quantity = COALESCE(quantity, 0) - ?, last_updated = ?, version = version + 1
+                    WHERE id = ?
+                """, (quantity, now.isoformat(), item_id))
+                self.conn.execute("""
+                    UPDATE usage_requests SET status = 'approved', decided_by = ?, decided_at = ?, usage_id = ?
+                    WHERE id = ?
+                """, (session.username, now.isoformat(), usage_id, request_id))
+                approved.append((request_id, usage_id))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return approved, skipped
+
+    def reject(self, session, request_ids):
+        """Close the requests without touching stock; returns how many were pending"""
+        session.require('usage.approve')
+        try:
+            rejected = self.conn.executemany("""
+                UPDATE usage_requests SET status = 'rejected', decided_by = ?, decided_at = ?
+                WHERE id = ? AND status = 'pending'
+            """, [(session.username, datetime.now().isoformat(), request_id)
+                  for request_id in request_ids]).rowcount
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return rejected
+
+# Item type and report section registry, extended by plugin manifests
+@dataclass
+class ItemType:
+    """One inventory tab: its `items.item_type` value, label and ID prefix"""
+    __slots__ = ("key", "label", "heading", "prefix", "returnable", "order")
+    key: str
+    label: str
+    heading: str
+    prefix: str
+    returnable: bool
+    order: int
+
+@dataclass
+class ReportSection:
+    """A report section; `render(app, doc, styles)` yields its flowables"""
+    __slots__ = ("name", "title", "order", "render")
+    name: str
+    title: str
+    order: int
+    render: object
+
+class PluginRegistry:
+    """Item types and report sections, built in or declared by plugins.
+    
+    A plugin is a `*.json` manifest in the plugins directory. Its item
+    types are plain declarations, so tabs, ID prefixes and report sections
+    are generated without running plugin code. Report sections name an
+    `entry_point` in the manifest's `module` (a .py file beside it); the
+    module is imported the first time such a section is rendered. Example:
+    
+        {"module": "biosamples.py",
+         "item_types": [{"key": "biological_sample", "label": "Biological Samples 生物样本",
+                         "prefix": "BIO"}],
+         "report_sections": [{"name": "freezer_map", "title": "Freezer Map",
+                              "entry_point": "render_freezer_map"}]}
+    """
+    # Plugin types default to order 100, between the built-in types and "Other"
+    BUILTIN_ITEM_TYPES = (
+        ("equipment", "Equipment 设备", "Equipment Inventory", "EQ", True, 10),
+        ("chemical", "Chemicals 化学品", "Chemicals Inventory", "CHE", False, 20),
+        ("consumable", "Consumables 消耗品", "Consumables Inventory", "CON", False, 30),
+        ("other", "Other 其他", "Other Inventory", "OT", False, 1000),
+    )
+    FALLBACK_TYPE = "other"
+    KEY_PATTERN = re.compile(r"^[a-z][a-z0-9_]*$")
+    
+    def __init__(self, plugin_dir=None):
+        self.plugin_dir = Path(plugin_dir) if plugin_dir else None
+        self._item_types = {}
+        self._sections = {}
+        self._modules = {}
+        self.errors = []
+        for key, label, heading, prefix, returnable, order in self.BUILTIN_ITEM_TYPES:
+            self.register_item_type(key, label, prefix, heading, returnable, order)
+        self.register_report_section("summary", "Inventory Summary",
+                                     lambda app, doc, styles: app.report_summary(), order=0)
+        if self.plugin_dir is not None:
+            self.discover()
+
+    def register_item_type(self, key, label, prefix, heading=None, returnable=False, order=100):
+        if not self.KEY_PATTERN.match(key or ""):
+            raise ValueError(f"Item type key '{key}' must be lower-case letters, digits and underscores")
+        prefix = (prefix or "").strip().upper()
+        if not prefix.isalnum():
+            raise ValueError(f"Item type '{key}' needs an alphanumeric ID prefix")
+        clash = [t.key for t in self._item_types.values() if t.prefix == prefix and t.key != key]
+        if clash:
+            raise ValueError(f"ID prefix '{prefix}' is already used by '{clash[0]}'")
+        self._item_types[key] = ItemType(key, label, heading or f"{label} Inventory", prefix, bool(returnable), order)
+
+    def register_report_section(self, name, title, render, order=100):
+        self._sections[name] = ReportSection(name, title, order, render)
+
+    def discover(self):
+        """Read every manifest; a broken plugin is recorded in `errors` and skipped"""
+        if not self.plugin_dir.is_dir():
+            return
+        for manifest_path in sorted(self.plugin_dir.glob("*.json")):
+            try:
+                manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+                for spec in manifest.get("item_types", []):
+                    self.register_item_type(spec['key'], spec['label'], spec['prefix'], spec.get('heading'),
+                                            spec.get('returnable', False), spec.get('order', 100))
+                module = manifest.get("module")
+                for spec in manifest.get("report_sections", []):
+                    if not module:
+                        raise ValueError("report sections need a 'module'")
+                    self.register_report_section(
+                        spec['name'], spec['title'],
+                        self._lazy_entry_point(manifest_path.parent / module, spec['entry_point']),
+                        spec.get('order', 100))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.errors.append(f"{manifest_path.name}: {e}")
+
+    def _lazy_entry_point(self, module_path, name):
+        def render(app, doc, styles):
+            return getattr(self._import(module_path), name)(app, doc, styles)
+        return render
+
+    def _import(self, module_path):
+        module = self._modules.get(module_path)
+        if module is None:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location(f"lab_plugin_{module_path.stem}", module_path)
+            if spec is None:
+                raise ImportError(f"Cannot load plugin module {module_path}")
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self._modules[module_path] = module
+        return module
+
+    def item_types(self):
+        return sorted(self._item_types.values(), key=lambda t: (t.order, t.key))
+
+    def item_type(self, key):
+        """The declaration for `key`; unknown types are treated as the fallback type"""
+        return self._item_types.get(key) or self._item_types[self.FALLBACK_TYPE]
+
+    def report_sections(self):
+        """Registered sections plus one inventory section per item type, in report order"""
+        sections = list(self._sections.values())
+        for item_type in self.item_types():
+            sections.append(ReportSection(
+                f"inventory:{item_type.key}", item_type.heading, 50,
+                lambda app, doc, styles, key=item_type.key: app.report_inventory_tables(doc, key)))
+        return sorted(sections, key=lambda s: s.order)
+
+# Enhanced Lab Inventory System
+class LabInventorySystem:
+    def __init__(self, root):
+        self.root = root
+        self.root.title("DNA Virology Lab Management System-ICGEB China RRC")
+        self.root.geometry("1200x700")
+        
+        # Setup directories
+        self.base_dir = Path.home() / "DNA_Virology_Lab_System"
+        self.setup_directories()
+        
+        # Initialize database
+        self.init_database()
+        
+        # Initialize calibration/warranty scheduler
+        self.scheduler = CalibrationScheduler(self.conn)
+        self.scheduler.build()
+        
+        # Initialize daily stock snapshots
+        self.snapshots = StockSnapshotStore(self.conn)
+        
+        # Initialize equipment loan tracking
+        self.loans = LoanTracker(self.conn)
+        
+        # Initialize manuals/certificates attachment store
+        self.attachments = AttachmentStore(self.conn, self.dirs['blobs'])
+        
+        # Initialize multi-item edit/delete with undo
+        self.bulk = BulkItemOperations(self.conn)
+        
+        # Initialize item audit trail
+        self.audit = ItemAuditTrail(self.conn)
+        
+        # Initialize low-stock/expiry/calibration alerting
+        self.alerts = AlertEngine(self.conn, self.dirs['data'] / "alerts_outbox.jsonl")
+        self._alerts_due_checked = None
+        
+        # Initialize lot tracking
+        self.lots = LotTracker(self.conn)
+        
+        # Initialize the storage location tree
+        self.locations = LocationHierarchy(self.conn)
+        
+        # Initialize consumption-driven reordering
+        self.reorder_planner = ReorderPlanner(self.conn, self.dirs['exports'] / "purchase_orders")
+        
+        # Initialize incremental backups
+        self.backups = IncrementalBackup(self.dirs['data'] / "backups")
+        
+        # Initialize integrity checks and statistics upkeep
+        self.maintenance = DatabaseMaintenance(self.conn)
+        
+        # Initialize users, roles and check-out approvals
+        self.access = AccessControl(self.conn)
+        
+        # Initialize item types and report sections (plugin code loads on first use)
+        self.plugins = PluginRegistry(self.dirs['plugins'])
+        
+        # Initialize IoT Device
+        self.iot_device = IoTDevice("IoT-001")
+        self.scan_service = None
+        self.api_server = None
+        self.label_spooler = None
+        
+        # Initialize Blockchain
+        self.blockchain = Blockchain()
+        
+        # Initialize AI Assistant
+        self.ai_assistant = AIAssistant()
+        
+        # Initialize memory budget for full-catalog operations
+        self.memory_budget = MemoryBudget(self.load_memory_budget())
+        
+        # Initialize UI language (labels are re-rendered from their bilingual source)
+        self.i18n = MessageCatalog(self.load_language())
+        self._i18n_sources = {}
+        
+        # Initialize Equipment Cover Generator
+        self.cover_generator = EquipmentCoverGenerator()
+        
+        # Rendered cover previews, cached in memory and under temp/thumbnails
+        self.thumbnails = ThumbnailCache(
+            self.dirs['temp'] / "thumbnails", {'cover': self.cover_generator.render_preview})
+        self._preview_job = None
+        
+        # Treeview pagers keyed by widget path
+        self.pagers = {}
+        
+        # Sign in before any of the main window is shown
+        self.root.withdraw()
+        self.session = self.log_in()
+        if self.session is None:
+            self.conn.close()
+            self.root.destroy()
+            raise SystemExit(0)
+        self.show_signed_in_user()
+        self.root.deiconify()
+        
+        # Create main frames
+        self.create_frames()
+        
+        # Create menu bar
+        self.create_menu()
+        
+        # Initialize tabs
+        self.create_tabs()
+        if self.plugins.errors:
+            self.status_bar.config(text=f"Plugins skipped 插件已跳过: {'; '.join(self.plugins.errors)}")
+        
+        # Dialogs pick up the current language when they are shown
+        self.root.bind_class("Toplevel", "<Map>", self.on_toplevel_mapped, add="+")
+        if self.i18n.language != "both":
+            self.apply_language()
+        
+        # Checkpoint stock levels once a day
+        self.schedule_snapshots()
+        
+        # Drain the alert queue filled by item writes
+        self.poll_alerts()
+
+    def setup_directories(self):
+        """Setup necessary directories for the application"""
+        self.dirs = {
+            'data': self.base_dir / "data",
+            'exports': self.base_dir / "exports",
+            'qrcodes': self.base_dir / "qrcodes",
+            'documents': self.base_dir / "documents",
+            'blobs': self.base_dir / "blobs",
+            'spool': self.base_dir / "spool",
+            'plugins': self.base_dir / "plugins",
+            'temp': self.base_dir / "temp"
+        }
+        
+        for dir_path in self.dirs.values():
+            dir_path.mkdir(parents=True, exist_ok=True)
+
+    def init_database(self):
+        """Initialize the SQLite database with datetime support"""
+        try:
+            db_path = self.dirs['data'] / "lab_inventory.db"
+            self.conn = sqlite3.connect(str(db_path), detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            self.cursor = self.conn.cursor()
+
+            # Register custom datetime adapters and converters
+            sqlite3.register_adapter(datetime, lambda dt: dt.isoformat())
+            sqlite3.register_converter("timestamp", lambda dt: datetime.fromisoformat(dt.decode()))
+
+            # Create tables with proper foreign key support
+            self.cursor.execute("PRAGMA foreign_keys = ON")
+            self.cursor.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    name_cn TEXT,
+                    item_type TEXT NOT NULL,
+                    category TEXT,
+                    location TEXT,
+                    quantity INTEGER DEFAULT 0,
+                    unit TEXT,
+                    manufacturer TEXT,
+                    model_number TEXT,
+                    serial_number TEXT,
+                    purchase_date TEXT,
+                    warranty_until TEXT,
+                    maintenance_contact TEXT,
+                    last_calibration TEXT,
+                    next_calibration TEXT,
+                    safety_classification TEXT,
+                    last_updated TIMESTAMP,
+                    notes TEXT
+                )
+            """)
+            self.cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS usage_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    item_id TEXT,
+                    user TEXT NOT NULL,
+                    user_department TEXT,
+                    quantity_changed INTEGER,
+                    timestamp TIMESTAMP DEFAULT {LOCAL_TIMESTAMP_SQL},
+                    purpose TEXT,
+                    notes TEXT,
+                    supervisor_approval TEXT,
+                    return_time TIMESTAMP,
+                    FOREIGN KEY (item_id) REFERENCES items (id)
+                )
+            """)
+            
+            # Older databases cascaded item deletes into usage_log
+            ItemAuditTrail.rebuild_usage_log(self.conn)
+            
+            # Indexes backing keyset pagination in the API server
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_items_type_id ON items (item_type, id)")
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_log_item_id ON usage_log (item_id, id)")
+            
+            # Row versions for optimistic locking on item edits
+            ItemEditor.install(self.conn)
+            
+            # Alert rules, expiry dates and the dirty-item queue (before date normalization)
+            AlertEngine.install(self.conn)
+            
+            # Returnable loans and the open-loan partial indexes
+            LoanTracker.install(self.conn)
+            
+            # ISO dates and indexes for the calibration/warranty scheduler
+            CalibrationScheduler.migrate(self.conn)
+            
+            # Stock-level checkpoints
+            StockSnapshotStore.install(self.conn)
+            
+            # Item attachments and their deduplicated blobs
+            AttachmentStore.install(self.conn)
+            
+            # Purchase orders and the consumption-window index
+            ReorderPlanner.install(self.conn)
+            
+            # Location tree, item location ids and occupancy counters
+            LocationHierarchy.install(self.conn)
+            
+            # Stock lots and the FEFO allocation triggers on usage_log
+            LotTracker.install(self.conn)
+            
+            # Expression indexes for Treeview sorting and keyset paging
+            TreeviewPager.create_sort_indexes(self.conn)
+            
+            # Field-level audit triggers and the soft-delete column
+            ItemAuditTrail.install(self.conn)
+            
+            # Bulk edit and delete history, undone from its tagged audit entries
+            BulkItemOperations.install(self.conn)
+            
+            # Users, roles and the check-out approval queue
+            AccessControl.install(self.conn)
+            
+            # Change capture for multi-site synchronization
+            SyncEngine.install(self.conn)
+            self.conn.commit()
+        except Exception as e:
+            messagebox.showerror("Database Error", f"Failed to initialize database: {str(e)}")
+            raise
+
+    def create_frames(self):
+        """Create main application frames"""
+        self.main_frame = ttk.Frame(self.root)
+        self.main_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        self.status_bar = ttk.Label(self.root, text="Ready", relief=tk.SUNKEN, anchor=tk.W)
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+
+    def create_menu(self):
+        """Create menu bar"""
+        self.menubar = tk.Menu(self.root)
+        self.root.config(menu=self.menubar)
+        
+        # File Menu
+        file_menu = tk.Menu(self.menubar, tearoff=0)
+        self.menubar.add_cascade(label="File 文件", menu=file_menu)
+        file_menu.add_command(label="Export Inventory 导出库存", command=self.export_inventory)
+        file_menu.add_command(label="Export Usage Log 导出使用记录", command=self.export_usage_log)
+        file_menu.add_separator()
+        file_menu.add_command(label="Switch User 切换用户", command=self.switch_user)
+        file_menu.add_command(label="Exit 退出", command=self.root.quit)
+        
+        # Tools Menu
+        tools_menu = tk.Menu(self.menubar, tearoff=0)
+        self.menubar.add_cascade(label="Tools 工具", menu=tools_menu)
+        tools_menu.add_command(label="Generate Report 生成报告", command=self.generate_report)
+        tools_menu.add_command(label="Backup Database 备份数据库", command=self.backup_database)
+        tools_menu.add_command(label="Restore/Verify Backups 恢复/校验备份", command=self.show_backups)
+        tools_menu.add_command(label="Check & Repair Database 检查与修复数据库", command=self.show_maintenance)
+        tools_menu.add_command(label="Clean Up Attachments 清理附件", command=self.clean_up_attachments)
+        tools_menu.add_command(label="Undo Bulk Changes 撤销批量操作", command=self.show_bulk_history)
+        tools_menu.add_command(label="Memory Budget 内存预算", command=self.set_memory_budget)
+        tools_menu.add_command(label="Sync With Database 同步数据库", command=self.sync_database)
+        tools_menu.add_command(label="AI Predict Inventory Needs AI预测库存需求", command=self.ai_predict_inventory_needs)
+        tools_menu.add_command(label="Calibration & Warranty Alerts 校准与保修提醒", command=self.show_due_alerts)
+        tools_menu.add_command(label="Stock & Expiry Alerts 库存与过期警报", command=self.show_alerts)
+        tools_menu.add_command(label="Reorder & Purchase Orders 补货与采购订单", command=self.show_reorder)
+        tools_menu.add_command(label="Storage Locations 存放位置", command=self.show_locations)
+        tools_menu.add_command(label="Approval Queue 审批队列", command=self.show_approvals)
+        tools_menu.add_command(label="Users & Roles 用户与角色", command=self.show_users)
+        tools_menu.add_separator()
+        tools_menu.add_command(label="Start/Stop Scanner Service 启动/停止扫描服务", command=self.toggle_scan_service)
+        tools_menu.add_command(label="Start/Stop API Server 启动/停止API服务", command=self.toggle_api_server)
+        
+        # Language Menu
+        language_menu = tk.Menu(self.menubar, tearoff=0)
+        self.menubar.add_cascade(label="Language 语言", menu=language_menu)
+        self.language_var = tk.StringVar(value=self.i18n.language)
+        for language, label in MessageCatalog.LANGUAGES.items():
+            language_menu.add_radiobutton(label=label, value=language, variable=self.language_var,
+                                          command=lambda lang=language: self.set_language(lang))
+        
+        # About Menu
+        about_menu = tk.Menu(self.menubar, tearoff=0)
+        self.menubar.add_cascade(label="About 关于", menu=about_menu)
+        about_menu.add_command(label="About 关于", command=self.show_about)
+
+    def create_tabs(self):
+        """Create main application tabs"""
+        self.tab_control = ttk.Notebook(self.main_frame)
+        self.tab_control.pack(fill=tk.BOTH, expand=True)
+        
+        # One inventory tab per registered item type
+        self.inventory_tabs = {}
+        self.trees = {}
+        for item_type in self.plugins.item_types():
+            tab = ttk.Frame(self.tab_control)
+            self.tab_control.add(tab, text=item_type.label)
+            self.inventory_tabs[item_type.key] = tab
+            self.create_inventory_tab(tab, item_type.key)
         
         # Usage Log Tab
         self.usage_tab = ttk.Frame(self.tab_control)
         self.tab_control.add(self.usage_tab, text="Usage Log 使用记录")
         self.create_usage_tab()
+        
+        # Analytics Tab (built on first visit so pandas loads lazily)
+        self.analytics_tab = ttk.Frame(self.tab_control)
+        self.tab_control.add(self.analytics_tab, text="Analytics 分析")
+        self.analytics = None
+        self.tab_control.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+
+    def on_tab_changed(self, event):
+        """Build the analytics dashboard the first time its tab is opened"""
+        if self.tab_control.select() == str(self.analytics_tab) and self.analytics is None:
+            self.create_analytics_tab()
+
+    def create_analytics_tab(self):
+        """Create the usage analytics dashboard"""
+        try:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            self.analytics = UsageAnalytics(self.conn)
+        except ImportError:
+            ttk.Label(self.analytics_tab,
+                      text="pandas and matplotlib are required for analytics 分析需要 pandas 和 matplotlib").pack(pady=20)
+            self.apply_language(self.analytics_tab)
+            return
+        
+        control_frame = ttk.Frame(self.analytics_tab)
+        control_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(control_frame, text="Refresh 刷新",
+                   command=lambda: self.refresh_analytics(reload=True)).pack(side=tk.LEFT, padx=5)
+        self.analytics_status = ttk.Label(control_frame, text="")
+        self.analytics_status.pack(side=tk.LEFT, padx=5)
+        
+        self.analytics_figure = Figure(figsize=(11, 6), dpi=100)
+        self.analytics_canvas = FigureCanvasTkAgg(self.analytics_figure, master=self.analytics_tab)
+        self.analytics_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.refresh_analytics(reload=True)
+        self.apply_language(self.analytics_tab)
+
+    def refresh_analytics(self, reload=False):
+        """Redraw the dashboard from the cached frame, pulling new usage rows first if asked"""
+        try:
+            added = self.analytics.refresh() if reload else 0
+            frame = self.analytics.frame
+            self.analytics_figure.clear()
+            if frame is None or frame.empty:
+                self.analytics_status.config(text="No usage data yet 暂无使用数据")
+                self.analytics_canvas.draw()
+                return
+            
+            by_department = self.analytics_figure.add_subplot(2, 2, 1)
+            departments = self.analytics.consumption_by_department()
+            by_department.bar(departments.index.astype(str), departments.values)
+            by_department.set_title("Consumption by Department")
+            by_department.tick_params(axis='x', labelrotation=30, labelsize=8)
+            
+            top = self.analytics_figure.add_subplot(2, 2, 2)
+            top_items = self.analytics.top_items()
+            top.barh([f"{item_id} {name}" for item_id, name in top_items.index][::-1], top_items.values[::-1])
+            top.set_title("Top Items")
+            top.tick_params(axis='y', labelsize=8)
+            
+            weekly = self.analytics_figure.add_subplot(2, 1, 2)
+            trend = self.analytics.weekly_trend()
+            for column in trend.columns:
+                weekly.plot(trend.index, trend[column], marker='o', label=str(column))
+            weekly.set_title("Weekly Consumption by Item Type")
+            if len(trend.columns):
+                weekly.legend(fontsize=8)
+            
+            self.analytics_figure.tight_layout()
+            self.analytics_canvas.draw()
+            self.analytics_status.config(
+                text=f"{len(frame)} usage rows cached, {added} new 已缓存 {len(frame)} 条, 新增 {added} 条")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to refresh analytics: {str(e)}")
 
     def create_inventory_tab(self, parent, item_type):
         """Create inventory management tab with improved layout"""
@@ -282,12 +6007,27 @@ class LabInventorySystem:
                 command=lambda: self.add_item(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
         ttk.Button(control_frame, text="Edit Item 编辑物品",
                 command=lambda: self.edit_item(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(control_frame, text="Bulk Edit 批量编辑",
+                command=lambda: self.bulk_edit_items(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
         ttk.Button(control_frame, text="Delete Item 删除物品",
                 command=lambda: self.delete_item(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
         ttk.Button(control_frame, text="Generate QR Code 生成二维码",
                 command=lambda: self.generate_qr_code(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(control_frame, text="Print Labels 打印标签",
+                command=lambda: self.print_labels(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
         ttk.Button(control_frame, text="Generate File Cover 生成文件封面",
                 command=lambda: self.generate_file_covers(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(control_frame, text="Stock History 库存历史",
+                command=lambda: self.show_stock_history(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(control_frame, text="Attachments 附件",
+                command=lambda: self.show_attachments(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(control_frame, text="History 历史",
+                command=lambda: self.show_item_history(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(control_frame, text="Lots 批次",
+                command=lambda: self.show_lots(item_type)).pack(side=tk.LEFT, padx=5, pady=5)
+        preview_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(control_frame, text="Preview 预览", variable=preview_var,
+                command=lambda: self.toggle_preview(tree, preview_frame, preview_var)).pack(side=tk.LEFT, padx=5, pady=5)
         
         # Search Frame
         search_frame = ttk.LabelFrame(parent, text="Search 搜索")
@@ -299,13 +6039,22 @@ class LabInventorySystem:
         search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5, pady=5)
         
         # Treeview
-        columns = ("ID", "Name", "Name_CN", "Category", "Location", "Quantity", "Unit", 
-                "Manufacturer", "Model Number", "Serial Number", "Purchase Date", 
-                "Warranty Until", "Maintenance Contact", "Last Calibration", 
-                "Next Calibration", "Safety Classification")
+        columns = tuple(INVENTORY_COLUMNS)
         tree = ttk.Treeview(parent, columns=columns, show='headings')
         tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         
+        # Cover preview pane, packed beside the tree when enabled
+        preview_frame = ttk.LabelFrame(parent, text="Preview 预览")
+        preview_frame.image_label = ttk.Label(preview_frame)
+        preview_frame.image_label.pack(padx=5, pady=5)
+        tree.bind('<<TreeviewSelect>>', lambda e: self.schedule_preview(tree, preview_frame, preview_var))
+        
+        # Rows are sorted, filtered and paged in SQL
+        pager = TreeviewPager(
+            self.conn, tree, "FROM items", INVENTORY_COLUMNS, "id",
+            base_where="item_type = ? AND deleted_at IS NULL", base_params=(item_type,), default_sort="Name")
+        self.pagers[str(tree)] = pager
+        
         # Scrollbars
         y_scrollbar = ttk.Scrollbar(parent, orient=tk.VERTICAL, command=tree.yview)
         y_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
@@ -313,32 +6062,61 @@ class LabInventorySystem:
         x_scrollbar = ttk.Scrollbar(parent, orient=tk.HORIZONTAL, command=tree.xview)
         x_scrollbar.pack(side=tk.BOTTOM, fill=tk.X)
         
-        tree.configure(yscrollcommand=y_scrollbar.set, xscrollcommand=x_scrollbar.set)
+        tree.configure(yscrollcommand=pager.on_scroll(y_scrollbar), xscrollcommand=x_scrollbar.set)
         
         # Configure columns
         for col in columns:
             tree.heading(col, text=col)
             tree.column(col, width=100, minwidth=50)
+        pager.bind_headings(parent)
         
         # Store tree reference and bind search
-        if item_type == "equipment":
-            self.equipment_tree = tree
-        elif item_type == "chemical":
-            self.chemicals_tree = tree
-        elif item_type == "consumable":
-            self.consumables_tree = tree
-        else:
-            self.other_tree = tree
-            
+        self.trees[item_type] = tree
         search_entry.bind('<KeyRelease>', lambda e: self.search_items(item_type, tree, search_var))
         
         # Initial data load
         self.refresh_inventory(item_type, tree)
 
+    def toggle_preview(self, tree, preview_frame, preview_var):
+        """Show or hide the cover preview pane of an inventory tab"""
+        if preview_var.get():
+            preview_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=5, pady=5, before=tree)
+            self.schedule_preview(tree, preview_frame, preview_var)
+        else:
+            preview_frame.pack_forget()
+
+    def schedule_preview(self, tree, preview_frame, preview_var):
+        """Debounce preview rendering so holding an arrow key through the list stays responsive"""
+        if not preview_var.get():
+            return
+        if self._preview_job is not None:
+            self.root.after_cancel(self._preview_job)
+        self._preview_job = self.root.after(120, lambda: self.show_preview(tree, preview_frame))
+
+    def show_preview(self, tree, preview_frame):
+        """Display the cached cover thumbnail of the selected item"""
+        self._preview_job = None
+        selected = tree.selection()
+        if not selected:
+            return
+        
+        try:
+            item_id = tree.item(selected[0])['values'][0]
+            item = Item.fetch(self.conn, item_id, include_deleted=True)
+            if item is None:
+                return
+            image = self.thumbnails.get('cover', item_id, f"{item.last_updated}|{item.version}", item)
+            
+            # Keep a reference so Tk does not drop the image
+            preview_frame.photo = ImageTk.PhotoImage(image)
+            preview_frame.image_label.config(image=preview_frame.photo)
+        except Exception as e:
+            self.status_bar.config(text=f"Preview failed 预览失败: {str(e)}")
+
     def generate_file_covers(self, item_type):
         """Generate file covers for selected items"""
         try:
-            tree = self.equipment_tree if item_type == "equipment" else self.chemicals_tree if item_type == "chemical" else self.consumables_tree if item_type == "consumable" else self.other_tree
+            tree = self.trees[item_type]
             selected = tree.selection()
             
             if not selected:
@@ -358,8 +6136,10 @@ class LabInventorySystem:
                 return
 
             # Fetch item details
-            self.cursor.execute("SELECT * FROM items WHERE id = ?", (item_id,))
-            item_data = self.cursor.fetchone()
+            item = Item.fetch(self.conn, item_id)
+            if item is None:
+                messagebox.showerror("Error", "Item not found 物品不存在")
+                return
             
             # Create PDF with custom page setup
             doc = SimpleDocTemplate(
@@ -376,7 +6156,7 @@ class LabInventorySystem:
             
             # Equipment Name Box
             elements.append(Paragraph(
-                f"{item_data[1]}",
+                PDFFonts.markup(item.name),
                 styles['EquipmentName']
             ))
             
@@ -394,16 +6174,16 @@ class LabInventorySystem:
             # Create information table
             data = [
                 ["Information", ""],
-                ["Manufacturer", item_data[8]],
-                ["Model Number", item_data[9]],
-                ["Serial Number", item_data[10]],
-                ["Location", item_data[5]],
-                ["Purchase Date", item_data[11]],
-                ["Warranty Until", item_data[12]],
-                ["Maintenance Contact", item_data[13]],
-                ["Last Calibration", item_data[14]],
-                ["Next Calibration", item_data[15]],
-                ["Safety Classification", item_data[16]]
+                ["Manufacturer", item.manufacturer],
+                ["Model Number", item.model_number],
+                ["Serial Number", item.serial_number],
+                ["Location", item.location],
+                ["Purchase Date", item.purchase_date],
+                ["Warranty Until", item.warranty_until],
+                ["Maintenance Contact", item.maintenance_contact],
+                ["Last Calibration", item.last_calibration],
+                ["Next Calibration", item.next_calibration],
+                ["Safety Classification", item.safety_classification]
             ]
             
             # Table Style
@@ -432,6 +6212,7 @@ class LabInventorySystem:
             # Create and style the table
             table = Table(data, colWidths=[doc.width * 0.4, doc.width * 0.6])
             table.setStyle(table_style)
+            table.setStyle(TableStyle(PDFFonts.table_styles(data, 1)))
             elements.append(table)
             
             # Add generation date
@@ -450,12 +6231,105 @@ class LabInventorySystem:
 
     def on_closing(self):
         """Clean up database connection when closing"""
+        if self.scan_service is not None:
+            self.scan_service.stop()
+        if self.api_server is not None:
+            self.api_server.stop()
+        if self.label_spooler is not None:
+            self.label_spooler.stop()
         if hasattr(self, 'conn'):
+            try:
+                self.maintenance.run_due()
+            except sqlite3.Error:
+                pass
             self.conn.close()
 
+    def toggle_scan_service(self):
+        """Start or stop the IoT scan ingestion service"""
+        if not self.require_permission("services.manage"):
+            return
+        try:
+            if self.scan_service is not None:
+                self.scan_service.stop()
+                self.scan_service = None
+                self.iot_device.ingestion_service = None
+                self.status_bar.config(text="Scanner service stopped 扫描服务已停止")
+                return
+            
+            # Scans are booked as the user who starts the service, or queued if they cannot approve
+            self.scan_service = ScanIngestionService(self.dirs['data'] / "lab_inventory.db", self.session)
+            self.scan_service.start()
+            if self.scan_service.loop is None:
+                self.scan_service = None
+                raise RuntimeError("service failed to start")
+            self.iot_device.ingestion_service = self.scan_service
+            self.status_bar.config(
+                text=f"Scanner service listening on {self.scan_service.host}:{self.scan_service.port} "
+                     f"as {self.session.username} 扫描服务运行中")
+            self.poll_scan_results()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to toggle scanner service: {str(e)}")
+
+    def toggle_api_server(self):
+        """Start or stop the embedded REST/JSON API server"""
+        if not self.require_permission("services.manage"):
+            return
+        try:
+            if self.api_server is not None:
+                self.api_server.stop()
+                self.api_server = None
+                self.status_bar.config(text="API server stopped API服务已停止")
+                return
+            
+            self.api_server = LabAPIServer(self.dirs['data'] / "lab_inventory.db")
+            self.api_server.start()
+            self.status_bar.config(
+                text=f"API server running on http://{self.api_server.host}:{self.api_server.port} API服务运行中")
+        except Exception as e:
+            self.api_server = None
+            messagebox.showerror("Error", f"Failed to toggle API server: {str(e)}")
+
+    def poll_scan_results(self):
+        """Apply batched scan results to the UI from the Tk thread"""
+        if self.scan_service is None:
+            return
+        
+        item_types = set()
+        applied = queued = rejected = 0
+        while True:
+            try:
+                summary = self.scan_service.results.get_nowait()
+            except queue.Empty:
+                break
+            item_types.update(summary['item_types'])
+            applied += len(summary['applied'])
+            queued += len(summary['queued'])
+            rejected += len(summary['rejected'])
+            for entry in summary['applied']:
+                self.blockchain.add_transaction({
+                    'item_id': entry['item_id'],
+                    'user': entry['user'],
+                    'quantity_changed': entry['quantity'],
+                    'timestamp': entry['timestamp']
+                })
+        
+        if applied or queued or rejected:
+            for item_type in item_types:
+                if item_type in self.trees:
+                    self.refresh_inventory(item_type, self.trees[item_type])
+            self.refresh_usage_log()
+            stats = self.scan_service.stats
+            self.status_bar.config(
+                text=f"Scans: {stats['received']} received, {stats['duplicates']} duplicates, "
+                     f"{stats['applied']} applied, {stats['queued']} awaiting approval, "
+                     f"{stats['rejected']} rejected, "
+                     f"{stats['invalid']} invalid, {stats['failed']} failed batches")
+        
+        self.root.after(250, self.poll_scan_results)
+
     def generate_qr_code(self, item_type):
         """Generate QR code for selected item"""
-        tree = self.equipment_tree if item_type == "equipment" else self.chemicals_tree if item_type == "chemical" else self.consumables_tree if item_type == "consumable" else self.other_tree
+        tree = self.trees[item_type]
         selected = tree.selection()
         
         if not selected:
@@ -464,26 +6338,75 @@ class LabInventorySystem:
         
         try:
             item_id = tree.item(selected[0])['values'][0]
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            
-            qr_data = f"Item ID: {item_id}\nProperty of DNA Virology Lab-ICGEB China RRC"
-            qr.add_data(qr_data)
-            qr.make(fit=True)
-            
-            qr_img = qr.make_image(fill_color="black", back_color="white")
             qr_path = self.dirs['qrcodes'] / f"item_{item_id}_qr.png"
-            qr_img.save(qr_path)
+            # The QR content depends only on the item id, so an existing image is reused
+            if not qr_path.exists():
+                make_qr_image(item_id).save(qr_path)
             
             messagebox.showinfo("Success", f"QR code generated successfully!\n二维码已生成: {qr_path}")
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to generate QR code: {str(e)}")
 
+    def print_labels(self, item_type):
+        """Queue asset labels for the selected items to the print spool"""
+        tree = self.trees[item_type]
+        selected = tree.selection()
+        
+        if not selected:
+            messagebox.showwarning("Warning", "Please select items to print labels for 请选择要打印标签的物品")
+            return
+        
+        item_ids = [tree.item(iid)['values'][0] for iid in selected]
+        
+        print_window = tk.Toplevel(self.root)
+        print_window.title(f"Print Labels 打印标签 - {len(item_ids)} items")
+        print_window.transient(self.root)
+        print_window.grab_set()
+        
+        formats = {"ZPL (Zebra)": "zpl", "ESC/POS raster": "escpos", "PDF label sheet 标签页": "sheet"}
+        ttk.Label(print_window, text="Format 格式:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        format_var = tk.StringVar(value=next(iter(formats)))
+        ttk.Combobox(print_window, textvariable=format_var, values=tuple(formats),
+                     state="readonly", width=24).grid(row=0, column=1, padx=5, pady=5)
+        ttk.Label(print_window, text="Copies 份数:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
+        copies_var = tk.IntVar(value=1)
+        ttk.Spinbox(print_window, from_=1, to=100, textvariable=copies_var, width=6).grid(
+            row=1, column=1, padx=5, pady=5, sticky="w")
+        
+        def submit():
+            try:
+                copies = copies_var.get()
+                if copies < 1:
+                    raise ValueError("Copies must be at least 1")
+                items = [item for item in (Item.fetch(self.conn, item_id) for item_id in item_ids) if item is not None]
+                
+                if self.label_spooler is None:
+                    self.label_spooler = LabelSpooler(self.dirs['spool'], self.dirs['temp'] / "labels")
+                job_id = self.label_spooler.submit(items, formats[format_var.get()], copies)
+                print_window.destroy()
+                self.status_bar.config(text=f"Label job {job_id} queued 标签任务已加入队列")
+                self.root.after(250, self.poll_label_jobs)
+            except (ValueError, tk.TclError) as e:
+                messagebox.showerror("Error", f"Invalid input: {str(e)}", parent=print_window)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to queue labels: {str(e)}", parent=print_window)
+        
+        ttk.Button(print_window, text="Print 打印", command=submit).grid(row=2, column=0, columnspan=2, pady=10)
+
+    def poll_label_jobs(self):
+        """Report finished label jobs from the spooler thread"""
+        try:
+            result = self.label_spooler.results.get_nowait()
+        except queue.Empty:
+            self.root.after(250, self.poll_label_jobs)
+            return
+        if 'error' in result:
+            messagebox.showerror("Error", f"Label job {result['job']} failed: {result['error']}")
+        else:
+            self.status_bar.config(
+                text=f"Spooled {result['labels']} labels in {result['seconds']:.1f}s 标签已输出: {result['path']}")
+
     def create_usage_tab(self):
         """Create usage log tab with improved layout"""
         # Control Frame
@@ -492,12 +6415,29 @@ class LabInventorySystem:
         
         ttk.Button(control_frame, text="Add Usage Log 添加使用记录",
                   command=self.add_usage_log).pack(side=tk.LEFT, padx=5)
+        ttk.Button(control_frame, text="Check In 归还",
+                  command=self.check_in_selected).pack(side=tk.LEFT, padx=5)
+        ttk.Button(control_frame, text="Outstanding Loans 未归还",
+                  command=self.show_outstanding_loans).pack(side=tk.LEFT, padx=5)
         
         # Treeview
-        columns = ("ID", "Item", "User", "Department", "Quantity", "Date", "Purpose", "Status")
+        columns = tuple(USAGE_COLUMNS)
         self.usage_tree = ttk.Treeview(self.usage_tab, columns=columns, show='headings')
         self.usage_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         
+        date_index = columns.index("Date")
+        
+        def format_row(row):
+            row = list(row)
+            timestamp = parse_timestamp(row[date_index])
+            row[date_index] = timestamp.strftime("%Y-%m-%d %H:%M") if timestamp else ""
+            return row
+        
+        self.usage_pager = TreeviewPager(
+            self.conn, self.usage_tree, "FROM usage_log u JOIN items i ON u.item_id = i.id",
+            USAGE_COLUMNS, "u.id", default_sort="Date", row_transform=format_row)
+        self.usage_pager.descending = True
+        
         # Scrollbars
         y_scrollbar = ttk.Scrollbar(self.usage_tab, orient=tk.VERTICAL, command=self.usage_tree.yview)
         y_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
@@ -505,17 +6445,22 @@ class LabInventorySystem:
         x_scrollbar = ttk.Scrollbar(self.usage_tab, orient=tk.HORIZONTAL, command=self.usage_tree.xview)
         x_scrollbar.pack(side=tk.BOTTOM, fill=tk.X)
         
-        self.usage_tree.configure(yscrollcommand=y_scrollbar.set, xscrollcommand=x_scrollbar.set)
+        self.usage_tree.configure(yscrollcommand=self.usage_pager.on_scroll(y_scrollbar),
+                                  xscrollcommand=x_scrollbar.set)
         
         # Configure columns
         for col in columns:
             self.usage_tree.heading(col, text=col)
             self.usage_tree.column(col, width=100, minwidth=50)
+        self.usage_pager.bind_headings(self.usage_tab)
         
         self.refresh_usage_log()
 
     def add_usage_log(self):
         """Add a new usage log entry"""
+        if not self.require_permission("usage.add"):
+            return
+        
         add_window = tk.Toplevel(self.root)
         add_window.title("Add Usage Log 添加使用记录")
         add_window.geometry("400x400")
@@ -552,8 +6497,7 @@ class LabInventorySystem:
             ("user_department", "Department 部门", False),
             ("quantity_changed", "Quantity Changed 数量变化 *", True),
             ("purpose", "Purpose 目的", False),
-            ("notes", "Notes 备注", False),
-            ("supervisor_approval", "Supervisor Approval 主管批准", False)
+            ("notes", "Notes 备注", False)
         ]
         
         for field, label, required in field_configs:
@@ -564,6 +6508,12 @@ class LabInventorySystem:
                 fields[field] = ttk.Entry(scrollable_frame)
             fields[field].grid(row=row, column=1, padx=5, pady=5, sticky="ew")
             row += 1
+        fields['user'].insert(0, self.session.display_name)
+        
+        self.returnable_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(scrollable_frame, text="Return expected 需归还",
+                        variable=self.returnable_var).grid(row=row, column=1, padx=5, pady=5, sticky="w")
+        row += 1
         
         def validate_and_save():
             # Validation
@@ -586,29 +6536,48 @@ class LabInventorySystem:
                 messagebox.showerror("Error", f"Invalid quantity: {str(e)}")
                 return
             
+            returnable = self.returnable_var.get()
+            if returnable and quantity_changed < 0:
+                messagebox.showerror("Error", "Only check-outs (positive quantities) can be returned")
+                return
+            
             # Check if the item has enough quantity
-            self.cursor.execute("SELECT quantity FROM items WHERE id = ?", (item_id,))
-            current_quantity = self.cursor.fetchone()[0]
+            self.cursor.execute("SELECT COALESCE(quantity, 0) FROM items WHERE id = ? AND deleted_at IS NULL",
+                                (item_id,))
+            row = self.cursor.fetchone()
+            if row is None:
+                messagebox.showerror("Error", "Item not found 物品不存在")
+                return
+            current_quantity = row[0]
             
             if current_quantity - quantity_changed < 0:
                 messagebox.showerror("Error", "Not enough quantity in stock")
                 return
             
+            # Check-outs by users who cannot approve them wait in the approval queue
+            if quantity_changed > 0 and not self.session.can("usage.approve"):
+                try:
+                    request_id = self.access.request_checkout(
+                        self.session, item_id, fields['user'].get().strip(), quantity_changed,
+                        fields['user_department'].get().strip(), fields['purpose'].get().strip(),
+                        fields['notes'].get("1.0", tk.END).strip(), returnable)
+                except Exception as e:
+                    messagebox.showerror("Error", f"Failed to submit request: {str(e)}")
+                    return
+                add_window.destroy()
+                messagebox.showinfo("Submitted 已提交",
+                                    f"Check-out request #{request_id} is waiting for supervisor approval\n"
+                                    f"领用申请 #{request_id} 等待主管审批")
+                return
+            
             # Save to database
             try:
-                # Update the item's quantity
-                self.cursor.execute("""
-                    UPDATE items
-                    SET quantity = quantity - ?
-                    WHERE id = ?
-                """, (quantity_changed, item_id))
-                
-                # Insert the usage log entry
+                # Insert the usage log entry first so lot tracking sees the movement
                 self.cursor.execute("""
                     INSERT INTO usage_log (
                         item_id, user, user_department, quantity_changed,
-                        purpose, notes, supervisor_approval
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                        purpose, notes, supervisor_approval, returnable
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     item_id,
                     fields['user'].get().strip(),
@@ -616,9 +6585,17 @@ class LabInventorySystem:
                     quantity_changed,
                     fields['purpose'].get().strip(),
                     fields['notes'].get("1.0", tk.END).strip(),
-                    fields['supervisor_approval'].get().strip()
+                    self.session.username if quantity_changed > 0 else "",
+                    1 if returnable else 0
                 ))
                 
+                # Update the item's quantity
+                self.cursor.execute("""
+                    UPDATE items
+                    SET quantity = COALESCE(quantity, 0) - ?, last_updated = ?, version = version + 1
+                    WHERE id = ?
+                """, (quantity_changed, datetime.now().isoformat(), item_id))
+                
                 # Add transaction to blockchain
                 transaction = {
                     'item_id': item_id,
@@ -630,6 +6607,7 @@ class LabInventorySystem:
                 
                 self.conn.commit()
                 self.refresh_usage_log()
+                self.check_alerts()
                 add_window.destroy()
                 messagebox.showinfo("Success", "Usage log added successfully! 使用记录添加成功！")
             
@@ -645,6 +6623,80 @@ class LabInventorySystem:
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
 
+    def check_in_selected(self):
+        """Return the checked-out entries selected in the usage log"""
+        if not self.require_permission("loans.check_in"):
+            return
+        selected = self.usage_tree.selection()
+        
+        if not selected:
+            messagebox.showwarning("Warning", "Please select a usage entry to check in 请选择要归还的记录")
+            return
+        
+        try:
+            log_ids = [self.usage_tree.item(iid)['values'][0] for iid in selected]
+            returned = self.loans.check_in(log_ids)
+            if not returned:
+                messagebox.showinfo("Check In 归还", "No open loans in the selection 所选记录中没有未归还项")
+                return
+            self.refresh_after_check_in()
+            messagebox.showinfo("Success", f"{returned} item(s) checked in 已归还 {returned} 项")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to check in: {str(e)}")
+
+    def refresh_after_check_in(self):
+        for item_type, tree in self.trees.items():
+            self.refresh_inventory(item_type, tree)
+        self.refresh_usage_log()
+
+    def show_outstanding_loans(self):
+        """List items currently checked out, optionally for one user"""
+        loans_window = tk.Toplevel(self.root)
+        loans_window.title("Outstanding Loans 未归还")
+        loans_window.geometry("900x450")
+        loans_window.transient(self.root)
+        
+        control_frame = ttk.Frame(loans_window)
+        control_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(control_frame, text="User 用户:").pack(side=tk.LEFT, padx=5)
+        user_var = tk.StringVar()
+        ttk.Entry(control_frame, textvariable=user_var, width=20).pack(side=tk.LEFT, padx=5)
+        
+        columns = ("ID", "Item ID", "Item", "User", "Department", "Quantity", "Checked Out", "Purpose")
+        tree = ttk.Treeview(loans_window, columns=columns, show='headings')
+        for col in columns:
+            tree.heading(col, text=col)
+            tree.column(col, width=100, minwidth=50)
+        y_scrollbar = ttk.Scrollbar(loans_window, orient=tk.VERTICAL, command=tree.yview)
+        y_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        tree.configure(yscrollcommand=y_scrollbar.set)
+        tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def load_loans():
+            for item in tree.get_children():
+                tree.delete(item)
+            for row in self.loans.outstanding(user_var.get().strip() or None):
+                tree.insert("", "end", values=row)
+        
+        def check_in():
+            if not self.require_permission("loans.check_in"):
+                return
+            selected = tree.selection()
+            if not selected:
+                messagebox.showwarning("Warning", "Please select loans to check in 请选择要归还的记录", parent=loans_window)
+                return
+            try:
+                returned = self.loans.check_in([tree.item(iid)['values'][0] for iid in selected])
+                self.refresh_after_check_in()
+                load_loans()
+                messagebox.showinfo("Success", f"{returned} item(s) checked in 已归还 {returned} 项", parent=loans_window)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to check in: {str(e)}", parent=loans_window)
+        
+        ttk.Button(control_frame, text="Filter 筛选", command=load_loans).pack(side=tk.LEFT, padx=5)
+        ttk.Button(control_frame, text="Check In Selected 归还所选", command=check_in).pack(side=tk.LEFT, padx=5)
+        load_loans()
+
     def filter_item_dropdown(self):
         """Filter the dropdown menu based on user input"""
         search_term = self.item_var.get().lower()
@@ -655,17 +6707,24 @@ class LabInventorySystem:
         selected_item = self.item_var.get()
         if selected_item:
             item_id = selected_item.split(" - ")[0]
+            # Equipment is lent out and comes back; default the checkbox accordingly
+            self.cursor.execute("SELECT item_type FROM items WHERE id = ?", (item_id,))
+            row = self.cursor.fetchone()
+            self.returnable_var.set(bool(row) and self.plugins.item_type(row[0]).returnable)
 
     def populate_item_dropdown(self):
         """Populate the item dropdown with item IDs and names"""
-        self.cursor.execute("SELECT id, name FROM items")
+        self.cursor.execute("SELECT id, name FROM items WHERE deleted_at IS NULL")
         items = self.cursor.fetchall()
         self.item_dropdown['values'] = [f"{item[0]} - {item[1]}" for item in items]
 
     def add_item(self, item_type):
         """Add a new item to inventory with improved validation"""
+        if not self.require_permission("item.add"):
+            return
+        
         add_window = tk.Toplevel(self.root)
-        add_window.title(f"Add {item_type.capitalize()} 添加{item_type}")
+        add_window.title(f"Add Item 添加物品 - {self.plugins.item_type(item_type).label}")
         add_window.geometry("400x800")  # Increased height to accommodate more fields
         add_window.transient(self.root)
         add_window.grab_set()
@@ -701,6 +6760,7 @@ class LabInventorySystem:
             ("maintenance_contact", "Maintenance Contact 维护联系人", False),
             ("last_calibration", "Last Calibration 上次校准 (YYYY-MM-DD)", False),
             ("next_calibration", "Next Calibration 下次校准 (YYYY-MM-DD)", False),
+            ("expiry_date", "Expiry Date 有效期至 (YYYY-MM-DD)", False),
             ("safety_classification", "Safety Classification 安全分类", False),
             ("notes", "Notes 备注", False)
         ]
@@ -709,6 +6769,9 @@ class LabInventorySystem:
             ttk.Label(scrollable_frame, text=label).grid(row=row, column=0, padx=5, pady=5, sticky="w")
             if field == "notes":
                 fields[field] = tk.Text(scrollable_frame, height=3, width=30)
+            elif field == "location":
+                # Known storage locations are offered, free text is still accepted
+                fields[field] = ttk.Combobox(scrollable_frame, values=self.locations.paths())
             else:
                 fields[field] = ttk.Entry(scrollable_frame)
             fields[field].grid(row=row, column=1, padx=5, pady=5, sticky="ew")
@@ -728,19 +6791,14 @@ class LabInventorySystem:
                 messagebox.showerror("Error", f"Invalid quantity: {str(e)}")
                 return
             
-            # Generate item ID
-            if item_type == "chemical":
-                prefix = "CHE"
-            elif item_type == "equipment":
-                prefix = "EQ"
-            elif item_type == "consumable":
-                prefix = "CON"
-            else:
-                prefix = "OT"
+            try:
+                dates = {field: normalize_date(fields[field].get()) for field in ITEM_DATE_FIELDS}
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid date: {str(e)}")
+                return
             
-            self.cursor.execute("SELECT COUNT(*) FROM items WHERE item_type = ?", (item_type,))
-            count = self.cursor.fetchone()[0]
-            item_id = f"{prefix}{count + 1:04d}"
+            # Generate a site-unique item ID so synced databases never collide
+            item_id = SyncEngine(self.conn).new_item_id(self.plugins.item_type(item_type).prefix)
             
             # Save to database
             try:
@@ -750,8 +6808,8 @@ class LabInventorySystem:
                         quantity, unit, manufacturer, model_number,
                         serial_number, purchase_date, warranty_until,
                         maintenance_contact, last_calibration, next_calibration,
-                        safety_classification, notes, last_updated
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        safety_classification, notes, last_updated, expiry_date
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     item_id,
                     fields["name"].get().strip(),
@@ -764,18 +6822,21 @@ class LabInventorySystem:
                     fields["manufacturer"].get().strip(),
                     fields["model_number"].get().strip(),
                     fields["serial_number"].get().strip(),
-                    fields["purchase_date"].get().strip(),
-                    fields["warranty_until"].get().strip(),
+                    dates["purchase_date"],
+                    dates["warranty_until"],
                     fields["maintenance_contact"].get().strip(),
-                    fields["last_calibration"].get().strip(),
-                    fields["next_calibration"].get().strip(),
+                    dates["last_calibration"],
+                    dates["next_calibration"],
                     fields["safety_classification"].get().strip(),
                     fields["notes"].get("1.0", tk.END).strip(),
-                    datetime.now()
+                    datetime.now(),
+                    dates["expiry_date"]
                 ))
                 
                 self.conn.commit()
-                tree = self.equipment_tree if item_type == "equipment" else self.chemicals_tree if item_type == "chemical" else self.consumables_tree if item_type == "consumable" else self.other_tree
+                self.scheduler.refresh_item(item_id)
+                self.check_alerts()
+                tree = self.trees[item_type]
                 self.refresh_inventory(item_type, tree)
                 add_window.destroy()
                 messagebox.showinfo("Success", "Item added successfully! 物品添加成功！")
@@ -794,7 +6855,10 @@ class LabInventorySystem:
     
     def edit_item(self, item_type):
         """Edit selected item with improved validation and error handling"""
-        tree = self.equipment_tree if item_type == "equipment" else self.chemicals_tree if item_type == "chemical" else self.consumables_tree if item_type == "consumable" else self.other_tree
+        if not self.require_permission("item.edit"):
+            return
+        
+        tree = self.trees[item_type]
         selected = tree.selection()
         
         if not selected:
@@ -804,19 +6868,13 @@ class LabInventorySystem:
         try:
             item_id = tree.item(selected[0])['values'][0]
             
-            self.cursor.execute("""
-                SELECT name, name_cn, category, location, quantity, unit,
-                    manufacturer, model_number, serial_number, purchase_date,
-                    warranty_until, maintenance_contact, last_calibration,
-                    next_calibration, safety_classification, notes
-                FROM items
-                WHERE id = ?
-            """, (item_id,))
-            
-            item_data = self.cursor.fetchone()
-            if not item_data:
+            # Remember the row and version the dialog starts from
+            editor = ItemEditor(self.conn)
+            original, version = editor.load(item_id)
+            if original is None:
                 messagebox.showerror("Error", "Item not found in database")
                 return
+            state = {'original': original, 'version': version}
             
             edit_window = tk.Toplevel(self.root)
             edit_window.title("Edit Item 编辑物品")
@@ -840,22 +6898,23 @@ class LabInventorySystem:
             # Fields
             fields = {}
             field_configs = [
-                ("name", "Name 名称 *", item_data[0]),
-                ("name_cn", "Chinese Name 中文名称", item_data[1]),
-                ("category", "Category 类别", item_data[2]),
-                ("location", "Location 位置", item_data[3]),
-                ("quantity", "Quantity 数量 *", str(item_data[4])),
-                ("unit", "Unit 单位", item_data[5]),
-                ("manufacturer", "Manufacturer 制造商", item_data[6]),
-                ("model_number", "Model Number 型号", item_data[7]),
-                ("serial_number", "Serial Number 序列号", item_data[8]),
-                ("purchase_date", "Purchase Date 购买日期 (YYYY-MM-DD)", item_data[9]),
-                ("warranty_until", "Warranty Until 保修至 (YYYY-MM-DD)", item_data[10]),
-                ("maintenance_contact", "Maintenance Contact 维护联系人", item_data[11]),
-                ("last_calibration", "Last Calibration 上次校准 (YYYY-MM-DD)", item_data[12]),
-                ("next_calibration", "Next Calibration 下次校准 (YYYY-MM-DD)", item_data[13]),
-                ("safety_classification", "Safety Classification 安全分类", item_data[14]),
-                ("notes", "Notes 备注", item_data[15])
+                ("name", "Name 名称 *", original['name']),
+                ("name_cn", "Chinese Name 中文名称", original['name_cn']),
+                ("category", "Category 类别", original['category']),
+                ("location", "Location 位置", original['location']),
+                ("quantity", "Quantity 数量 *", str(original['quantity'])),
+                ("unit", "Unit 单位", original['unit']),
+                ("manufacturer", "Manufacturer 制造商", original['manufacturer']),
+                ("model_number", "Model Number 型号", original['model_number']),
+                ("serial_number", "Serial Number 序列号", original['serial_number']),
+                ("purchase_date", "Purchase Date 购买日期 (YYYY-MM-DD)", original['purchase_date']),
+                ("warranty_until", "Warranty Until 保修至 (YYYY-MM-DD)", original['warranty_until']),
+                ("maintenance_contact", "Maintenance Contact 维护联系人", original['maintenance_contact']),
+                ("last_calibration", "Last Calibration 上次校准 (YYYY-MM-DD)", original['last_calibration']),
+                ("next_calibration", "Next Calibration 下次校准 (YYYY-MM-DD)", original['next_calibration']),
+                ("expiry_date", "Expiry Date 有效期至 (YYYY-MM-DD)", original['expiry_date']),
+                ("safety_classification", "Safety Classification 安全分类", original['safety_classification']),
+                ("notes", "Notes 备注", original['notes'])
             ]
             
             row = 0
@@ -864,12 +6923,20 @@ class LabInventorySystem:
                 if field == "notes":
                     fields[field] = tk.Text(scrollable_frame, height=3, width=30)
                     fields[field].insert("1.0", value if value else "")
+                elif field == "location":
+                    fields[field] = ttk.Combobox(scrollable_frame, values=self.locations.paths())
+                    fields[field].insert(0, value if value else "")
                 else:
                     fields[field] = ttk.Entry(scrollable_frame)
                     fields[field].insert(0, value if value else "")
                 fields[field].grid(row=row, column=1, padx=5, pady=5, sticky="ew")
                 row += 1
             
+            if self.lots.is_tracked(item_id):
+                # Stock and expiry of lot-tracked items follow their lots
+                fields['quantity'].config(state="disabled")
+                fields['expiry_date'].config(state="disabled")
+            
             def validate_and_save():
                 # Validation
                 if not fields['name'].get().strip():
@@ -884,39 +6951,39 @@ class LabInventorySystem:
                     messagebox.showerror("Error", f"Invalid quantity: {str(e)}")
                     return
                 
-                # Save to database
                 try:
-                    self.cursor.execute("""
-                        UPDATE items
-                        SET name = ?, name_cn = ?, category = ?, location = ?,
-                            quantity = ?, unit = ?, manufacturer = ?, model_number = ?,
-                            serial_number = ?, purchase_date = ?, warranty_until = ?,
-                            maintenance_contact = ?, last_calibration = ?,
-                            next_calibration = ?, safety_classification = ?,
-                            notes = ?, last_updated = ?
-                        WHERE id = ?
-                    """, (
-                        fields["name"].get().strip(),
-                        fields["name_cn"].get().strip(),
-                        fields["category"].get().strip(),
-                        fields["location"].get().strip(),
-                        quantity,
-                        fields["unit"].get().strip(),
-                        fields["manufacturer"].get().strip(),
-                        fields["model_number"].get().strip(),
-                        fields["serial_number"].get().strip(),
-                        fields["purchase_date"].get().strip(),
-                        fields["warranty_until"].get().strip(),
-                        fields["maintenance_contact"].get().strip(),
-                        fields["last_calibration"].get().strip(),
-                        fields["next_calibration"].get().strip(),
-                        fields["safety_classification"].get().strip(),
-                        fields["notes"].get("1.0", tk.END).strip(),
-                        datetime.now(),
-                        item_id
-                    ))
+                    dates = {field: normalize_date(fields[field].get()) for field in ITEM_DATE_FIELDS}
+                except ValueError as e:
+                    messagebox.showerror("Error", f"Invalid date: {str(e)}")
+                    return
+                
+                changes = {
+                    field: fields[field].get().strip() for field in ItemEditor.EDITABLE_FIELDS
+                    if field not in ("quantity", "notes") and field not in dates
+                }
+                changes.update(dates)
+                changes["quantity"] = quantity
+                changes["notes"] = fields["notes"].get("1.0", tk.END).strip()
+                
+                # Save to database, writing only the changed columns
+                try:
+                    while True:
+                        try:
+                            state['version'], written = editor.save(
+                                item_id, state['original'], changes, state['version'])
+                            break
+                        except ItemVersionConflict as conflict:
+                            changes = self.resolve_edit_conflict(edit_window, item_id, conflict)
+                            if changes is None:
+                                return
+                            state['original'], state['version'] = conflict.current, conflict.version
                     
-                    self.conn.commit()
+                    if not written:
+                        edit_window.destroy()
+                        messagebox.showinfo("Edit Item 编辑物品", "No changes to save 没有需要保存的更改")
+                        return
+                    self.scheduler.refresh_item(item_id)
+                    self.check_alerts()
                     self.refresh_inventory(item_type, tree)
                     edit_window.destroy()
                     messagebox.showinfo("Success", "Item updated successfully! 物品更新成功！")
@@ -936,9 +7003,53 @@ class LabInventorySystem:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to edit item: {str(e)}")
             
+    def resolve_edit_conflict(self, parent, item_id, conflict):
+        """Ask which value wins for each field edited concurrently; returns merged changes or None"""
+        merge_window = tk.Toplevel(parent)
+        merge_window.title("Edit Conflict 编辑冲突")
+        merge_window.transient(parent)
+        merge_window.grab_set()
+        
+        ttk.Label(merge_window, text=(
+            f"{item_id} was changed by another user while you were editing.\n"
+            f"其他用户在您编辑期间修改了 {item_id}。请选择要保留的值:")).grid(
+            row=0, column=0, columnspan=3, padx=10, pady=10, sticky="w")
+        ttk.Label(merge_window, text="Field 字段").grid(row=1, column=0, padx=5, sticky="w")
+        ttk.Label(merge_window, text="Mine 我的").grid(row=1, column=1, padx=5, sticky="w")
+        ttk.Label(merge_window, text="Theirs 他人的").grid(row=1, column=2, padx=5, sticky="w")
+        
+        choices = {}
+        for row, (field, (mine, theirs)) in enumerate(conflict.conflicts.items(), start=2):
+            choices[field] = tk.StringVar(value="mine")
+            ttk.Label(merge_window, text=field).grid(row=row, column=0, padx=5, pady=2, sticky="w")
+            ttk.Radiobutton(merge_window, text=str(mine), value="mine",
+                            variable=choices[field]).grid(row=row, column=1, padx=5, pady=2, sticky="w")
+            ttk.Radiobutton(merge_window, text=str(theirs), value="theirs",
+                            variable=choices[field]).grid(row=row, column=2, padx=5, pady=2, sticky="w")
+        
+        result = {}
+        
+        def apply():
+            merged = dict(conflict.changes)
+            for field, choice in choices.items():
+                if choice.get() == "theirs":
+                    merged[field] = conflict.current[field]
+            result['changes'] = merged
+            merge_window.destroy()
+        
+        button_row = len(conflict.conflicts) + 2
+        ttk.Button(merge_window, text="Apply 应用", command=apply).grid(row=button_row, column=1, pady=10)
+        ttk.Button(merge_window, text="Cancel 取消",
+                   command=merge_window.destroy).grid(row=button_row, column=2, pady=10)
+        parent.wait_window(merge_window)
+        return result.get('changes')
+
     def delete_item(self, item_type):
-        """Delete selected item with improved error handling"""
-        tree = self.equipment_tree if item_type == "equipment" else self.chemicals_tree if item_type == "chemical" else self.consumables_tree if item_type == "consumable" else self.other_tree
+        """Delete the selected items in one transaction"""
+        if not self.require_permission("item.delete"):
+            return
+        
+        tree = self.trees[item_type]
         selected = tree.selection()
         
         if not selected:
@@ -946,130 +7057,359 @@ class LabInventorySystem:
             return
         
         try:
-            item_id = tree.item(selected[0])['values'][0]
-            item_name = tree.item(selected[0])['values'][1]
+            item_ids = [tree.item(iid)['values'][0] for iid in selected]
+            if len(item_ids) == 1:
+                item_name = tree.item(selected[0])['values'][1]
+                prompt = f"Are you sure you want to delete '{item_name}'?\n确定要删除 '{item_name}' 吗？"
+            else:
+                prompt = (f"Are you sure you want to delete {len(item_ids)} items?\n"
+                          f"确定要删除 {len(item_ids)} 个物品吗？")
             
-            if messagebox.askyesno("Confirm Delete", 
-                f"Are you sure you want to delete '{item_name}'?\n确定要删除 '{item_name}' 吗？"):
-                
-                self.cursor.execute("DELETE FROM items WHERE id = ?", (item_id,))
-                self.conn.commit()
+            if messagebox.askyesno("Confirm Delete", prompt):
+                self.bulk.delete(item_ids)
+                for item_id in item_ids:
+                    self.scheduler.refresh_item(item_id)
+                    self.thumbnails.discard(item_id)
                 
-                self.refresh_inventory(item_type, tree)
-                messagebox.showinfo("Success", "Item deleted successfully! 物品删除成功！")
+                self.pagers[str(tree)].remove_rows(item_ids)
+                messagebox.showinfo("Success", 
+                    f"{len(item_ids)} item(s) deleted successfully! 已删除 {len(item_ids)} 个物品！\n"
+                    "Tools > Undo Bulk Changes can restore them 可通过 工具 > 撤销批量操作 恢复")
+        
+        except Exception as e:
+            self.conn.rollback()
+            messagebox.showerror("Error", f"Failed to delete item: {str(e)}")
+
+    def bulk_edit_items(self, item_type):
+        """Set one field to the same value on every selected item"""
+        if not self.require_permission("item.edit"):
+            return
+        
+        tree = self.trees[item_type]
+        selected = tree.selection()
+        
+        if not selected:
+            messagebox.showwarning("Warning", "Please select items to edit 请选择要编辑的物品")
+            return
+        
+        item_ids = [tree.item(iid)['values'][0] for iid in selected]
+        
+        bulk_window = tk.Toplevel(self.root)
+        bulk_window.title(f"Bulk Edit 批量编辑 - {len(item_ids)} items")
+        bulk_window.transient(self.root)
+        bulk_window.grab_set()
+        
+        ttk.Label(bulk_window, text="Field 字段:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        field_var = tk.StringVar(value="location")
+        ttk.Combobox(bulk_window, textvariable=field_var, values=ItemEditor.EDITABLE_FIELDS,
+                     state="readonly").grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+        ttk.Label(bulk_window, text="New Value 新值:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
+        value_entry = ttk.Entry(bulk_window)
+        value_entry.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
+        
+        def apply():
+            field, value = field_var.get(), value_entry.get().strip()
+            try:
+                if field == "name" and not value:
+                    raise ValueError("Name is required")
+                if field == "quantity":
+                    value = int(value)
+                    if value < 0:
+                        raise ValueError("Quantity must be positive")
+                if field in ITEM_DATE_FIELDS:
+                    value = normalize_date(value)
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid value: {str(e)}", parent=bulk_window)
+                return
+            
+            try:
+                self.bulk.update(item_ids, field, value)
+                for item_id in item_ids:
+                    self.scheduler.refresh_item(item_id)
+                self.pagers[str(tree)].refresh_rows(item_ids)
+                bulk_window.destroy()
+                self.status_bar.config(text=f"Updated {field} on {len(item_ids)} items 已批量更新")
+            except Exception as e:
+                messagebox.showerror("Error", f"Bulk edit failed: {str(e)}", parent=bulk_window)
+        
+        ttk.Button(bulk_window, text="Apply 应用", command=apply).grid(row=2, column=0, columnspan=2, pady=10)
+
+    def show_lots(self, item_type):
+        """List the selected item's lots in consumption order and receive new ones"""
+        tree = self.trees[item_type]
+        selected = tree.selection()
+        
+        if not selected:
+            messagebox.showwarning("Warning", "Please select an item 请选择物品")
+            return
+        
+        item_id = tree.item(selected[0])['values'][0]
+        
+        lots_window = tk.Toplevel(self.root)
+        lots_window.title(f"Lots 批次 - {item_id}")
+        lots_window.geometry("650x450")
+        
+        columns = ("Lot 批号", "Expiry 有效期", "Quantity 数量", "Received 入库日期")
+        lots_tree = ttk.Treeview(lots_window, columns=columns, show='headings')
+        for col in columns:
+            lots_tree.heading(col, text=col)
+            lots_tree.column(col, width=140)
+        lots_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        show_empty_var = tk.BooleanVar(value=False)
+        
+        def refresh():
+            lots_tree.delete(*lots_tree.get_children())
+            for _, lot_number, expiry_date, quantity, received_date in self.lots.lots(item_id, show_empty_var.get()):
+                lots_tree.insert('', tk.END, values=(lot_number, expiry_date or "", quantity, received_date))
+        
+        form = ttk.LabelFrame(lots_window, text="Receive Lot 批次入库")
+        form.pack(fill=tk.X, padx=5, pady=5)
+        entries = {}
+        for column, (field, label) in enumerate((("lot_number", "Lot 批号"), ("quantity", "Quantity 数量"),
+                                                 ("expiry_date", "Expiry 有效期"),
+                                                 ("received_date", "Received 入库日期"))):
+            ttk.Label(form, text=label).grid(row=0, column=column, padx=2, sticky="w")
+            entries[field] = ttk.Entry(form, width=14)
+            entries[field].grid(row=1, column=column, padx=2, pady=2)
+        entries['received_date'].insert(0, date.today().isoformat())
+        
+        def receive():
+            if not self.require_permission("stock.receive"):
+                return
+            try:
+                quantity = int(entries['quantity'].get())
+                self.lots.receive(item_id, entries['lot_number'].get(), quantity,
+                                  entries['expiry_date'].get(), entries['received_date'].get())
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid input: {str(e)}", parent=lots_window)
+                return
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to receive lot: {str(e)}", parent=lots_window)
+                return
+            for field in ('lot_number', 'quantity', 'expiry_date'):
+                entries[field].delete(0, tk.END)
+            refresh()
+            self.refresh_inventory(item_type, tree)
+            self.refresh_usage_log()
+            self.check_alerts()
+        
+        ttk.Button(form, text="Receive 入库", command=receive).grid(row=1, column=4, padx=5)
+        ttk.Checkbutton(lots_window, text="Show used-up lots 显示已用完批次", variable=show_empty_var,
+                        command=refresh).pack(anchor="w", padx=5, pady=5)
+        refresh()
+
+    def show_item_history(self, item_type):
+        """Show the audit trail of the selected item and its state on a chosen date"""
+        tree = self.trees[item_type]
+        selected = tree.selection()
+        
+        if not selected:
+            messagebox.showwarning("Warning", "Please select an item 请选择物品")
+            return
+        
+        item_id = tree.item(selected[0])['values'][0]
+        
+        history_window = tk.Toplevel(self.root)
+        history_window.title(f"History 历史 - {item_id}")
+        history_window.geometry("750x450")
+        
+        columns = ("When 时间", "Operation 操作", "Field 字段", "Old 旧值", "New 新值")
+        history_tree = ttk.Treeview(history_window, columns=columns, show='headings')
+        for col in columns:
+            history_tree.heading(col, text=col)
+            history_tree.column(col, width=140)
+        history_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        try:
+            for changed_at, op, changes in self.audit.history(item_id):
+                for field, change in changes.items():
+                    old, new = change if op in ("UPDATE", "DELETE", "RESTORE") else (None, change)
+                    history_tree.insert('', tk.END, values=(
+                        changed_at[:19].replace("T", " "), op, field,
+                        "" if old is None else old, "" if new is None else new))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load history: {str(e)}", parent=history_window)
+        
+        state_frame = ttk.Frame(history_window)
+        state_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(state_frame, text="State on 某日状态 (YYYY-MM-DD):").pack(side=tk.LEFT, padx=5)
+        date_entry = ttk.Entry(state_frame, width=12)
+        date_entry.insert(0, date.today().isoformat())
+        date_entry.pack(side=tk.LEFT, padx=5)
+        state_label = ttk.Label(history_window, text="", justify=tk.LEFT, wraplength=720)
+        state_label.pack(fill=tk.X, padx=10, pady=5)
+        
+        def show_state():
+            try:
+                state = self.audit.state_at(item_id, normalize_date(date_entry.get()))
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid date: {str(e)}", parent=history_window)
+                return
+            if state is None:
+                state_label.config(text="Item did not exist on that date 该日期物品不存在")
+            else:
+                state_label.config(text="; ".join(f"{field}: {value}" for field, value in state.items()))
+        
+        ttk.Button(state_frame, text="Show 显示", command=show_state).pack(side=tk.LEFT, padx=5)
+
+    def show_bulk_history(self):
+        """List recent bulk operations and undo the selected one"""
+        history_window = tk.Toplevel(self.root)
+        history_window.title("Undo Bulk Changes 撤销批量操作")
+        history_window.geometry("700x350")
+        
+        columns = ("ID", "Operation 操作", "Field 字段", "Value 值", "Items 物品数", "When 时间", "Undone 已撤销")
+        history_tree = ttk.Treeview(history_window, columns=columns, show='headings', selectmode="browse")
+        for col in columns:
+            history_tree.heading(col, text=col)
+            history_tree.column(col, width=90)
+        history_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def refresh():
+            history_tree.delete(*history_tree.get_children())
+            for op_id, op, field, value, count, performed_at, undone_at in self.bulk.recent():
+                history_tree.insert('', tk.END, values=(
+                    op_id, op, field or "", value or "", count, performed_at[:16], (undone_at or "")[:16]))
+        
+        def undo():
+            selection = history_tree.selection()
+            if not selection or not self.require_permission("bulk.undo"):
+                return
+            op_id = history_tree.item(selection[0])['values'][0]
+            try:
+                item_ids = self.bulk.undo(op_id)
+                for item_id in item_ids:
+                    self.scheduler.refresh_item(item_id)
+                    self.thumbnails.discard(item_id)
+                # Restored rows must be placed in sort order, so reload the tabs
+                for item_type, tree in self.trees.items():
+                    self.refresh_inventory(item_type, tree)
+                self.refresh_usage_log()
+                refresh()
+            except Exception as e:
+                messagebox.showerror("Error", f"Undo failed: {str(e)}", parent=history_window)
+        
+        ttk.Button(history_window, text="Undo Selected 撤销所选", command=undo).pack(pady=5)
+        refresh()
+
+    def show_attachments(self, item_type):
+        """Show, add and export manuals, certificates and SDS sheets for the selected item"""
+        tree = self.trees[item_type]
+        selected = tree.selection()
+        
+        if not selected:
+            messagebox.showwarning("Warning", "Please select an item 请选择物品")
+            return
+        
+        item_id = tree.item(selected[0])['values'][0]
+        
+        attachments_window = tk.Toplevel(self.root)
+        attachments_window.title(f"Attachments 附件 - {item_id}")
+        attachments_window.geometry("700x350")
+        
+        columns = ("ID", "File 文件", "Kind 类型", "Size 大小", "Added 添加时间")
+        attachment_tree = ttk.Treeview(attachments_window, columns=columns, show='headings')
+        for col in columns:
+            attachment_tree.heading(col, text=col)
+            attachment_tree.column(col, width=60 if col == "ID" else 140)
+        attachment_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def refresh():
+            attachment_tree.delete(*attachment_tree.get_children())
+            for attachment_id, filename, kind, size, added_at, _ in self.attachments.list_attachments(item_id):
+                attachment_tree.insert('', tk.END, values=(
+                    attachment_id, filename, kind or "", f"{size / 1024:.1f} KB", added_at[:16]))
+        
+        def add():
+            if not self.require_permission("item.edit"):
+                return
+            paths = filedialog.askopenfilenames(
+                parent=attachments_window, initialdir=self.dirs['documents'], title="Attach Files 添加附件")
+            if not paths:
+                return
+            kind = simpledialog.askstring(
+                "Attachment Kind 附件类型", "Kind (manual, certificate, SDS...) 类型:", parent=attachments_window)
+            try:
+                reused = 0
+                for path in paths:
+                    reused += self.attachments.attach(item_id, path, kind or None)[2]
+                refresh()
+                if reused:
+                    messagebox.showinfo("Attachments 附件",
+                        f"{reused} file(s) were already stored and have been linked without copying\n"
+                        f"{reused} 个文件已存在，已直接关联",
+                        parent=attachments_window)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to attach file: {str(e)}", parent=attachments_window)
+        
+        def save_as():
+            selection = attachment_tree.selection()
+            if not selection:
+                return
+            attachment_id, filename = attachment_tree.item(selection[0])['values'][:2]
+            destination = filedialog.asksaveasfilename(
+                parent=attachments_window, initialdir=self.dirs['documents'], initialfile=filename)
+            if not destination:
+                return
+            try:
+                self.attachments.export(attachment_id, destination)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save attachment: {str(e)}", parent=attachments_window)
+        
+        def remove():
+            selection = attachment_tree.selection()
+            if not selection or not self.require_permission("item.edit"):
+                return
+            if not messagebox.askyesno(
+                    "Confirm", "Remove selected attachments? 删除所选附件？", parent=attachments_window):
+                return
+            try:
+                self.attachments.detach([attachment_tree.item(i)['values'][0] for i in selection])
+                self.attachments.collect_garbage()
+                refresh()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to remove attachment: {str(e)}", parent=attachments_window)
         
+        button_frame = ttk.Frame(attachments_window)
+        button_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(button_frame, text="Add 添加", command=add).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Save As 另存为", command=save_as).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Remove 删除", command=remove).pack(side=tk.LEFT, padx=5)
+        
+        refresh()
+
+    def clean_up_attachments(self):
+        """Remove unreferenced and stray attachment blobs from disk"""
+        if not self.require_permission("database.admin"):
+            return
+        try:
+            removed, freed = self.attachments.collect_garbage(scan_disk=True)
+            messagebox.showinfo("Clean Up Attachments 清理附件",
+                f"Removed {removed} unused file(s), freed {freed / (1024 * 1024):.1f} MB\n"
+                f"已删除 {removed} 个未使用文件")
         except Exception as e:
-            self.conn.rollback()
-            messagebox.showerror("Error", f"Failed to delete item: {str(e)}")
+            messagebox.showerror("Error", f"Failed to clean up attachments: {str(e)}")
 
     def search_items(self, item_type, tree, search_var):
         """Search items with improved search logic"""
-        search_term = search_var.get().lower().strip()
-        
-        for item in tree.get_children():
-            tree.delete(item)
-        
         try:
-            if search_term:
-                self.cursor.execute("""
-                    SELECT id, name, name_cn, category, location, quantity, unit
-                    FROM items
-                    WHERE item_type = ? AND (
-                        LOWER(name) LIKE ? OR
-                        LOWER(COALESCE(name_cn, '')) LIKE ? OR
-                        LOWER(COALESCE(category, '')) LIKE ? OR
-                        LOWER(COALESCE(location, '')) LIKE ? OR
-                        LOWER(COALESCE(unit, '')) LIKE ?
-                    )
-                """, (
-                    item_type,
-                    f"%{search_term}%",
-                    f"%{search_term}%",
-                    f"%{search_term}%",
-                    f"%{search_term}%",
-                    f"%{search_term}%"
-                ))
-            else:
-                self.cursor.execute("""
-                    SELECT id, name, name_cn, category, location, quantity, unit
-                    FROM items
-                    WHERE item_type = ?
-                """, (item_type,))
-            
-            for row in self.cursor.fetchall():
-                tree.insert("", "end", values=row)
-            
+            self.pagers[str(tree)].set_search(search_var.get(), INVENTORY_SEARCH_COLUMNS)
         except Exception as e:
             messagebox.showerror("Error", f"Search failed: {str(e)}")
 
     def refresh_inventory(self, item_type, tree):
         """Refresh inventory display with error handling"""
-        for item in tree.get_children():
-            tree.delete(item)
-        
         try:
-            # Fetch data from the database
-            self.cursor.execute("""
-                SELECT id, name, name_cn, category, location, quantity, unit,
-                    manufacturer, model_number, serial_number, purchase_date,
-                    warranty_until, maintenance_contact, last_calibration,
-                    next_calibration, safety_classification
-                FROM items
-                WHERE item_type = ?
-                ORDER BY name
-            """, (item_type,))
-            
-            # Fetch all rows
-            rows = self.cursor.fetchall()
-            
-            # Debug: Print the number of columns in the Treeview
-            print(f"Number of Treeview columns: {len(tree['columns'])}")
-            
-            # Debug: Print the number of values returned by the SQL query
-            if rows:
-                print(f"Number of values returned by SQL query: {len(rows[0])}")
-            else:
-                print("No rows returned by SQL query.")
-            
-            # Check if the number of columns in the Treeview matches the number of values
-            columns = tree["columns"]
-            if rows and len(columns) != len(rows[0]):
-                raise ValueError(f"Number of Treeview columns ({len(columns)}) does not match the number of values ({len(rows[0])})")
-            
-            # Insert rows into the Treeview
-            for row in rows:
-                tree.insert("", "end", values=row)
-                    
+            # Reload the first page with the tab's current sort, filters and search
+            self.pagers[str(tree)].reload()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to refresh inventory: {str(e)}")
 
     def refresh_usage_log(self):
         """Refresh usage log display with improved error handling"""
-        for item in self.usage_tree.get_children():
-            self.usage_tree.delete(item)
-        
         try:
-            self.cursor.execute("""
-                SELECT u.id, i.name, u.user, u.user_department,
-                       u.quantity_changed, u.timestamp, u.purpose,
-                       CASE WHEN u.return_time IS NULL THEN 'Active' 
-                            ELSE 'Returned' END as status
-                FROM usage_log u
-                JOIN items i ON u.item_id = i.id
-                ORDER BY u.timestamp DESC
-            """)
-            
-            for row in self.cursor.fetchall():
-                # Format timestamp
-                row = list(row)
-                if isinstance(row[5], str):
-                    timestamp = datetime.fromisoformat(row[5])
-                else:
-                    timestamp = row[5]
-                row[5] = timestamp.strftime("%Y-%m-%d %H:%M")
-                
-                self.usage_tree.insert("", "end", values=row)
-                
+            self.usage_pager.reload()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to refresh usage log: {str(e)}")
 
@@ -1086,304 +7426,1273 @@ class LabInventorySystem:
             if not report_path:
                 return
             
-            # Create PDF document
+            # Create PDF document; flowables are generated as reportlab consumes them
             doc = SimpleDocTemplate(report_path, pagesize=letter)
-            styles = getSampleStyleSheet()
-            elements = []
-            
-            # Title
-            title_style = ParagraphStyle(
-                'CustomTitle',
-                parent=styles['Title'],
-                fontSize=24,
-                spaceAfter=30
-            )
-            elements.append(Paragraph("DNA Virology Laboratory Inventory Report", title_style))
-            
-            # Date
-            elements.append(Paragraph(
-                f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-                styles['Normal']
-            ))
-            elements.append(Paragraph("<br/><br/>", styles['Normal']))
-            
-            # Inventory Summary
-            elements.append(Paragraph("Inventory Summary", styles['Heading1']))
-            
-            self.cursor.execute("""
-                SELECT item_type,
-                       COUNT(*) as total_items,
-                       SUM(CASE WHEN quantity <= 0 THEN 1 ELSE 0 END) as out_of_stock,
-                       SUM(quantity) as total_quantity
-                FROM items
-                GROUP BY item_type
-            """)
-            
-            summary_data = [['Type', 'Total Items', 'Out of Stock', 'Total Quantity']]
-            summary_data.extend(self.cursor.fetchall())
-            
-            summary_table = Table(summary_data)
-            summary_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 12),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-                ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-                ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                ('FONTSIZE', (0, 1), (-1, -1), 10),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('BOX', (0, 0), (-1, -1), 2, colors.black)
-            ]))
-            elements.append(summary_table)
-            elements.append(Paragraph("<br/><br/>", styles['Normal']))
-            
-            # Equipment List
-            elements.append(Paragraph("Equipment Inventory", styles['Heading1']))
-            
-            self.cursor.execute("""
-                SELECT name, name_cn, category, location, quantity, unit, manufacturer
-                FROM items
-                WHERE item_type = 'equipment'
-                ORDER BY category, name
-            """)
-            
-            equipment_data = [['Name', 'Chinese Name', 'Category', 'Location', 'Quantity', 'Unit', 'Manufacturer']]
-            equipment_data.extend(self.cursor.fetchall())
+            with self.memory_budget.track("Report"):
+                doc.build(FlowableStream(self.report_flowables(doc)))
+            self.status_bar.config(text=self.memory_budget.describe())
+            messagebox.showinfo("Success", f"Report generated successfully!\n报告已生成: {report_path}")
             
-            equipment_table = Table(equipment_data)
-            equipment_table.setStyle(TableStyle([
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to generate report: {str(e)}")
+
+    def report_flowables(self, doc):
+        """Yield the report's flowables, reading each inventory section in batches"""
+        styles = getSampleStyleSheet()
+        
+        # Title
+        title_style = ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Title'],
+            fontSize=24,
+            spaceAfter=30
+        )
+        yield Paragraph("DNA Virology Laboratory Inventory Report", title_style)
+        
+        # Date
+        yield Paragraph(
+            f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            styles['Normal']
+        )
+        yield Paragraph("<br/><br/>", styles['Normal'])
+        
+        # Built-in and plugin sections in registry order
+        for section in self.plugins.report_sections():
+            yield Paragraph(section.title, styles['Heading1'])
+            yield from section.render(self, doc, styles)
+            yield Paragraph("<br/><br/>", styles['Normal'])
+
+    def report_summary(self):
+        """Yield the per-type totals table"""
+        self.cursor.execute("""
+            SELECT item_type,
+                   COUNT(*) as total_items,
+                   SUM(CASE WHEN quantity <= 0 THEN 1 ELSE 0 END) as out_of_stock,
+                   SUM(quantity) as total_quantity
+            FROM items
+            WHERE deleted_at IS NULL
+            GROUP BY item_type
+        """)
+        
+        summary_data = [['Type', 'Total Items', 'Out of Stock', 'Total Quantity']]
+        summary_data.extend(self.cursor.fetchall())
+        
+        summary_table = Table(summary_data)
+        summary_table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 12),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
+            ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+            ('FONTSIZE', (0, 1), (-1, -1), 10),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('BOX', (0, 0), (-1, -1), 2, colors.black)
+        ]))
+        yield summary_table
+
+    def report_inventory_tables(self, doc, item_type, rows_per_table=100):
+        """Yield one section's rows as a run of fixed-width tables"""
+        header = ['Name', 'Chinese Name', 'Category', 'Location', 'Quantity', 'Unit', 'Manufacturer']
+        # Fixed widths keep consecutive tables aligned
+        col_widths = [doc.width * share for share in (0.2, 0.16, 0.13, 0.15, 0.09, 0.08, 0.19)]
+        rows = self.memory_budget.iter_rows(self.conn, """
+            SELECT name, name_cn, category, location, quantity, unit, manufacturer
+            FROM items
+            WHERE item_type = ? AND deleted_at IS NULL
+            ORDER BY category, name
+        """, (item_type,))
+        
+        chunk = [header]
+        first = True
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= rows_per_table:
+                yield self.report_inventory_table(chunk, col_widths, first)
+                chunk, first = [], False
+        if chunk:
+            yield self.report_inventory_table(chunk, col_widths, first)
+
+    def report_inventory_table(self, data, col_widths, has_header):
+        table = Table(data, colWidths=col_widths)
+        body_start = 1 if has_header else 0
+        style = [
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('BACKGROUND', (0, body_start), (-1, -1), colors.white),
+            ('TEXTCOLOR', (0, body_start), (-1, -1), colors.black),
+            ('FONTNAME', (0, body_start), (-1, -1), 'Helvetica'),
+            ('FONTSIZE', (0, body_start), (-1, -1), 8),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('BOX', (0, 0), (-1, -1), 2, colors.black)
+        ]
+        if has_header:
+            style[:0] = [
                 ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
                 ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
                 ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
                 ('FONTSIZE', (0, 0), (-1, 0), 10),
                 ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-                ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-                ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                ('FONTSIZE', (0, 1), (-1, -1), 8),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('BOX', (0, 0), (-1, -1), 2, colors.black)
-            ]))
-            elements.append(equipment_table)
-            elements.append(Paragraph("<br/><br/>", styles['Normal']))
+            ]
+        # Chinese names need the CJK font; Helvetica would print boxes
+        style.extend(PDFFonts.table_styles(data, body_start))
+        table.setStyle(TableStyle(style))
+        return table
+
+    def export_inventory(self):
+        """Export inventory data to CSV"""
+        try:
+            export_path = filedialog.asksaveasfilename(
+                defaultextension=".csv",
+                initialdir=self.dirs['exports'],
+                title="Export Inventory",
+                filetypes=[("CSV files", "*.csv")]
+            )
             
-            # Chemicals List
-            elements.append(Paragraph("Chemicals Inventory", styles['Heading1']))
+            if not export_path:
+                return
             
-            self.cursor.execute("""
-                SELECT name, name_cn, category, location, quantity, unit, manufacturer
+            sql = """
+                SELECT id, name, name_cn, category, location, quantity, unit,
+                       manufacturer, model_number, serial_number, purchase_date,
+                       warranty_until, maintenance_contact, last_calibration,
+                       next_calibration, safety_classification, last_updated, notes
                 FROM items
-                WHERE item_type = 'chemical'
-                ORDER BY category, name
-            """)
-            
-            chemicals_data = [['Name', 'Chinese Name', 'Category', 'Location', 'Quantity', 'Unit', 'Manufacturer']]
-            chemicals_data.extend(self.cursor.fetchall())
-            
-            chemicals_table = Table(chemicals_data)
-            chemicals_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 10),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-                ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-                ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                ('FONTSIZE', (0, 1), (-1, -1), 8),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('BOX', (0, 0), (-1, -1), 2, colors.black)
-            ]))
-            elements.append(chemicals_table)
+                WHERE deleted_at IS NULL
+                ORDER BY item_type, category, name
+            """
             
-            # Consumables List
-            elements.append(Paragraph("Consumables Inventory", styles['Heading1']))
+            with self.memory_budget.track("Inventory export"), \
+                    open(export_path, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.writer(csvfile)
+                # Write header
+                writer.writerow([
+                    'ID', 'Name', 'Chinese Name', 'Category', 'Location',
+                    'Quantity', 'Unit', 'Manufacturer', 'Model Number', 
+                    'Serial Number', 'Purchase Date', 'Warranty Until', 
+                    'Maintenance Contact', 'Last Calibration', 'Next calibration',
+                    'Safety Classification', 'Last Updated', 'Notes'
+                ])
+                # Write data
+                writer.writerows(self.memory_budget.iter_rows(self.conn, sql))
             
-            self.cursor.execute("""
-                SELECT name, name_cn, category, location, quantity, unit, manufacturer
-                FROM items
-                WHERE item_type = 'consumable'
-                ORDER BY category, name
-            """)
+            self.status_bar.config(text=self.memory_budget.describe())
+            messagebox.showinfo("Success", f"Inventory exported successfully!\n库存已导出: {export_path}")
             
-            consumables_data = [['Name', 'Chinese Name', 'Category', 'Location', 'Quantity', 'Unit', 'Manufacturer']]
-            consumables_data.extend(self.cursor.fetchall())
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export inventory: {str(e)}")
+
+    def export_usage_log(self):
+        """Export usage log data to CSV"""
+        try:
+            export_path = filedialog.asksaveasfilename(
+                defaultextension=".csv",
+                initialdir=self.dirs['exports'],
+                title="Export Usage Log",
+                filetypes=[("CSV files", "*.csv")]
+            )
             
-            consumables_table = Table(consumables_data)
-            consumables_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 10),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-                ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-                ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                ('FONTSIZE', (0, 1), (-1, -1), 8),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('BOX', (0, 0), (-1, -1), 2, colors.black)
-            ]))
-            elements.append(consumables_table)
+            if not export_path:
+                return
             
-            # Other Items List
-            elements.append(Paragraph("Other Inventory", styles['Heading1']))
+            sql = """
+                SELECT u.id, i.name, i.name_cn, u.user, u.user_department,
+                       u.quantity_changed, u.timestamp, u.purpose,
+                       u.supervisor_approval, u.return_time, u.notes
+                FROM usage_log u
+                JOIN items i ON u.item_id = i.id
+                ORDER BY u.timestamp DESC
+            """
             
-            self.cursor.execute("""
-                SELECT name, name_cn, category, location, quantity, unit, manufacturer
-                FROM items
-                WHERE item_type = 'other'
-                ORDER BY category, name
-            """)
+            with self.memory_budget.track("Usage log export"), \
+                    open(export_path, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.writer(csvfile)
+                # Write header
+                writer.writerow([
+                    'ID', 'Item Name', 'Item Chinese Name', 'User', 'Department',
+                    'Quantity Changed', 'Timestamp', 'Purpose',
+                    'Supervisor Approval', 'Return Time', 'Notes'
+                ])
+                # Write data
+                writer.writerows(self.memory_budget.iter_rows(self.conn, sql))
             
-            other_data = [['Name', 'Chinese Name', 'Category', 'Location', 'Quantity', 'Unit', 'Manufacturer']]
-            other_data.extend(self.cursor.fetchall())
+            self.status_bar.config(text=self.memory_budget.describe())
+            messagebox.showinfo("Success", f"Usage log exported successfully!\n使用记录已导出: {export_path}")
             
-            other_table = Table(other_data)
-            other_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 10),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-                ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-                ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                ('FONTSIZE', (0, 1), (-1, -1), 8),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('BOX', (0, 0), (-1, -1), 2, colors.black)
-            ]))
-            elements.append(other_table)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export usage log: {str(e)}")
+
+    def backup_database(self):
+        """Write a compressed, optionally encrypted backup (full or incremental)"""
+        try:
+            passphrase = simpledialog.askstring(
+                "Backup 备份",
+                "Passphrase to encrypt the backup (leave empty for none)\n加密密码(留空则不加密):",
+                show='*', parent=self.root
+            )
+            if passphrase is None:
+                return
             
-            # Build PDF
-            doc.build(elements)
-            messagebox.showinfo("Success", f"Report generated successfully!\n报告已生成: {report_path}")
+            header = self.backups.backup(self.conn, passphrase or None)
+            kind = "Full 完整" if header['kind'] == "full" else "Incremental 增量"
+            messagebox.showinfo(
+                "Success",
+                f"Database backed up successfully!\n数据库已备份: {header['path']}\n"
+                f"{kind}: {header['pages_stored']}/{header['page_count']} pages 页, "
+                f"{header['stored_bytes'] / 1024:.1f} KB ({header['compression']}"
+                f"{', encrypted 已加密' if header['encrypted'] else ''})"
+            )
             
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to generate report: {str(e)}")
+            messagebox.showerror("Error", f"Failed to backup database: {str(e)}")
+
+    def show_backups(self):
+        """List backup archives, verify them and restore any point in time"""
+        backups_window = tk.Toplevel(self.root)
+        backups_window.title("Backups 备份")
+        backups_window.geometry("800x420")
+        
+        columns = ("Backup 备份", "Created 时间", "Type 类型", "Pages 页数", "Size 大小", "Encrypted 加密", "Status 状态")
+        backups_tree = ttk.Treeview(backups_window, columns=columns, show='headings')
+        for col in columns:
+            backups_tree.heading(col, text=col)
+            backups_tree.column(col, width=100)
+        backups_tree.column(columns[0], width=240)
+        backups_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def refresh(status=None):
+            backups_tree.delete(*backups_tree.get_children())
+            for header in self.backups.archives():
+                backups_tree.insert('', tk.END, iid=header['name'], values=(
+                    header['name'], header['created'][:19].replace("T", " "), header['kind'],
+                    f"{header['pages_stored']}/{header['page_count']}",
+                    f"{header['path'].stat().st_size / 1024:.1f} KB",
+                    "Yes 是" if header['encrypted'] else "No 否",
+                    (status or {}).get(header['name'], "")
+                ))
+        
+        def ask_passphrase(encrypted):
+            if not encrypted:
+                return None
+            return simpledialog.askstring("Passphrase 密码", "Backup passphrase 备份密码:",
+                                          show='*', parent=backups_window)
+        
+        def verify():
+            try:
+                encrypted = any(h['encrypted'] for h in self.backups.archives())
+                results = self.backups.verify(ask_passphrase(encrypted))
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to verify backups: {str(e)}", parent=backups_window)
+                return
+            refresh({name: "OK 正常" if error is None else error for name, error in results})
+            failed = [name for name, error in results if error]
+            if failed:
+                messagebox.showwarning("Warning", f"{len(failed)} backup(s) failed verification\n{len(failed)} 个备份校验失败",
+                                       parent=backups_window)
+            else:
+                messagebox.showinfo("Success", f"All {len(results)} backups verified\n所有备份校验通过", parent=backups_window)
+        
+        def restore():
+            if not self.require_permission("database.admin"):
+                return
+            selected = backups_tree.selection()
+            if not selected:
+                messagebox.showwarning("Warning", "Please select a backup 请选择备份", parent=backups_window)
+                return
+            destination = filedialog.asksaveasfilename(
+                parent=backups_window,
+                initialdir=self.dirs['data'] / "backups",
+                initialfile=f"{selected[0]}.db",
+                defaultextension=".db",
+                filetypes=[("SQLite databases", "*.db")]
+            )
+            if not destination:
+                return
+            if Path(destination).resolve() == (self.dirs['data'] / "lab_inventory.db").resolve():
+                messagebox.showerror("Error", "Restore to a new file, not the open database\n请恢复到新文件", parent=backups_window)
+                return
+            try:
+                encrypted = any(h['encrypted'] for h in self.backups.archives() if h['name'] == selected[0])
+                self.backups.restore(selected[0], destination, ask_passphrase(encrypted))
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to restore backup: {str(e)}", parent=backups_window)
+                return
+            messagebox.showinfo("Success", f"Backup restored 备份已恢复: {destination}", parent=backups_window)
+        
+        buttons = ttk.Frame(backups_window)
+        buttons.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(buttons, text="Verify All 全部校验", command=verify).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Restore To File 恢复到文件", command=restore).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Refresh 刷新", command=refresh).pack(side=tk.LEFT, padx=2)
+        refresh()
+
+    def show_maintenance(self):
+        """Run the integrity checks and repair, analyze or vacuum the database"""
+        maintenance_window = tk.Toplevel(self.root)
+        maintenance_window.title("Check & Repair Database 检查与修复数据库")
+        maintenance_window.geometry("800x400")
+        
+        columns = ("Check 检查项", "Problems 问题数", "Examples 示例")
+        checks_tree = ttk.Treeview(maintenance_window, columns=columns, show='headings')
+        for col in columns:
+            checks_tree.heading(col, text=col)
+        checks_tree.column(columns[0], width=220)
+        checks_tree.column(columns[1], width=90)
+        checks_tree.column(columns[2], width=460)
+        checks_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        status_label = ttk.Label(maintenance_window, text="")
+        status_label.pack(fill=tk.X, padx=5)
+        
+        def show(results):
+            checks_tree.delete(*checks_tree.get_children())
+            for key, label, count, samples in results:
+                checks_tree.insert('', tk.END, iid=key, values=(label, count, "; ".join(map(str, samples))))
+            due = self.maintenance.due_tasks()
+            status_label.config(text=f"Free space 空闲页: {self.maintenance.free_ratio():.0%}    "
+                                     f"Due 待执行: {', '.join(due) or '-'}")
+        
+        def recheck():
+            try:
+                show(self.maintenance.check())
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to check database: {str(e)}", parent=maintenance_window)
+        
+        def repair():
+            if not self.require_permission("database.admin"):
+                return
+            keys = checks_tree.selection() or None
+            if not messagebox.askyesno("Confirm",
+                                       "Repair the selected checks (all when none is selected)?\n修复所选检查项(未选择则全部)?",
+                                       parent=maintenance_window):
+                return
+            try:
+                show(self.maintenance.repair(keys))
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to repair database: {str(e)}", parent=maintenance_window)
+                return
+            self.refresh_after_check_in()
+        
+        def run(task):
+            if not self.require_permission("database.admin"):
+                return
+            try:
+                getattr(self.maintenance, task)()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to run {task}: {str(e)}", parent=maintenance_window)
+                return
+            recheck()
+        
+        buttons = ttk.Frame(maintenance_window)
+        buttons.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(buttons, text="Re-check 重新检查", command=recheck).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Repair 修复", command=repair).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Analyze 更新统计", command=lambda: run("analyze")).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Vacuum 压缩", command=lambda: run("vacuum")).pack(side=tk.LEFT, padx=2)
+        recheck()
+
+    def log_in(self):
+        """Ask for credentials (or create the first account); returns a Session or None"""
+        first_run = self.access.user_count() == 0
+        login_window = tk.Toplevel(self.root)
+        login_window.title("Create Administrator 创建管理员" if first_run else "Sign In 登录")
+        login_window.resizable(False, False)
+        login_window.grab_set()
+        
+        fields = [("username", "Username 用户名", ""), ("password", "Password 密码", "*")]
+        if first_run:
+            fields.insert(1, ("display_name", "Full Name 姓名", ""))
+            fields.append(("confirm", "Confirm Password 确认密码", "*"))
+        entries = {}
+        for row, (field, label, show) in enumerate(fields):
+            ttk.Label(login_window, text=label).grid(row=row, column=0, padx=5, pady=5, sticky="w")
+            entries[field] = ttk.Entry(login_window, show=show)
+            entries[field].grid(row=row, column=1, padx=5, pady=5, sticky="ew")
+        entries['username'].focus_set()
+        result = {}
+        
+        def submit(event=None):
+            username = entries['username'].get().strip()
+            password = entries['password'].get()
+            try:
+                if first_run:
+                    if password != entries['confirm'].get():
+                        raise ValueError("Passwords do not match 两次密码不一致")
+                    self.access.create_user(username, password, "supervisor", entries['display_name'].get())
+                session = self.access.authenticate(username, password)
+            except ValueError as e:
+                messagebox.showerror("Error", str(e), parent=login_window)
+                return
+            if session is None:
+                entries['password'].delete(0, tk.END)
+                messagebox.showerror("Error", "Invalid username or password 用户名或密码错误", parent=login_window)
+                return
+            result['session'] = session
+            login_window.destroy()
+        
+        ttk.Button(login_window, text="OK 确定", command=submit).grid(
+            row=len(fields), column=0, columnspan=2, pady=10)
+        login_window.bind("<Return>", submit)
+        self.root.wait_window(login_window)
+        return result.get('session')
+
+    def show_signed_in_user(self):
+        self.root.title(f"DNA Virology Lab Management System-ICGEB China RRC - "
+                        f"{self.session.display_name} ({self.session.role})")
 
-    def export_inventory(self):
-        """Export inventory data to CSV"""
+    def switch_user(self):
+        """Sign in as someone else; the current session stays if the dialog is closed"""
+        session = self.log_in()
+        if session is not None:
+            self.session = session
+            self.show_signed_in_user()
+
+    def reload_session(self):
+        """Pick up role or permission changes made to the signed-in account"""
+        for username, display_name, role, active, _ in self.access.users():
+            if username == self.session.username and active:
+                self.session = Session(username, display_name or username, role, self.access.permissions(role))
+                self.show_signed_in_user()
+                return
+
+    def require_permission(self, permission):
+        """True when the signed-in user holds `permission`; otherwise explain and return False"""
         try:
-            export_path = filedialog.asksaveasfilename(
-                defaultextension=".csv",
-                initialdir=self.dirs['exports'],
-                title="Export Inventory",
-                filetypes=[("CSV files", "*.csv")]
-            )
-            
-            if not export_path:
+            self.session.require(permission)
+            return True
+        except AccessDenied as e:
+            messagebox.showwarning("Access Denied 权限不足", f"{str(e)}\n当前角色无此权限")
+            return False
+
+    def show_approvals(self):
+        """Approve or reject pending check-out requests in batches"""
+        if not self.require_permission("usage.approve"):
+            return
+        
+        approvals_window = tk.Toplevel(self.root)
+        approvals_window.title("Approval Queue 审批队列")
+        approvals_window.geometry("950x420")
+        
+        columns = ("Request 申请", "Item ID 物品编号", "Name 名称", "Quantity 数量", "In Stock 库存",
+                   "User 用户", "Purpose 目的", "Requested By 申请人", "Requested 申请时间")
+        requests_tree = ttk.Treeview(approvals_window, columns=columns, show='headings', selectmode='extended')
+        for col in columns:
+            requests_tree.heading(col, text=col)
+            requests_tree.column(col, width=100)
+        requests_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        pending = {}
+        
+        def refresh():
+            requests_tree.delete(*requests_tree.get_children())
+            pending.clear()
+            for row in self.access.pending():
+                pending[str(row[0])] = row
+                requests_tree.insert('', tk.END, iid=str(row[0]), values=(*row[:-1], row[-1][:16].replace("T", " ")))
+        
+        def selected_ids():
+            selected = requests_tree.selection()
+            if not selected:
+                messagebox.showwarning("Warning", "Please select requests 请选择申请", parent=approvals_window)
+            return [int(iid) for iid in selected]
+        
+        def approve():
+            request_ids = selected_ids()
+            if not request_ids:
                 return
-            
-            self.cursor.execute("""
-                SELECT id, name, name_cn, category, location, quantity, unit,
-                       manufacturer, model_number, serial_number, purchase_date,
-                       warranty_until, maintenance_contact, last_calibration,
-                       next_calibration, safety_classification, last_updated, notes
-                FROM items
-                ORDER BY item_type, category, name
-            """)
-            
-            with open(export_path, 'w', newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-                # Write header
-                writer.writerow([
-                    'ID', 'Name', 'Chinese Name', 'Category', 'Location',
-                    'Quantity', 'Unit', 'Manufacturer', 'Model Number', 
-                    'Serial Number', 'Purchase Date', 'Warranty Until', 
-                    'Maintenance Contact', 'Last Calibration', 'Next calibration',
-                    'Safety Classification', 'Last Updated', 'Notes'
-                ])
-                # Write data
-                writer.writerows(self.cursor.fetchall())
-            
-            messagebox.showinfo("Success", f"Inventory exported successfully!\n库存已导出: {export_path}")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to export inventory: {str(e)}")
+            try:
+                approved, skipped = self.access.approve(self.session, request_ids)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to approve requests: {str(e)}", parent=approvals_window)
+                return
+            for request_id, _ in approved:
+                _, item_id, _, quantity, _, user, _, _, _ = pending[str(request_id)]
+                self.blockchain.add_transaction({
+                    'item_id': item_id,
+                    'user': user,
+                    'quantity_changed': quantity,
+                    'approved_by': self.session.username,
+                    'timestamp': str(datetime.now())
+                })
+            refresh()
+            self.refresh_after_check_in()
+            self.check_alerts()
+            message = f"{len(approved)} request(s) approved 已批准 {len(approved)} 项"
+            if skipped:
+                message += "\n\n" + "\n".join(f"#{request_id}: {reason}" for request_id, reason in skipped)
+            messagebox.showinfo("Approval Queue 审批队列", message, parent=approvals_window)
+        
+        def reject():
+            request_ids = selected_ids()
+            if not request_ids:
+                return
+            if not messagebox.askyesno("Confirm", f"Reject {len(request_ids)} request(s)?\n拒绝 {len(request_ids)} 项申请?",
+                                       parent=approvals_window):
+                return
+            try:
+                self.access.reject(self.session, request_ids)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to reject requests: {str(e)}", parent=approvals_window)
+                return
+            refresh()
+        
+        buttons = ttk.Frame(approvals_window)
+        buttons.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(buttons, text="Select All 全选",
+                   command=lambda: requests_tree.selection_set(requests_tree.get_children())).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Approve 批准", command=approve).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Reject 拒绝", command=reject).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Refresh 刷新", command=refresh).pack(side=tk.LEFT, padx=2)
+        refresh()
 
-    def export_usage_log(self):
-        """Export usage log data to CSV"""
+    def show_users(self):
+        """Manage accounts and what each role may do"""
+        if not self.require_permission("users.manage"):
+            return
+        
+        users_window = tk.Toplevel(self.root)
+        users_window.title("Users & Roles 用户与角色")
+        users_window.geometry("750x600")
+        
+        columns = ("Username 用户名", "Name 姓名", "Role 角色", "Active 启用", "Last Sign-in 最近登录")
+        users_tree = ttk.Treeview(users_window, columns=columns, show='headings', selectmode='browse')
+        for col in columns:
+            users_tree.heading(col, text=col)
+            users_tree.column(col, width=140)
+        users_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def refresh():
+            users_tree.delete(*users_tree.get_children())
+            for username, display_name, role, active, last_login in self.access.users():
+                users_tree.insert('', tk.END, iid=username, values=(
+                    username, display_name or "", role, "Yes 是" if active else "No 否",
+                    (last_login or "")[:16].replace("T", " ")))
+        
+        form = ttk.LabelFrame(users_window, text="Account 账户")
+        form.pack(fill=tk.X, padx=5, pady=5)
+        entries = {}
+        for column, (field, label, show) in enumerate((("username", "Username 用户名", ""),
+                                                       ("display_name", "Full Name 姓名", ""),
+                                                       ("password", "Password 密码", "*"))):
+            ttk.Label(form, text=label).grid(row=0, column=column, padx=2, sticky="w")
+            entries[field] = ttk.Entry(form, width=16, show=show)
+            entries[field].grid(row=1, column=column, padx=2, pady=2)
+        ttk.Label(form, text="Role 角色").grid(row=0, column=3, padx=2, sticky="w")
+        role_var = tk.StringVar(value="technician")
+        ttk.Combobox(form, textvariable=role_var, values=self.access.roles(), state="readonly",
+                     width=14).grid(row=1, column=3, padx=2, pady=2)
+        
+        def selected_user():
+            selected = users_tree.selection()
+            if not selected:
+                messagebox.showwarning("Warning", "Please select a user 请选择用户", parent=users_window)
+                return None
+            return selected[0]
+        
+        def run(action, *args):
+            try:
+                action(*args)
+            except ValueError as e:
+                messagebox.showerror("Error", str(e), parent=users_window)
+                return
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to update user: {str(e)}", parent=users_window)
+                return
+            entries['password'].delete(0, tk.END)
+            refresh()
+            self.reload_session()
+        
+        def add_user():
+            run(self.access.create_user, entries['username'].get(), entries['password'].get(),
+                role_var.get(), entries['display_name'].get())
+        
+        def set_role():
+            username = selected_user()
+            if username:
+                run(self.access.set_role, username, role_var.get())
+        
+        def reset_password():
+            username = selected_user()
+            if username:
+                run(self.access.set_password, username, entries['password'].get())
+        
+        def toggle_active():
+            username = selected_user()
+            if username:
+                active = any(name == username and is_active for name, _, _, is_active, _ in self.access.users())
+                run(self.access.set_active, username, not active)
+        
+        buttons = ttk.Frame(form)
+        buttons.grid(row=2, column=0, columnspan=4, sticky="w", pady=5)
+        ttk.Button(buttons, text="Add User 添加用户", command=add_user).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Set Role 设置角色", command=set_role).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Reset Password 重置密码", command=reset_password).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Enable/Disable 启用/停用", command=toggle_active).pack(side=tk.LEFT, padx=2)
+        
+        permissions_frame = ttk.LabelFrame(users_window, text="Role Permissions 角色权限")
+        permissions_frame.pack(fill=tk.X, padx=5, pady=5)
+        permission_role_var = tk.StringVar(value="technician")
+        permission_vars = {permission: tk.BooleanVar() for permission in AccessControl.PERMISSIONS}
+        
+        def load_permissions(event=None):
+            granted = self.access.permissions(permission_role_var.get())
+            for permission, var in permission_vars.items():
+                var.set(permission in granted)
+        
+        def save_permissions():
+            run(self.access.set_permissions, permission_role_var.get(),
+                [permission for permission, var in permission_vars.items() if var.get()])
+            load_permissions()
+        
+        role_box = ttk.Combobox(permissions_frame, textvariable=permission_role_var, values=self.access.roles(),
+                                state="readonly", width=14)
+        role_box.grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        role_box.bind("<<ComboboxSelected>>", load_permissions)
+        for index, (permission, label) in enumerate(AccessControl.PERMISSIONS.items()):
+            ttk.Checkbutton(permissions_frame, text=label, variable=permission_vars[permission]).grid(
+                row=1 + index // 2, column=index % 2, padx=5, pady=2, sticky="w")
+        ttk.Button(permissions_frame, text="Save 保存", command=save_permissions).grid(
+            row=0, column=1, padx=5, pady=5, sticky="w")
+        
+        load_permissions()
+        refresh()
+
+    def sync_database(self):
+        """Exchange changes with another workstation's database"""
+        if not self.require_permission("database.admin"):
+            return
         try:
-            export_path = filedialog.asksaveasfilename(
-                defaultextension=".csv",
-                initialdir=self.dirs['exports'],
-                title="Export Usage Log",
-                filetypes=[("CSV files", "*.csv")]
+            peer_path = filedialog.askopenfilename(
+                initialdir=self.dirs['data'],
+                title="Select Database to Sync With",
+                filetypes=[("SQLite databases", "*.db")]
             )
             
-            if not export_path:
+            if not peer_path:
                 return
             
-            self.cursor.execute("""
-                SELECT u.id, i.name, i.name_cn, u.user, u.user_department,
-                       u.quantity_changed, u.timestamp, u.purpose,
-                       u.supervisor_approval, u.return_time, u.notes
-                FROM usage_log u
-                JOIN items i ON u.item_id = i.id
-                ORDER BY u.timestamp DESC
-            """)
+            if Path(peer_path).resolve() == (self.dirs['data'] / "lab_inventory.db").resolve():
+                messagebox.showwarning("Warning", "Cannot sync a database with itself 不能与自身同步")
+                return
             
-            with open(export_path, 'w', newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-                # Write header
-                writer.writerow([
-                    'ID', 'Item Name', 'Item Chinese Name', 'User', 'Department',
-                    'Quantity Changed', 'Timestamp', 'Purpose',
-                    'Supervisor Approval', 'Return Time', 'Notes'
-                ])
-                # Write data
-                writer.writerows(self.cursor.fetchall())
+            peer_conn = sqlite3.connect(peer_path, timeout=30)
+            try:
+                peer_conn.execute("PRAGMA foreign_keys = ON")
+                SyncEngine.install(peer_conn)
+                peer_conn.commit()
+                engines = (SyncEngine(self.conn), SyncEngine(peer_conn))
+                known_conflicts = [len(engine.conflicts()) for engine in engines]
+                pulled, pushed = engines[0].sync_with(peer_conn)
+                # Conflicts are recorded on the side that received the change
+                new_conflicts = []
+                for engine, known in zip(engines, known_conflicts):
+                    conflicts = engine.conflicts()
+                    new_conflicts += conflicts[:len(conflicts) - known]
+            finally:
+                peer_conn.close()
             
-            messagebox.showinfo("Success", f"Usage log exported successfully!\n使用记录已导出: {export_path}")
+            for item_type, tree in self.trees.items():
+                self.refresh_inventory(item_type, tree)
+            self.refresh_usage_log()
+            self.scheduler.build()
+            messagebox.showinfo(
+                "Success",
+                f"Sync complete: {pulled} change(s) received, {pushed} change(s) sent\n"
+                f"同步完成: 接收 {pulled} 项, 发送 {pushed} 项"
+            )
+            if new_conflicts:
+                details = "\n".join(f"{origin_site}: {table} {row_key} ({op}) - {reason}"
+                                    for _, origin_site, table, row_key, op, _, reason, _ in new_conflicts[:20])
+                messagebox.showwarning(
+                    "Sync Conflicts 同步冲突",
+                    f"{len(new_conflicts)} incoming change(s) were skipped and need manual review\n"
+                    f"{len(new_conflicts)} 项传入更改被跳过, 需人工核对:\n\n{details}")
             
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to export usage log: {str(e)}")
+            messagebox.showerror("Error", f"Failed to sync database: {str(e)}")
 
-    def backup_database(self):
-        """Create a backup of the database"""
+    def schedule_snapshots(self):
+        """Take today's stock snapshot if missing and check again hourly"""
+        try:
+            self.snapshots.take_snapshot()
+        except Exception as e:
+            self.status_bar.config(text=f"Stock snapshot failed: {str(e)}")
+        self.root.after(60 * 60 * 1000, self.schedule_snapshots)
+
+    def check_alerts(self):
+        """Evaluate alert rules for items written since the last check"""
         try:
-            backup_dir = self.dirs['data'] / "backups"
-            backup_dir.mkdir(exist_ok=True)
+            today = date.today()
+            if self._alerts_due_checked != today:
+                self.alerts.evaluate_due()
+                self._alerts_due_checked = today
+            self.alerts.evaluate_pending()
+        except Exception as e:
+            self.status_bar.config(text=f"Alert evaluation failed: {str(e)}")
+            return
+        
+        new_alerts = []
+        while not self.alerts.notifications.empty():
+            new_alerts.append(self.alerts.notifications.get_nowait())
+        if new_alerts:
+            self.status_bar.config(
+                text=f"⚠ {len(new_alerts)} new alert(s) 新警报: {new_alerts[-1]['message']}")
+
+    def poll_alerts(self):
+        """Pick up writes made by the scanner service, API or sync every few seconds"""
+        self.check_alerts()
+        self.root.after(3000, self.poll_alerts)
+
+    def show_alerts(self):
+        """Show open alerts and manage alert rules"""
+        alerts_window = tk.Toplevel(self.root)
+        alerts_window.title("Stock & Expiry Alerts 库存与过期警报")
+        alerts_window.geometry("800x450")
+        
+        columns = ("ID", "Item 物品", "Type 类型", "Message 信息", "Raised 时间", "Acknowledged 已确认")
+        alert_tree = ttk.Treeview(alerts_window, columns=columns, show='headings')
+        for col in columns:
+            alert_tree.heading(col, text=col)
+            alert_tree.column(col, width=300 if col == "Message 信息" else 90)
+        alert_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def refresh():
+            self.check_alerts()
+            alert_tree.delete(*alert_tree.get_children())
+            for alert_id, item_id, rule_type, message, raised_at, acknowledged_at in self.alerts.open_alerts():
+                alert_tree.insert('', tk.END, values=(
+                    alert_id, item_id, AlertEngine.RULE_TYPES.get(rule_type, rule_type), message,
+                    raised_at[:16], "✓" if acknowledged_at else ""))
+        
+        def acknowledge():
+            try:
+                self.alerts.acknowledge([alert_tree.item(i)['values'][0] for i in alert_tree.selection()])
+                refresh()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to acknowledge: {str(e)}", parent=alerts_window)
+        
+        button_frame = ttk.Frame(alerts_window)
+        button_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(button_frame, text="Acknowledge 确认", command=acknowledge).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Refresh 刷新", command=refresh).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Rules 规则",
+                   command=lambda: self.show_alert_rules(alerts_window, refresh)).pack(side=tk.LEFT, padx=5)
+        refresh()
+
+    def show_locations(self):
+        """Browse the storage location tree, its occupancy and the items in each subtree"""
+        locations_window = tk.Toplevel(self.root)
+        locations_window.title("Storage Locations 存放位置")
+        locations_window.geometry("800x550")
+        
+        columns = ("Level 级别", "Items 物品数", "Hazardous 危险品数")
+        location_tree = ttk.Treeview(locations_window, columns=columns, selectmode="browse")
+        location_tree.heading("#0", text="Location 位置")
+        location_tree.column("#0", width=350)
+        for col in columns:
+            location_tree.heading(col, text=col)
+            location_tree.column(col, width=120)
+        location_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def refresh():
+            expanded = set()
+            pending = list(location_tree.get_children())
+            while pending:
+                iid = pending.pop()
+                if location_tree.item(iid, 'open'):
+                    expanded.add(iid)
+                pending.extend(location_tree.get_children(iid))
+            location_tree.delete(*location_tree.get_children())
+            for location_id, parent_id, name, level, _, item_count, hazardous_count in self.locations.nodes():
+                iid = str(location_id)
+                location_tree.insert("" if parent_id is None else str(parent_id), tk.END, iid=iid, text=name,
+                                     open=iid in expanded, values=(
+                                         LocationHierarchy.LEVEL_LABELS[level], item_count, hazardous_count))
+        
+        def selected_id():
+            selection = location_tree.selection()
+            return int(selection[0]) if selection else None
+        
+        def run(action, *args):
+            try:
+                action(*args)
+                refresh()
+                return True
+            except Exception as e:
+                messagebox.showerror("Error", f"Location update failed: {str(e)}", parent=locations_window)
+                return False
+        
+        def add(child):
+            if not self.require_permission("locations.manage"):
+                return
+            parent_id = selected_id() if child else None
+            if child and parent_id is None:
+                messagebox.showwarning("Warning", "Please select a location 请选择位置", parent=locations_window)
+                return
+            name = simpledialog.askstring("Add Location 添加位置", "Name 名称:", parent=locations_window)
+            if name and run(self.locations.add, name, parent_id):
+                # Items already recorded under this path are now linked to it
+                self.refresh_after_check_in()
+        
+        def rename():
+            location_id = selected_id()
+            if location_id is None or not self.require_permission("locations.manage"):
+                return
+            name = simpledialog.askstring("Rename Location 重命名位置", "Name 名称:", parent=locations_window,
+                                          initialvalue=self.locations.get(location_id)['name'])
+            if name and run(self.locations.rename, location_id, name):
+                self.refresh_after_check_in()
+        
+        def move():
+            location_id = selected_id()
+            if location_id is None or not self.require_permission("locations.manage"):
+                return
+            node = self.locations.get(location_id)
+            level = LocationHierarchy.LEVELS.index(node['level'])
+            targets = {path: target_id for target_id, _, _, target_level, path, _, _ in self.locations.nodes()
+                       if level > 0 and target_level == LocationHierarchy.LEVELS[level - 1]
+                       and target_id != node['parent_id']}
+            if not targets:
+                messagebox.showinfo("Move 移动", "Nowhere to move this location 无可移动的目标",
+                                    parent=locations_window)
+                return
             
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = backup_dir / f"lab_inventory_backup_{timestamp}.db"
+            move_window = tk.Toplevel(locations_window)
+            move_window.title(f"Move 移动 - {node['path']}")
+            target_var = tk.StringVar(value=next(iter(targets)))
+            ttk.Combobox(move_window, textvariable=target_var, values=tuple(targets),
+                         state="readonly", width=50).pack(padx=10, pady=10)
             
-            # Close current connection
-            self.conn.close()
+            def confirm():
+                if run(self.locations.move, location_id, targets[target_var.get()]):
+                    move_window.destroy()
+                    self.refresh_after_check_in()
             
-            # Copy database file
-            shutil.copy2(
-                self.dirs['data'] / "lab_inventory.db",
-                backup_path
-            )
+            ttk.Button(move_window, text="Move 移动", command=confirm).pack(pady=5)
+        
+        def delete():
+            location_id = selected_id()
+            if location_id is None or not self.require_permission("locations.manage"):
+                return
+            if messagebox.askyesno(
+                    "Confirm", "Delete this location and everything below it?\n删除此位置及其所有下级位置？",
+                    parent=locations_window):
+                run(self.locations.delete, location_id)
+        
+        def show_items():
+            location_id = selected_id()
+            if location_id is None:
+                return
+            items_window = tk.Toplevel(locations_window)
+            items_window.title(f"Items 物品 - {self.locations.get(location_id)['path']}")
+            items_window.geometry("900x400")
+            item_columns = ("ID", "Name 名称", "Chinese Name 中文名称", "Type 类型", "Quantity 数量",
+                            "Unit 单位", "Location 位置", "Safety 安全分类")
+            items_tree = ttk.Treeview(items_window, columns=item_columns, show='headings')
+            for col in item_columns:
+                items_tree.heading(col, text=col)
+                items_tree.column(col, width=220 if col == "Location 位置" else 90)
+            items_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+            for row in self.locations.items_in(location_id):
+                items_tree.insert('', tk.END, values=tuple("" if v is None else v for v in row))
+        
+        button_frame = ttk.Frame(locations_window)
+        button_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(button_frame, text="Add Building 添加楼宇", command=lambda: add(False)).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="Add Inside 添加下级", command=lambda: add(True)).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="Rename 重命名", command=rename).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="Move 移动", command=move).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="Delete 删除", command=delete).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="Show Items 显示物品", command=show_items).pack(side=tk.LEFT, padx=2)
+        refresh()
+
+    def show_reorder(self):
+        """Review reorder proposals, issue purchase orders and close open ones"""
+        reorder_window = tk.Toplevel(self.root)
+        reorder_window.title("Reorder & Purchase Orders 补货与采购订单")
+        reorder_window.geometry("900x600")
+        
+        settings = ttk.Frame(reorder_window)
+        settings.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(settings, text="Usage window (days) 用量统计天数:").pack(side=tk.LEFT, padx=2)
+        window_var = tk.IntVar(value=90)
+        ttk.Entry(settings, textvariable=window_var, width=6).pack(side=tk.LEFT, padx=2)
+        ttk.Label(settings, text="Cover (days) 备货天数:").pack(side=tk.LEFT, padx=2)
+        cover_var = tk.IntVar(value=30)
+        ttk.Entry(settings, textvariable=cover_var, width=6).pack(side=tk.LEFT, padx=2)
+        
+        columns = ("Manufacturer 制造商", "ID", "Name 名称", "In Stock 库存", "Reorder Point 再订货点",
+                   "Daily Usage 日用量", "Order Qty 订购量", "Unit 单位")
+        proposal_tree = ttk.Treeview(reorder_window, columns=columns, show='headings')
+        for col in columns:
+            proposal_tree.heading(col, text=col)
+            proposal_tree.column(col, width=200 if col == "Name 名称" else 100)
+        proposal_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        proposal_buttons = ttk.Frame(reorder_window)
+        proposal_buttons.pack(fill=tk.X, padx=5)
+        
+        ttk.Label(reorder_window, text="Open Purchase Orders 未完成采购订单").pack(anchor="w", padx=5, pady=(10, 0))
+        order_columns = ("PO", "Manufacturer 制造商", "Created 创建时间", "Lines 行数", "Total Qty 总数量")
+        order_tree = ttk.Treeview(reorder_window, columns=order_columns, show='headings', height=6)
+        for col in order_columns:
+            order_tree.heading(col, text=col)
+            order_tree.column(col, width=150)
+        order_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        proposals = []
+        
+        def refresh():
+            try:
+                window_days, cover_days = window_var.get(), cover_var.get()
+                if window_days < 1 or cover_days < 0:
+                    raise ValueError("Usage window must be at least one day")
+                proposals[:] = self.reorder_planner.proposals(window_days, cover_days)
+            except (ValueError, tk.TclError) as e:
+                messagebox.showerror("Error", f"Invalid input: {str(e)}", parent=reorder_window)
+                return
+            proposal_tree.delete(*proposal_tree.get_children())
+            for proposal in proposals:
+                proposal_tree.insert('', tk.END, iid=proposal.item_id, values=(
+                    proposal.manufacturer, proposal.item_id, f"{proposal.name} {proposal.name_cn or ''}".strip(),
+                    proposal.quantity, f"{proposal.reorder_point:g}", proposal.daily_rate,
+                    proposal.order_quantity, proposal.unit or ""))
+            order_tree.delete(*order_tree.get_children())
+            for po_id, manufacturer, created_at, lines, total in self.reorder_planner.open_orders():
+                order_tree.insert('', tk.END, iid=po_id, values=(po_id, manufacturer, created_at[:16], lines, total))
+        
+        def create_orders():
+            if not self.require_permission("stock.receive"):
+                return
+            # Only the selected proposals when there is a selection, otherwise all of them
+            selected = set(proposal_tree.selection())
+            rows = [proposal for proposal in proposals if not selected or proposal.item_id in selected]
+            if not rows:
+                messagebox.showinfo("Reorder", "Nothing to order 无需订购", parent=reorder_window)
+                return
+            try:
+                batch_id, count, pdf_path, csv_path = self.reorder_planner.create_orders(rows)
+                refresh()
+                messagebox.showinfo("Success", f"Created {count} purchase orders 已生成采购订单\n"
+                                    f"{pdf_path}\n{csv_path}", parent=reorder_window)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to create purchase orders: {str(e)}", parent=reorder_window)
+        
+        def close_orders(receive):
+            if not self.require_permission("stock.receive"):
+                return
+            selected = order_tree.selection()
+            if not selected:
+                messagebox.showwarning("Warning", "Please select a purchase order 请选择采购订单", parent=reorder_window)
+                return
+            try:
+                for po_id in selected:
+                    if receive:
+                        self.reorder_planner.receive(po_id)
+                    else:
+                        self.reorder_planner.cancel(po_id)
+                refresh()
+                if receive:
+                    self.refresh_after_check_in()
+                    self.check_alerts()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to update purchase order: {str(e)}", parent=reorder_window)
+        
+        ttk.Button(proposal_buttons, text="Refresh 刷新", command=refresh).pack(side=tk.LEFT, padx=5)
+        ttk.Button(proposal_buttons, text="Create Orders 生成订单", command=create_orders).pack(side=tk.LEFT, padx=5)
+        order_buttons = ttk.Frame(reorder_window)
+        order_buttons.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(order_buttons, text="Mark Received 标记到货",
+                   command=lambda: close_orders(True)).pack(side=tk.LEFT, padx=5)
+        ttk.Button(order_buttons, text="Cancel Order 取消订单",
+                   command=lambda: close_orders(False)).pack(side=tk.LEFT, padx=5)
+        refresh()
+
+    def show_alert_rules(self, parent, on_change):
+        """List, add and delete alert rules"""
+        rules_window = tk.Toplevel(parent)
+        rules_window.title("Alert Rules 警报规则")
+        rules_window.geometry("600x400")
+        
+        columns = ("ID", "Type 类型", "Scope 范围", "Target 目标", "Threshold 阈值")
+        rules_tree = ttk.Treeview(rules_window, columns=columns, show='headings', selectmode="browse")
+        for col in columns:
+            rules_tree.heading(col, text=col)
+            rules_tree.column(col, width=100)
+        rules_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def refresh():
+            rules_tree.delete(*rules_tree.get_children())
+            for row in self.conn.execute(
+                    "SELECT id, rule_type, scope, target, threshold FROM alert_rules ORDER BY rule_type, scope"):
+                rules_tree.insert('', tk.END, values=tuple("" if v is None else v for v in row))
+        
+        form = ttk.Frame(rules_window)
+        form.pack(fill=tk.X, padx=5, pady=5)
+        rule_type_var = tk.StringVar(value="low_stock")
+        scope_var = tk.StringVar(value="category")
+        ttk.Combobox(form, textvariable=rule_type_var, values=tuple(AlertEngine.RULE_TYPES),
+                     state="readonly", width=12).pack(side=tk.LEFT, padx=2)
+        ttk.Combobox(form, textvariable=scope_var, values=AlertEngine.SCOPES,
+                     state="readonly", width=10).pack(side=tk.LEFT, padx=2)
+        ttk.Label(form, text="Target 目标:").pack(side=tk.LEFT, padx=2)
+        target_entry = ttk.Entry(form, width=14)
+        target_entry.pack(side=tk.LEFT, padx=2)
+        ttk.Label(form, text="Threshold (qty/days) 阈值:").pack(side=tk.LEFT, padx=2)
+        threshold_entry = ttk.Entry(form, width=6)
+        threshold_entry.pack(side=tk.LEFT, padx=2)
+        
+        def save():
+            if not self.require_permission("alerts.manage"):
+                return
+            try:
+                threshold = float(threshold_entry.get())
+                if threshold < 0:
+                    raise ValueError("Threshold must be positive")
+                target = target_entry.get().strip()
+                if scope_var.get() != "all" and not target:
+                    raise ValueError("Target is required for this scope")
+                self.alerts.save_rule(rule_type_var.get(), scope_var.get(), target, threshold)
+                refresh()
+                on_change()
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid rule: {str(e)}", parent=rules_window)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save rule: {str(e)}", parent=rules_window)
+        
+        def delete():
+            selection = rules_tree.selection()
+            if not selection or not self.require_permission("alerts.manage"):
+                return
+            try:
+                self.alerts.delete_rule(rules_tree.item(selection[0])['values'][0])
+                refresh()
+                on_change()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to delete rule: {str(e)}", parent=rules_window)
+        
+        ttk.Button(form, text="Save 保存", command=save).pack(side=tk.LEFT, padx=2)
+        ttk.Button(rules_window, text="Delete Selected 删除所选", command=delete).pack(pady=5)
+        refresh()
+
+    def show_stock_history(self, item_type):
+        """Show point-in-time stock and a historical chart for the selected item"""
+        tree = self.trees[item_type]
+        selected = tree.selection()
+        
+        if not selected:
+            messagebox.showwarning("Warning", "Please select an item to view its history 请选择要查看历史的物品")
+            return
+        
+        try:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        except ImportError:
+            messagebox.showerror("Error", "matplotlib is required for stock history charts")
+            return
+        
+        item_id = str(tree.item(selected[0])['values'][0])
+        item_name = tree.item(selected[0])['values'][1]
+        
+        history_window = tk.Toplevel(self.root)
+        history_window.title(f"Stock History 库存历史 - {item_id}")
+        history_window.geometry("800x550")
+        history_window.transient(self.root)
+        
+        control_frame = ttk.Frame(history_window)
+        control_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(control_frame, text="Days 天数:").pack(side=tk.LEFT, padx=5)
+        days_var = tk.StringVar(value="30")
+        ttk.Spinbox(control_frame, from_=1, to=3650, textvariable=days_var, width=6).pack(side=tk.LEFT, padx=5)
+        ttk.Label(control_frame, text="Quantity on date 指定日期数量 (YYYY-MM-DD):").pack(side=tk.LEFT, padx=5)
+        date_var = tk.StringVar(value=date.today().isoformat())
+        ttk.Entry(control_frame, textvariable=date_var, width=12).pack(side=tk.LEFT, padx=5)
+        result_label = ttk.Label(control_frame, text="")
+        
+        figure = Figure(figsize=(7, 4), dpi=100)
+        axes = figure.add_subplot(111)
+        chart = FigureCanvasTkAgg(figure, master=history_window)
+        chart.get_tk_widget().pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def draw():
+            try:
+                days = int(days_var.get())
+                series = self.snapshots.trend(item_id, days)
+                when = datetime.combine(date.fromisoformat(normalize_date(date_var.get())), datetime.max.time())
+                result_label.config(text=f"= {self.snapshots.quantity_at(item_id, when)}")
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid input: {str(e)}", parent=history_window)
+                return
             
-            # Reopen connection
-            self.conn = sqlite3.connect(
-                str(self.dirs['data'] / "lab_inventory.db"),
-                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
-            )
-            self.cursor = self.conn.cursor()
+            axes.clear()
+            axes.step([day for day, _ in series], [quantity for _, quantity in series], where='post')
+            axes.set_title(f"{item_id} - {item_name}")
+            axes.set_ylabel("Quantity")
+            axes.grid(True, alpha=0.3)
+            figure.autofmt_xdate()
+            chart.draw()
+        
+        ttk.Button(control_frame, text="Show 显示", command=draw).pack(side=tk.LEFT, padx=5)
+        result_label.pack(side=tk.LEFT, padx=5)
+        draw()
+
+    def show_due_alerts(self):
+        """Show equipment due for calibration or with expiring warranty"""
+        alerts_window = tk.Toplevel(self.root)
+        alerts_window.title("Calibration & Warranty Alerts 校准与保修提醒")
+        alerts_window.geometry("900x450")
+        alerts_window.transient(self.root)
+        
+        control_frame = ttk.Frame(alerts_window)
+        control_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(control_frame, text="Due within (days) 天数内到期:").pack(side=tk.LEFT, padx=5)
+        days_var = tk.StringVar(value=str(30))
+        ttk.Spinbox(control_frame, from_=0, to=3650, textvariable=days_var, width=6).pack(side=tk.LEFT, padx=5)
+        
+        columns = ("Due Date", "Days Left", "Type", "ID", "Name", "Location")
+        tree = ttk.Treeview(alerts_window, columns=columns, show='headings')
+        for col in columns:
+            tree.heading(col, text=col)
+            tree.column(col, width=120, minwidth=50)
+        tree.tag_configure('overdue', foreground='red')
+        tree.tag_configure('invalid', foreground='orange')
+        
+        y_scrollbar = ttk.Scrollbar(alerts_window, orient=tk.VERTICAL, command=tree.yview)
+        y_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        tree.configure(yscrollcommand=y_scrollbar.set)
+        tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        def load_alerts():
+            try:
+                days = int(days_var.get())
+            except ValueError:
+                messagebox.showerror("Error", "Days must be a whole number", parent=alerts_window)
+                return
             
-            messagebox.showinfo(
-                "Success",
-                f"Database backed up successfully!\n数据库已备份: {backup_path}"
-            )
+            # Rebuild so the horizon is counted from today, not from when the app started
+            self.scheduler.build()
+            if days <= self.scheduler.horizon_days:
+                limit = (date.today() + timedelta(days=days)).isoformat()
+                entries = [entry for entry in self.scheduler.due_list if entry[0] <= limit]
+            else:
+                entries = self.scheduler.due_within(days)
             
+            for item in tree.get_children():
+                tree.delete(item)
+            today = date.today()
+            for due, field, item_id, name, location, item_type in entries:
+                due_on = CalibrationScheduler.parse_due(due)
+                if due_on is None:
+                    continue
+                days_left = (due_on - today).days
+                tree.insert("", "end", values=(
+                    due, days_left, CalibrationScheduler.DUE_FIELDS[field], item_id, name, location
+                ), tags=('overdue',) if days_left < 0 else ())
+            for value, field, item_id, name, location, item_type in self.scheduler.invalid_dates():
+                tree.insert("", "end", values=(
+                    value, "Invalid date 日期无效", CalibrationScheduler.DUE_FIELDS[field], item_id, name, location
+                ), tags=('invalid',))
+        
+        ttk.Button(control_frame, text="Refresh 刷新", command=load_alerts).pack(side=tk.LEFT, padx=5)
+        load_alerts()
+
+    def load_memory_budget(self):
+        """Memory budget in MB from app_meta, defaulting to 256"""
+        row = self.conn.execute("SELECT value FROM app_meta WHERE key = 'memory_budget_mb'").fetchone()
+        return int(row[0]) if row else 256
+
+    def set_memory_budget(self):
+        """Configure the memory budget used to size batches"""
+        budget = simpledialog.askinteger(
+            "Memory Budget 内存预算",
+            f"Memory budget in MB 内存预算 (MB):\n{self.memory_budget.describe()}",
+            initialvalue=self.memory_budget.budget_mb, minvalue=16, maxvalue=65536, parent=self.root)
+        if budget is None:
+            return
+        try:
+            self.conn.execute("""
+                INSERT INTO app_meta (key, value) VALUES ('memory_budget_mb', ?)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """, (str(budget),))
+            self.conn.commit()
+            self.memory_budget.budget_mb = budget
+            self.status_bar.config(
+                text=f"Memory budget set to {budget} MB ({self.memory_budget.batch_rows} rows per batch)")
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to backup database: {str(e)}")
-            # Ensure connection is reopened even if backup fails
-            self.conn = sqlite3.connect(
-                str(self.dirs['data'] / "lab_inventory.db"),
-                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
-            )
-            self.cursor = self.conn.cursor()
+            self.conn.rollback()
+            messagebox.showerror("Error", f"Failed to set memory budget: {str(e)}")
+
+    def load_language(self):
+        """UI language from app_meta, defaulting to bilingual"""
+        row = self.conn.execute("SELECT value FROM app_meta WHERE key = 'language'").fetchone()
+        return row[0] if row else "both"
+
+    def set_language(self, language):
+        """Switch the UI language in place and remember the choice"""
+        try:
+            self.conn.execute("""
+                INSERT INTO app_meta (key, value) VALUES ('language', ?)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """, (language,))
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            messagebox.showerror("Error", f"Failed to save language: {str(e)}")
+        self.i18n.language = language
+        self.apply_language()
+
+    def on_toplevel_mapped(self, event):
+        # Tk's own dialogs have no tkinter widget behind them
+        if self.i18n.language != "both" and not isinstance(event.widget, str):
+            self.apply_language(event.widget)
+
+    def _relabel(self, key, current, setter, seen):
+        """Show `current`'s source text in the current language"""
+        seen.add(key)
+        source, shown = self._i18n_sources.get(key, (None, None))
+        if current != shown:
+            # The application set new text since the last relabel
+            source = current
+        text = self.i18n.translate(source)
+        self._i18n_sources[key] = (source, text)
+        if text != current:
+            setter(text)
+
+    def apply_language(self, widget=None):
+        """Relabel a widget tree (the whole window by default) in the current language"""
+        full = widget is None
+        seen = set()
+        stack = [widget or self.root]
+        while stack:
+            w = stack.pop()
+            stack.extend(w.winfo_children())
+            path = str(w)
+            try:
+                if isinstance(w, (tk.Tk, tk.Toplevel)):
+                    self._relabel((path, 'title'), w.title(), w.title, seen)
+                elif isinstance(w, tk.Menu):
+                    last = w.index('end')
+                    for i in range(0 if last is None else last + 1):
+                        if w.type(i) in ('command', 'cascade', 'checkbutton', 'radiobutton'):
+                            self._relabel((path, 'entry', i), w.entrycget(i, 'label'),
+                                          lambda text, w=w, i=i: w.entryconfigure(i, label=text), seen)
+                elif isinstance(w, ttk.Notebook):
+                    for tab in w.tabs():
+                        self._relabel((path, 'tab', tab), w.tab(tab, 'text'),
+                                      lambda text, w=w, tab=tab: w.tab(tab, text=text), seen)
+                elif isinstance(w, ttk.Treeview):
+                    for column in w['columns']:
+                        self._relabel((path, 'heading', column), w.heading(column, 'text'),
+                                      lambda text, w=w, column=column: w.heading(column, text=text), seen)
+                elif 'text' in w.keys():
+                    self._relabel((path, 'text'), str(w.cget('text')),
+                                  lambda text, w=w: w.configure(text=text), seen)
+            except tk.TclError:
+                continue
+        if full:
+            # Forget widgets that have been destroyed
+            self._i18n_sources = {k: v for k, v in self._i18n_sources.items() if k in seen}
 
     def show_about(self):
         """Show about dialog"""
@@ -1403,14 +8712,18 @@ class LabInventorySystem:
     def ai_predict_inventory_needs(self):
         """AI Predict Inventory Needs"""
         try:
-            self.cursor.execute("SELECT name, quantity, item_type FROM items")
-            inventory_data = [{'name': row[0], 'quantity': row[1], 'item_type': row[2]} for row in self.cursor.fetchall()]
-            low_stock_items = self.ai_assistant.predict_inventory_needs(inventory_data)
+            with self.memory_budget.track("AI prediction"):
+                inventory_data = self.memory_budget.iter_rows(
+                    self.conn, Item.select_sql("WHERE deleted_at IS NULL"), row_factory=Item.row_factory)
+                low_stock_items = self.ai_assistant.predict_inventory_needs(inventory_data)
+            self.status_bar.config(text=self.memory_budget.describe())
             
             if low_stock_items:
                 message = "Low stock items:\n"
-                for item in low_stock_items:
-                    message += f"{item['name']} - {item['quantity']} left\n"
+                for item in low_stock_items[:50]:
+                    message += f"{item.name} - {item.quantity} left\n"
+                if len(low_stock_items) > 50:
+                    message += f"... and {len(low_stock_items) - 50} more\n"
                 messagebox.showinfo("AI Prediction", message)
             else:
                 messagebox.showinfo("AI Prediction", "No low stock items detected.")
@@ -1426,6 +8739,70 @@ class LabInventorySystem:
             pass
 
 def main():
+    parser = argparse.ArgumentParser(description="DNA Virology Lab Management System")
+    parser.add_argument("--api", action="store_true", help="run the REST/JSON API server without the GUI")
+    parser.add_argument("--host", default="127.0.0.1", help="API server host (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8780, help="API server port (default: 8780)")
+    parser.add_argument("--backup", action="store_true", help="write a full or incremental backup and exit")
+    parser.add_argument("--verify-backups", action="store_true", help="check every backup archive and exit")
+    parser.add_argument("--restore", metavar="BACKUP", help="rebuild the database as of BACKUP into --output")
+    parser.add_argument("--output", help="database file written by --restore")
+    parser.add_argument("--check", action="store_true", help="run the integrity checks and exit")
+    parser.add_argument("--repair", action="store_true", help="repair what the integrity checks find and exit")
+    parser.add_argument("--optimize", action="store_true", help="run ANALYZE and VACUUM and exit")
+    args = parser.parse_args()
+    
+    data_dir = Path.home() / "DNA_Virology_Lab_System" / "data"
+    db_path = data_dir / "lab_inventory.db"
+    
+    if args.backup or args.verify_backups or args.restore:
+        # Read from the environment so the passphrase never appears in the process list
+        passphrase = os.environ.get("LAB_BACKUP_PASSPHRASE") or None
+        backups = IncrementalBackup(data_dir / "backups")
+        if args.backup:
+            conn = sqlite3.connect(str(db_path))
+            try:
+                header = backups.backup(conn, passphrase)
+            finally:
+                conn.close()
+            print(f"{header['kind']} backup {header['path']}: {header['pages_stored']}/{header['page_count']} pages, "
+                  f"{header['stored_bytes']} bytes")
+        if args.restore:
+            if not args.output:
+                parser.error("--restore requires --output")
+            print(f"Restored {backups.restore(Path(args.restore).stem, args.output, passphrase)}")
+        if args.verify_backups:
+            results = backups.verify(passphrase)
+            for name, error in results:
+                print(f"{name}: {error or 'OK'}")
+            if any(error for _, error in results):
+                sys.exit(1)
+        return
+    
+    if args.check or args.repair or args.optimize:
+        conn = sqlite3.connect(str(db_path))
+        try:
+            conn.execute("PRAGMA foreign_keys = ON")
+            maintenance = DatabaseMaintenance(conn)
+            results = maintenance.repair() if args.repair else maintenance.check()
+            if args.optimize:
+                maintenance.analyze()
+                maintenance.vacuum()
+        finally:
+            conn.close()
+        for _, label, count, samples in results:
+            print(f"{label}: {count or 'OK'}")
+            for sample in samples:
+                print(f"    {sample}")
+        if any(count for _, _, count, _ in results):
+            sys.exit(1)
+        return
+    
+    if args.api:
+        print(f"Serving inventory API for {db_path} on http://{args.host}:{args.port}")
+        LabAPIServer(db_path, host=args.host, port=args.port, verbose=True).serve_forever()
+        return
+    
     root = tk.Tk()
     app = LabInventorySystem(root)
     root.mainloop()
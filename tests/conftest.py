@@ -0,0 +1,61 @@
+"""Shared fixtures: a LabInventorySystem with its database but no Tk window"""
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import DNA_Virology_Lab_Management_System as lab  # noqa: E402
+
+
+def make_system(base_dir):
+    system = lab.LabInventorySystem.__new__(lab.LabInventorySystem)
+    system.base_dir = Path(base_dir)
+    system.setup_directories()
+    system.init_database()
+    return system
+
+
+def add_items(conn, count=5, item_type="chemical", prefix="CHE", quantity=100):
+    """Insert `count` plain items numbered from 1; returns their ids"""
+    ids = [f"{prefix}{n:04d}" for n in range(1, count + 1)]
+    conn.executemany("""
+        INSERT INTO items (id, name, item_type, quantity, unit, last_updated)
+        VALUES (?, ?, ?, ?, 'ml', ?)
+    """, [(item_id, f"Item {item_id}", item_type, quantity, datetime.now().isoformat()) for item_id in ids])
+    conn.commit()
+    return ids
+
+
+@pytest.fixture(autouse=True)
+def fast_password_hashing(monkeypatch):
+    monkeypatch.setattr(lab.AccessControl, "HASH_ITERATIONS", 1000)
+
+
+@pytest.fixture
+def system(tmp_path):
+    system = make_system(tmp_path)
+    yield system
+    system.conn.close()
+
+
+@pytest.fixture
+def db_path(system):
+    return system.dirs['data'] / "lab_inventory.db"
+
+
+@pytest.fixture
+def accounts(system):
+    """A supervisor, a technician and a viewer, signed in"""
+    access = lab.AccessControl(system.conn)
+    for username, password, role in (("boss", "supersecret", "supervisor"),
+                                     ("tech", "techpass1", "technician"),
+                                     ("view", "viewpass1", "viewer")):
+        access.create_user(username, password, role)
+    return {
+        "boss": access.authenticate("boss", "supersecret"),
+        "tech": access.authenticate("tech", "techpass1"),
+        "view": access.authenticate("view", "viewpass1"),
+    }
@@ -0,0 +1,136 @@
+"""Embedded REST/JSON API: paging, conditional GETs and usage posting"""
+import base64
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from conftest import add_items, lab
+
+
+@pytest.fixture
+def api(system, db_path, accounts):
+    server = lab.LabAPIServer(db_path, port=0, page_size=10)
+    server.start()
+    yield server
+    server.stop()
+
+
+def call(api, path, body=None, auth="view:viewpass1", headers=None):
+    """(status, headers, decoded JSON body or None), signed in as the viewer unless `auth` says otherwise"""
+    headers = dict(headers or {})
+    if auth:
+        headers["Authorization"] = "Basic " + base64.b64encode(auth.encode()).decode()
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{api.port}{path}", headers=headers,
+        data=None if body is None else json.dumps(body).encode(), method="GET" if body is None else "POST")
+    try:
+        with urllib.request.urlopen(request) as response:
+            raw = response.read()
+            return response.status, response.headers, json.loads(raw) if raw else None
+    except urllib.error.HTTPError as e:
+        raw = e.read()
+        return e.code, e.headers, json.loads(raw) if raw else None
+
+
+def test_reads_need_an_account_with_view_permission(system, api, accounts):
+    add_items(system.conn, 1)
+    status, headers, _ = call(api, "/items", auth=None)
+    assert status == 401 and headers["WWW-Authenticate"].startswith("Basic")
+    assert call(api, "/reports/summary", auth="view:wrong-password")[0] == 401
+    assert call(api, "/items/CHE0001", auth="tech:techpass1")[0] == 200
+    lab.AccessControl(system.conn).set_permissions("viewer", [])
+    api._sessions.clear()
+    assert call(api, "/items")[0] == 403
+
+
+def test_existing_databases_grant_view_to_the_default_roles(system):
+    system.conn.execute("DELETE FROM role_permissions WHERE permission = 'inventory.view'")
+    system.conn.execute("DELETE FROM permission_catalog WHERE permission = 'inventory.view'")
+    lab.AccessControl.install(system.conn)
+    granted = system.conn.execute(
+        "SELECT role FROM role_permissions WHERE permission = 'inventory.view' ORDER BY role").fetchall()
+    assert granted == [("supervisor",), ("technician",), ("viewer",)]
+
+
+def test_repeated_requests_reuse_the_verified_credentials(system, api, monkeypatch):
+    checks = []
+    verify = lab.AccessControl.verify_password
+    monkeypatch.setattr(lab.AccessControl, "verify_password",
+                        staticmethod(lambda *args: checks.append(1) or verify(*args)))
+    for _ in range(3):
+        assert call(api, "/reports/summary")[0] == 200
+    assert len(checks) == 1
+    api.SESSION_TTL = 0
+    api._sessions.clear()
+    call(api, "/reports/summary")
+    call(api, "/reports/summary")
+    assert len(checks) == 3
+
+
+def test_keyset_paging_walks_every_item_once(system, api):
+    ids = add_items(system.conn, 25)
+    seen, after = [], ""
+    while True:
+        status, _, page = call(api, f"/items?limit=10&after={after}")
+        assert status == 200
+        seen += [item["id"] for item in page["items"]]
+        if page["next_after"] is None:
+            break
+        after = page["next_after"]
+    assert seen == ids
+
+
+def test_limit_is_capped_and_must_be_positive(system, api):
+    add_items(system.conn, 3)
+    assert call(api, "/items?limit=0")[0] == 400
+    api.max_page_size = 2
+    assert len(call(api, "/items?limit=50")[2]["items"]) == 2
+
+
+def test_etag_answers_304_until_the_item_changes(system, api):
+    add_items(system.conn, 1)
+    status, headers, item = call(api, "/items/CHE0001")
+    assert status == 200 and item["quantity"] == 100
+    etag = headers["ETag"]
+    assert call(api, "/items/CHE0001", headers={"If-None-Match": etag})[0] == 304
+    system.conn.execute("UPDATE items SET quantity = 99 WHERE id = 'CHE0001'")
+    system.conn.commit()
+    status, headers, item = call(api, "/items/CHE0001", headers={"If-None-Match": etag})
+    assert status == 200 and item["quantity"] == 99 and headers["ETag"] != etag
+
+
+def test_streamed_list_is_a_complete_json_array(system, api):
+    add_items(system.conn, 30)
+    status, _, items = call(api, "/items?stream=1")
+    assert status == 200 and len(items) == 30
+
+
+def test_post_usage_treats_null_quantity_as_empty_and_stamps_the_item(system, api):
+    add_items(system.conn, 2)
+    system.conn.execute("UPDATE items SET quantity = NULL, last_updated = '2000-01-01' WHERE id = 'CHE0001'")
+    system.conn.commit()
+    entry = {"item_id": "CHE0001", "user": "bob", "quantity_changed": 1}
+    assert call(api, "/usage", entry, auth="boss:supersecret")[0] == 400
+    status, _, result = call(api, "/usage", dict(entry, quantity_changed=-4), auth="boss:supersecret")
+    assert status == 201 and result["remaining"] == 4
+    quantity, last_updated = system.conn.execute(
+        "SELECT quantity, last_updated FROM items WHERE id = 'CHE0001'").fetchone()
+    assert quantity == 4 and str(last_updated) > "2000-01-01"
+
+
+def test_post_usage_needs_credentials_and_queues_unapproved_check_outs(system, api):
+    add_items(system.conn, 1)
+    entry = {"item_id": "CHE0001", "user": "bob", "quantity_changed": 3, "supervisor_approval": "Someone"}
+    status, headers, _ = call(api, "/usage", entry, auth=None)
+    assert status == 401 and headers["WWW-Authenticate"].startswith("Basic")
+    assert call(api, "/usage", entry, auth="tech:wrong-password")[0] == 401
+    assert call(api, "/usage", entry, auth="view:viewpass1")[0] == 403
+    status, _, queued = call(api, "/usage", entry, auth="tech:techpass1")
+    assert status == 202 and queued["status"] == "pending"
+    status, _, booked = call(api, "/usage", entry, auth="boss:supersecret")
+    assert status == 201
+    assert system.conn.execute("SELECT quantity FROM items WHERE id = 'CHE0001'").fetchone()[0] == 97
+    assert system.conn.execute("SELECT supervisor_approval FROM usage_log WHERE id = ?",
+                               (booked["id"],)).fetchone()[0] == "boss"
@@ -0,0 +1,79 @@
+"""Full and delta backups, verification and restore"""
+import sqlite3
+import sys
+
+import pytest
+
+from conftest import add_items, lab
+
+
+def checksum(path):
+    conn = sqlite3.connect(str(path))
+    try:
+        assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        return conn.execute("SELECT COUNT(*), SUM(quantity) FROM items").fetchone()
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def stocked(system):
+    add_items(system.conn, 400)
+    return system.conn
+
+
+@pytest.fixture(params=["zstd", "gzip"])
+def codec(request, monkeypatch):
+    if request.param == "gzip":
+        # Without zstandard the archives fall back to gzip
+        monkeypatch.setitem(sys.modules, "zstandard", None)
+    return request.param
+
+
+@pytest.fixture
+def backups(codec, tmp_path, monkeypatch):
+    # Small frames so even a test database spans several of them
+    monkeypatch.setattr(lab.IncrementalBackup, "FRAME_PAGES", 4)
+    return lab.IncrementalBackup(tmp_path / "backups")
+
+
+@pytest.mark.parametrize("passphrase", [None, "correct horse"])
+def test_delta_backup_verifies_and_restores(stocked, backups, codec, tmp_path, passphrase):
+    full = backups.backup(stocked, passphrase)
+    stocked.execute("UPDATE items SET quantity = quantity + 1 WHERE id = 'CHE0001'")
+    stocked.commit()
+    delta = backups.backup(stocked, passphrase)
+    assert full['kind'] == "full" and delta['kind'] == "delta" and delta['base'] == full['name']
+    assert delta['pages_stored'] < delta['page_count']
+    assert full['compression'] == delta['compression'] == codec
+    assert backups.verify(passphrase) == [(full['name'], None), (delta['name'], None)]
+
+    assert checksum(backups.restore(full['name'], tmp_path / "full.db", passphrase)) == (400, 40000)
+    assert checksum(backups.restore(delta['name'], tmp_path / "delta.db", passphrase)) == (400, 40001)
+
+
+def test_archives_are_written_in_frames(stocked, backups):
+    header = backups.backup(stocked)
+    frames = list(backups._frames(header, 'pages'))
+    assert len(frames) == -(-header['page_count'] // backups.FRAME_PAGES)
+
+
+def test_encrypted_restore_needs_the_right_passphrase(stocked, backups, tmp_path):
+    header = backups.backup(stocked, "correct horse")
+    with pytest.raises(ValueError, match="wrong passphrase"):
+        backups.restore(header['name'], tmp_path / "out.db", "battery staple")
+    with pytest.raises(ValueError, match="passphrase is required"):
+        backups.restore(header['name'], tmp_path / "out.db")
+    assert not (tmp_path / "out.db").exists() and not (tmp_path / "out.db.part").exists()
+
+
+def test_damaged_archive_fails_verify_and_restore(stocked, backups, tmp_path):
+    header = backups.backup(stocked)
+    data = bytearray(header['path'].read_bytes())
+    data[header['pages_offset'] + 20] ^= 0xFF
+    header['path'].write_bytes(bytes(data))
+    ((name, error),) = backups.verify()
+    assert name == header['name'] and "checksum" in error
+    with pytest.raises(ValueError, match="checksum"):
+        backups.restore(header['name'], tmp_path / "out.db")
+    assert not (tmp_path / "out.db.part").exists()
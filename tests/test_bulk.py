@@ -0,0 +1,49 @@
+"""Bulk edits and deletes, undone from their tagged audit entries"""
+import pytest
+
+from conftest import add_items, lab
+
+
+@pytest.fixture
+def bulk(system):
+    add_items(system.conn, 3)
+    return lab.BulkItemOperations(system.conn)
+
+
+def column(conn, field):
+    return [row[0] for row in conn.execute(f"SELECT {field} FROM items ORDER BY id")]
+
+
+def test_undo_restores_the_audited_values(system, bulk):
+    conn = system.conn
+    conn.execute("UPDATE items SET category = 'Solvent' WHERE id = 'CHE0001'")
+    conn.commit()
+    operation = bulk.update(["CHE0001", "CHE0002"], "category", "Buffer")
+    assert column(conn, "category") == ["Buffer", "Buffer", None]
+    tagged = lab.ItemAuditTrail(conn).operation_changes(operation)
+    assert [item_id for item_id, _, _ in tagged] == ["CHE0001", "CHE0002"]
+    assert sorted(bulk.undo(operation)) == ["CHE0001", "CHE0002"]
+    assert column(conn, "category") == ["Solvent", None, None]
+    with pytest.raises(ValueError):
+        bulk.undo(operation)
+
+
+def test_undo_keeps_later_edits_and_restores_deletes(system, bulk):
+    conn = system.conn
+    edit = bulk.update(["CHE0001", "CHE0002"], "location", "Shelf 1")
+    conn.execute("UPDATE items SET location = 'Shelf 9' WHERE id = 'CHE0002'")
+    conn.commit()
+    delete = bulk.delete(["CHE0003"])
+    assert column(conn, "deleted_at")[2] is not None
+    bulk.undo(edit)
+    bulk.undo(delete)
+    assert column(conn, "location") == [None, "Shelf 9", None]
+    assert column(conn, "deleted_at") == [None, None, None]
+
+
+def test_edits_outside_an_operation_are_not_tagged(system, bulk):
+    conn = system.conn
+    bulk.update(["CHE0001"], "category", "Buffer")
+    conn.execute("UPDATE items SET category = 'Other' WHERE id = 'CHE0002'")
+    conn.commit()
+    assert conn.execute("SELECT COUNT(*) FROM item_audit WHERE operation_id IS NOT NULL").fetchone()[0] == 1
@@ -0,0 +1,36 @@
+"""Date normalization and the free-text date migration"""
+import sqlite3
+
+import pytest
+
+from conftest import lab
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2021-03-04", "2021-03-04"),
+    ("2021/03/04", "2021-03-04"),
+    ("13/04/2021", "2021-04-13"),
+    ("04/04/2021", "2021-04-04"),
+    ("4 Mar 2021", "2021-03-04"),
+])
+def test_strict_normalization_accepts_unambiguous_dates(text, expected):
+    assert lab.normalize_date(text, strict=True) == expected
+
+
+def test_strict_normalization_rejects_day_month_ambiguity():
+    assert lab.normalize_date("03/04/2021") == "2021-04-03"
+    with pytest.raises(ValueError, match="ambiguous"):
+        lab.normalize_date("03/04/2021", strict=True)
+
+
+def test_migration_keeps_ambiguous_text_for_review():
+    conn = sqlite3.connect(":memory:")
+    conn.execute(f"CREATE TABLE items (id TEXT PRIMARY KEY, name TEXT, location TEXT, item_type TEXT, "
+                 f"deleted_at TEXT, {', '.join(lab.ITEM_DATE_FIELDS)})")
+    conn.executemany("INSERT INTO items (id, next_calibration) VALUES (?, ?)",
+                     [("EQ1", "03/04/2021"), ("EQ2", "25/12/2021"), ("EQ3", "2022.01.31"), ("EQ4", "soon")])
+    lab.CalibrationScheduler.migrate(conn)
+    assert dict(conn.execute("SELECT id, next_calibration FROM items")) == {
+        "EQ1": "03/04/2021", "EQ2": "2021-12-25", "EQ3": "2022-01-31", "EQ4": "soon"}
+    invalid = lab.CalibrationScheduler(conn).invalid_dates()
+    assert [(value, item_id) for value, _, item_id, *_ in invalid] == [("03/04/2021", "EQ1"), ("soon", "EQ4")]
@@ -0,0 +1,73 @@
+"""ZPL ^GFA label encoding"""
+import re
+
+import pytest
+
+from conftest import lab
+
+
+def decode_gfa(data, row_bytes):
+    """Expand ZPL ASCII-compressed graphic field data back into packed rows"""
+    width = row_bytes * 2
+    rows, row, count = [], "", 0
+    for char in data:
+        if char == ":":
+            rows.append(rows[-1])
+        elif char == ",":
+            rows.append(row.ljust(width, "0"))
+            row = ""
+        elif "G" <= char <= "Y":
+            count += ord(char) - ord("G") + 1
+        elif "g" <= char <= "z":
+            count += (ord(char) - ord("g") + 1) * 20
+        else:
+            row += char * (count or 1)
+            count = 0
+            assert len(row) <= width
+            if len(row) == width:
+                rows.append(row)
+                row = ""
+    assert row == "" and count == 0
+    return bytes.fromhex("".join(rows))
+
+
+@pytest.fixture
+def spooler(tmp_path):
+    return lab.LabelSpooler(tmp_path / "spool", tmp_path / "cache")
+
+
+@pytest.mark.parametrize("count, expected", [
+    (1, "F"), (2, "HF"), (19, "YF"), (20, "gF"), (21, "gGF"), (39, "gYF"),
+    (40, "hF"), (399, "yYF"), (400, "zF"), (401, "zGF"), (820, "zzgF"),
+])
+def test_repeat_prefix(count, expected):
+    assert lab.LabelSpooler._zpl_repeat(count, "F") == expected
+
+
+def test_compression_round_trips_blank_repeated_and_long_rows(spooler):
+    row_bytes = 60
+    rows = [
+        bytes(row_bytes),
+        bytes([0xFF] * row_bytes),
+        bytes([0xFF] * row_bytes),
+        bytes([0x0F] + [0] * (row_bytes - 1)),
+        bytes(range(row_bytes)),
+        bytes([0xA5] * 30 + [0] * 30),
+    ]
+    data = spooler._zpl_compress(b"".join(rows), row_bytes)
+    assert data.startswith(",") and ":" in data
+    assert decode_gfa(data, row_bytes) == b"".join(rows)
+
+
+def test_encoded_label_matches_its_bitmap(spooler):
+    item = lab.Item(**dict(dict.fromkeys(lab.Item.__slots__), id="EQ0001-ABC123", name="Centrifuge", name_cn="离心机"))
+    label = spooler.render_label(item)
+    zpl = spooler.encode_zpl([label, label]).decode("ascii")
+    fields = re.findall(r"\^XA\^PW(\d+)\^LL(\d+)\^FO0,0\^GFA,(\d+),(\d+),(\d+),([^^]*)\^FS\^XZ\n", zpl)
+    assert len(fields) == 2
+    width, height, total, _, row_bytes, data = fields[0]
+    assert (int(width), int(height)) == spooler.size == label.size
+    assert int(row_bytes) == (int(width) + 7) // 8 and int(total) == int(row_bytes) * int(height)
+    bits = decode_gfa(data, int(row_bytes))
+    assert bits == spooler._black_bits(label) and any(bits)
+    assert len(data) < len(bits) * 2
@@ -0,0 +1,96 @@
+"""Lot FEFO consumption, credits, reconciliation and lot replication"""
+import pytest
+
+from conftest import add_items, lab, make_system
+
+
+def consume(conn, item_id, quantity, returnable=0):
+    log_id = conn.execute(
+        "INSERT INTO usage_log (item_id, user, quantity_changed, returnable) VALUES (?, 'bob', ?, ?)",
+        (item_id, quantity, returnable)).lastrowid
+    conn.execute("UPDATE items SET quantity = quantity - ? WHERE id = ?", (quantity, item_id))
+    conn.commit()
+    return log_id
+
+
+def stock(conn, item_id):
+    """{lot_number: quantity} plus the item's quantity and expiry"""
+    lots = dict(conn.execute("SELECT lot_number, quantity FROM item_lots WHERE item_id = ?", (item_id,)))
+    quantity, expiry = conn.execute("SELECT quantity, expiry_date FROM items WHERE id = ?", (item_id,)).fetchone()
+    return lots, quantity, expiry
+
+
+@pytest.fixture
+def lots(system):
+    add_items(system.conn, 1, quantity=0)
+    tracker = lab.LotTracker(system.conn)
+    tracker.receive("CHE0001", "L-LATE", 10, expiry_date="2031-01-01")
+    tracker.receive("CHE0001", "L-EARLY", 10, expiry_date="2030-01-01")
+    return system.conn
+
+
+def test_receive_tracks_lots_and_earliest_expiry(lots):
+    assert lab.LotTracker(lots).is_tracked("CHE0001")
+    assert stock(lots, "CHE0001") == ({"L-LATE": 10, "L-EARLY": 10}, 20, "2030-01-01")
+
+
+def test_consumption_is_first_expired_first_out(lots):
+    consume(lots, "CHE0001", 12)
+    assert stock(lots, "CHE0001") == ({"L-LATE": 8, "L-EARLY": 0}, 8, "2031-01-01")
+    assert [row[1] for row in lab.LotTracker(lots).lots("CHE0001")] == ["L-LATE"]
+
+
+def test_credit_goes_to_the_newest_lot(lots):
+    consume(lots, "CHE0001", -3)
+    assert stock(lots, "CHE0001")[0] == {"L-LATE": 10, "L-EARLY": 13}
+
+
+def test_returned_loan_restores_the_same_lots(lots):
+    consume(lots, "CHE0001", 4)
+    log_id = consume(lots, "CHE0001", 9, returnable=1)
+    assert stock(lots, "CHE0001")[0] == {"L-LATE": 7, "L-EARLY": 0}
+    assert lab.LoanTracker(lots).check_in([log_id]) == 1
+    assert stock(lots, "CHE0001") == ({"L-LATE": 10, "L-EARLY": 6}, 16, "2030-01-01")
+
+
+def test_manual_quantity_edit_is_reconciled(lots):
+    lots.execute("UPDATE items SET quantity = 5 WHERE id = 'CHE0001'")
+    assert stock(lots, "CHE0001")[0] == {"L-LATE": 5, "L-EARLY": 0}
+    lots.execute("UPDATE items SET quantity = 9 WHERE id = 'CHE0001'")
+    assert stock(lots, "CHE0001")[0] == {"L-LATE": 5, "L-EARLY": 4}
+
+
+def test_lots_replicate_between_sites(tmp_path):
+    systems = make_system(tmp_path / "a"), make_system(tmp_path / "b")
+    a, b = (system.conn for system in systems)
+    add_items(a, 1, quantity=0)
+    lab.LotTracker(a).receive("CHE0001", "L-LATE", 10, expiry_date="2031-01-01")
+    lab.LotTracker(a).receive("CHE0001", "L-EARLY", 10, expiry_date="2030-01-01")
+    lab.SyncEngine(a).sync_with(b)
+    assert stock(b, "CHE0001") == stock(a, "CHE0001") == ({"L-LATE": 10, "L-EARLY": 10}, 20, "2030-01-01")
+    # Both sites consume FEFO locally, then merge
+    consume(a, "CHE0001", 6)
+    consume(b, "CHE0001", 3)
+    lab.SyncEngine(a).sync_with(b)
+    assert stock(a, "CHE0001") == stock(b, "CHE0001") == ({"L-LATE": 10, "L-EARLY": 1}, 11, "2030-01-01")
+    # Overdrawing a lot concurrently settles to the same FEFO split on both sides
+    consume(a, "CHE0001", 5)
+    consume(b, "CHE0001", 2)
+    lab.SyncEngine(a).sync_with(b)
+    assert stock(a, "CHE0001") == stock(b, "CHE0001") == ({"L-LATE": 4, "L-EARLY": 0}, 4, "2031-01-01")
+    assert lab.SyncEngine(a).sync_with(b) == (0, 0)
+
+
+def test_existing_lots_are_captured_on_upgrade(tmp_path):
+    systems = make_system(tmp_path / "a"), make_system(tmp_path / "b")
+    a, b = (system.conn for system in systems)
+    add_items(a, 1, quantity=0)
+    lab.LotTracker(a).receive("CHE0001", "L-1", 4)
+    # A database that synced before lots were tracked
+    a.execute("DELETE FROM change_log WHERE table_name = 'item_lots'")
+    a.execute("UPDATE app_meta SET value = '[\"items\", \"usage_log\"]' WHERE key = 'captured_tables'")
+    a.commit()
+    lab.SyncEngine.install(a)
+    a.commit()
+    lab.SyncEngine(a).sync_with(b)
+    assert stock(b, "CHE0001")[0] == {"L-1": 4}
@@ -0,0 +1,92 @@
+"""Point-in-time stock from snapshots, usage_log and the adjustment journal"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import add_items, lab, make_system
+
+
+@pytest.fixture
+def store(system):
+    add_items(system.conn, 2, quantity=50)
+    return lab.StockSnapshotStore(system.conn)
+
+
+def backdate_snapshots(conn, hours):
+    taken_at = (datetime.now() - timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("UPDATE stock_snapshots SET taken_at = ?", (taken_at,))
+    conn.commit()
+
+
+def soon():
+    return datetime.now() + timedelta(seconds=2)
+
+
+def edit_quantity(conn, item_id, quantity):
+    editor = lab.ItemEditor(conn)
+    original, version = editor.load(item_id)
+    editor.save(item_id, original, {"quantity": quantity}, version)
+
+
+def test_item_edit_after_snapshot_counts_now_but_not_before(system, store):
+    conn = system.conn
+    store.take_snapshot()
+    backdate_snapshots(conn, 1)
+    edit_quantity(conn, "CHE0001", 80)
+    assert store.quantity_at("CHE0001", soon()) == 80
+    assert store.quantity_at("CHE0001", datetime.now() - timedelta(minutes=30)) == 50
+    # Before the only snapshot: replay backwards from it
+    assert store.quantity_at("CHE0001", datetime.now() - timedelta(hours=2)) == 50
+    # No snapshot at all: replay backwards from the live row
+    conn.execute("DELETE FROM stock_snapshots")
+    store._cache.clear()
+    assert store.quantity_at("CHE0001", datetime.now() - timedelta(minutes=30)) == 50
+
+
+def test_ledger_movements_and_returns_are_not_adjustments(system, store):
+    conn = system.conn
+    conn.execute("INSERT INTO usage_log (item_id, user, quantity_changed) VALUES ('CHE0001', 'bob', 5)")
+    conn.execute("UPDATE items SET quantity = quantity - 5 WHERE id = 'CHE0001'")
+    loan = conn.execute("""
+        INSERT INTO usage_log (item_id, user, quantity_changed, returnable) VALUES ('CHE0001', 'amy', 3, 1)
+    """).lastrowid
+    conn.execute("UPDATE items SET quantity = quantity - 3 WHERE id = 'CHE0001'")
+    conn.commit()
+    lab.LoanTracker(conn).check_in([loan])
+    assert conn.execute("SELECT COUNT(*) FROM stock_adjustments").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM ledger_pending").fetchone()[0] == 0
+    assert store.quantity_at("CHE0001", soon()) == 45
+
+
+def test_bulk_edit_undo_and_repair_are_journalled(system, store):
+    conn = system.conn
+    store.take_snapshot()
+    backdate_snapshots(conn, 1)
+    bulk = lab.BulkItemOperations(conn)
+    operation = bulk.update(["CHE0001", "CHE0002"], "quantity", 10)
+    assert [store.quantity_at(i, soon()) for i in ("CHE0001", "CHE0002")] == [10, 10]
+    bulk.undo(operation)
+    assert [store.quantity_at(i, soon()) for i in ("CHE0001", "CHE0002")] == [50, 50]
+    conn.execute("UPDATE items SET quantity = -4 WHERE id = 'CHE0002'")
+    conn.commit()
+    lab.DatabaseMaintenance(conn).repair(["quantities"])
+    live = conn.execute("SELECT quantity FROM items WHERE id = 'CHE0002'").fetchone()[0]
+    assert store.quantity_at("CHE0002", soon()) == live
+
+
+def test_synced_quantity_deltas_replay_on_the_peer(tmp_path):
+    systems = make_system(tmp_path / "a"), make_system(tmp_path / "b")
+    a, b = (system.conn for system in systems)
+    add_items(a, 1, quantity=50)
+    lab.SyncEngine(a).sync_with(b)
+    store = lab.StockSnapshotStore(b)
+    store.take_snapshot()
+    backdate_snapshots(b, 1)
+    edit_quantity(a, "CHE0001", 70)
+    a.execute("INSERT INTO usage_log (item_id, user, quantity_changed) VALUES ('CHE0001', 'bob', 5)")
+    a.execute("UPDATE items SET quantity = quantity - 5 WHERE id = 'CHE0001'")
+    a.commit()
+    lab.SyncEngine(a).sync_with(b)
+    assert b.execute("SELECT quantity FROM items").fetchone()[0] == 65
+    assert store.quantity_at("CHE0001", soon()) == 65
+    assert b.execute("SELECT SUM(quantity_delta) FROM stock_adjustments").fetchone()[0] == 20
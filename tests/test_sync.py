@@ -0,0 +1,85 @@
+"""Change capture and two-site delta sync"""
+import pytest
+
+from conftest import add_items, lab, make_system
+
+
+@pytest.fixture
+def sites(tmp_path):
+    a, b = make_system(tmp_path / "a"), make_system(tmp_path / "b")
+    yield a.conn, b.conn
+    a.conn.close()
+    b.conn.close()
+
+
+def add_item(conn, item_id, name, quantity, item_type="equipment"):
+    conn.execute("INSERT INTO items (id, name, item_type, quantity, last_updated) VALUES (?, ?, ?, ?, '2024-01-01')",
+                 (item_id, name, item_type, quantity))
+    conn.commit()
+
+
+def use(conn, item_id, quantity, user="bob"):
+    conn.execute("INSERT INTO usage_log (item_id, user, quantity_changed) VALUES (?, ?, ?)", (item_id, user, quantity))
+    conn.execute("UPDATE items SET quantity = quantity - ?, version = version + 1 WHERE id = ?", (quantity, item_id))
+    conn.commit()
+
+
+def items(conn):
+    return conn.execute("SELECT id, name, quantity FROM items ORDER BY id").fetchall()
+
+
+def test_concurrent_usage_converges(sites):
+    a, b = sites
+    add_items(a, 2, quantity=50)
+    lab.SyncEngine(a).sync_with(b)
+    use(a, "CHE0001", 5)
+    use(b, "CHE0001", 7)
+    use(b, "CHE0002", 1)
+    a.execute("UPDATE items SET location = 'Fridge A' WHERE id = 'CHE0002'")
+    a.commit()
+    lab.SyncEngine(a).sync_with(b)
+    assert items(a) == items(b) == [("CHE0001", "Item CHE0001", 38), ("CHE0002", "Item CHE0002", 49)]
+    assert b.execute("SELECT location FROM items WHERE id = 'CHE0002'").fetchone()[0] == "Fridge A"
+    assert a.execute("SELECT COUNT(*) FROM usage_log").fetchone()[0] == 3
+    assert b.execute("SELECT COUNT(*) FROM usage_log").fetchone()[0] == 3
+    assert lab.SyncEngine(a).sync_with(b) == (0, 0)
+
+
+def test_new_item_ids_are_unique_per_site(sites):
+    a, b = sites
+    first = lab.SyncEngine(a).new_item_id("EQ")
+    add_item(a, first, "Centrifuge", 1)
+    second = lab.SyncEngine(a).new_item_id("EQ")
+    assert first.startswith("EQ0001-") and second.startswith("EQ0002-")
+    add_item(b, lab.SyncEngine(b).new_item_id("EQ"), "Pipette", 5)
+    lab.SyncEngine(a).sync_with(b)
+    assert len(items(a)) == len(items(b)) == 2
+    assert {name for _, name, _ in items(a)} == {"Centrifuge", "Pipette"}
+
+
+def test_colliding_insert_is_reported_not_merged(sites):
+    a, b = sites
+    add_item(a, "EQ0001", "Centrifuge", 1)
+    add_item(b, "EQ0001", "Pipette", 5)
+    lab.SyncEngine(a).sync_with(b)
+    assert items(a) == [("EQ0001", "Centrifuge", 1)]
+    assert items(b) == [("EQ0001", "Pipette", 5)]
+    for conn in sites:
+        (conflict,) = lab.SyncEngine(conn).conflicts()
+        assert conflict[2:5] == ("items", "EQ0001", "INSERT")
+    # Later edits and usage of B's item must not leak into A's different item
+    use(b, "EQ0001", 2)
+    lab.SyncEngine(a).sync_with(b)
+    assert items(a) == [("EQ0001", "Centrifuge", 1)]
+    assert a.execute("SELECT COUNT(*) FROM usage_log").fetchone()[0] == 0
+    assert len(lab.SyncEngine(a).conflicts()) == 3
+
+
+def test_same_item_from_a_shared_copy_is_not_a_conflict(sites):
+    a, b = sites
+    add_item(a, "EQ0001", "Centrifuge", 4)
+    add_item(b, "EQ0001", "Centrifuge", 4)
+    use(a, "EQ0001", 1)
+    lab.SyncEngine(a).sync_with(b)
+    assert items(a) == items(b) == [("EQ0001", "Centrifuge", 3)]
+    assert lab.SyncEngine(a).conflicts() == lab.SyncEngine(b).conflicts() == []